@@ -1,9 +1,9 @@
 from django.contrib import admin
-from .models import UserProfile, Item, ItemCategory, Message, RecoveredItem
+from .models import UserProfile, Item, ItemCategory, ItemMatch, Message, Conversation, RecoveredItem
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
-	list_display = ('user', 'contact_number')
+	list_display = ('user', 'contact_number', 'unread_messages')
 
 @admin.register(ItemCategory)
 class ItemCategoryAdmin(admin.ModelAdmin):
@@ -11,12 +11,23 @@ class ItemCategoryAdmin(admin.ModelAdmin):
 
 @admin.register(Item)
 class ItemAdmin(admin.ModelAdmin):
-	list_display = ('title', 'status', 'category', 'location', 'date_reported', 'reported_by')
+	list_display = ('title', 'status', 'state', 'category', 'location', 'date_reported', 'reported_by')
+	list_filter = ('state', 'status')
+
+@admin.register(ItemMatch)
+class ItemMatchAdmin(admin.ModelAdmin):
+	list_display = ('item', 'candidate', 'score', 'scored_at')
+	raw_id_fields = ('item', 'candidate')
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
 	list_display = ('sender', 'recipient', 'item', 'timestamp', 'is_read')
 
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+	list_display = ('item', 'user_a', 'user_b', 'last_activity', 'unread_a', 'unread_b', 'archived_a', 'archived_b')
+	raw_id_fields = ('item', 'user_a', 'user_b', 'last_message')
+
 @admin.register(RecoveredItem)
 class RecoveredItemAdmin(admin.ModelAdmin):
 	list_display = ('item', 'owner', 'finder', 'recovered_date', 'rating', 'rated_at')
@@ -0,0 +1,29 @@
+"""
+System checks for settings that only break once there are several workers.
+"""
+from django.conf import settings
+from django.core.checks import Warning, register
+
+# Cache backends that keep their entries inside one process
+PER_PROCESS_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """Chat rate limits and presence live in the cache, which must be shared when the channel layer is"""
+    layer = getattr(settings, 'CHANNEL_LAYERS', {}).get('default', {}).get('BACKEND', '')
+    if not layer or layer == 'channels.layers.InMemoryChannelLayer':
+        # A single process: a per-process cache sees everything
+        return []
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+    if backend not in PER_PROCESS_CACHES:
+        return []
+    return [Warning(
+        f'The channel layer connects several processes but the default cache ({backend}) is per-process.',
+        hint='Per-user chat rate limits and presence are then kept per worker. Use a shared cache such as '
+             'django.core.cache.backends.redis.RedisCache.',
+        id='FindIt.W001',
+    )]
@@ -1,15 +1,75 @@
 import json
+import logging
+import time
+import uuid
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
-from .models import Message
+from django.utils import timezone
+from .messaging import conversation_messages, message_history, messages_after, unread_count
+from .notifications import user_group
+from . import metrics, presence
+from .ratelimit import TokenBucket, chat_limits, retry_after_seconds, take_shared
+from .storage import media_storage, release
+from .uploads import UploadError, discard_upload, finish_upload, parse_chunk, start_upload, write_chunk
+from .writebehind import PendingMessage, get_writer
+
+logger = logging.getLogger(__name__)
+
+# Missed messages sent per replay frame; the client asks again while has_more is set
+REPLAY_PAGE_SIZE = 50
+TIMESTAMP_FORMAT = '%b. %d, %Y, %I:%M %p'
+
+
+def message_event(message):
+    """A stored message in the same shape as a live chat_message frame"""
+    timestamp = timezone.localtime(message.timestamp)
+    return {
+        'message': message.content,
+        'sender_id': message.sender_id,
+        'sender_username': message.sender.username,
+        'timestamp': timestamp.strftime(TIMESTAMP_FORMAT),
+        'time': timestamp.strftime('%H:%M'),
+        'message_id': message.id,
+        'client_id': message.client_id or None,
+        'image_url': message.image.url if message.image else None,
+        'image_width': message.image_width,
+        'image_height': message.image_height,
+    }
+
+def chat_group(item_id, user_id, other_user_id):
+    """The room of a conversation: the same for both participants"""
+    low, high = sorted((user_id, other_user_id))
+    return f'chat_{item_id}_{low}_{high}'
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
-        self.room_group_name = f'chat_{self.conversation_id}'
+        self.room_group_name = None
+        self.heartbeat = None
+        self.user = self.scope.get('user')
+        if self.user is None or not self.user.is_authenticated:
+            logger.info('chat refused reason=anonymous conversation=%s', self.conversation_id)
+            await self.close()
+            return
+        # Checked once per socket: every later frame acts on this item and these two users
+        self.item, self.other_user = await self.authorize()
+        if self.item is None:
+            logger.info('chat refused reason=forbidden user=%s conversation=%s', self.user.pk, self.conversation_id)
+            await self.close()
+            return
 
-        print(f"🔵 WebSocket CONNECT: conversation_id={self.conversation_id}, room={self.room_group_name}")
+        self.room_group_name = chat_group(self.item.pk, self.user.pk, self.other_user.pk)
+        self.limits = chat_limits()
+        self.bucket = TokenBucket(self.limits['connection_rate'], self.limits['connection_burst'])
+        self.upload_bucket = TokenBucket(self.limits['upload_rate'], self.limits['upload_burst'])
+        self.violations = 0
+        # upload_id -> upload in progress on this socket; part files outlive the
+        # socket so a reconnecting client can resume
+        self.uploads = {}
+        self.typing = presence.TypingThrottle(self.send_typing)
 
         # Join room group
         await self.channel_layer.group_add(
@@ -18,10 +78,25 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
 
         await self.accept()
-        print(f"✅ WebSocket ACCEPTED: {self.channel_name}")
+        metrics.connections.inc(consumer='chat')
+        logger.info('chat connect user=%s room=%s channel=%s', self.user.pk, self.room_group_name, self.channel_name)
+
+        await self.channel_layer.group_add(presence.presence_group(self.other_user.pk), self.channel_name)
+        await self.send(text_data=json.dumps(await presence.get_presence(self.other_user.pk)))
+        self.heartbeat = await presence.join(self.channel_layer, self.user.pk)
 
     async def disconnect(self, close_code):
-        print(f"🔴 WebSocket DISCONNECT: conversation_id={self.conversation_id}, code={close_code}")
+        if self.room_group_name is None:
+            # Refused in connect
+            return
+        metrics.connections.dec(consumer='chat')
+        logger.info('chat disconnect user=%s room=%s code=%s', self.user.pk, self.room_group_name, close_code)
+        await self.typing.stop()
+        # Store this socket's queued messages before it goes away
+        await get_writer().flush()
+        if self.heartbeat is not None:
+            await presence.leave(self.channel_layer, self.user.pk, self.heartbeat)
+            await self.channel_layer.group_discard(presence.presence_group(self.other_user.pk), self.channel_name)
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
@@ -29,42 +104,210 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
-        print(f"📨 WebSocket RECEIVED: {text_data}")
-        text_data_json = json.loads(text_data)
-        message_content = text_data_json['message']
-        sender_id = text_data_json['sender_id']
-        recipient_id = text_data_json['recipient_id']
-        item_id = text_data_json.get('item_id')
-        image = text_data_json.get('image', None)
-
-        print(f"📝 Parsed message: sender={sender_id}, recipient={recipient_id}, item={item_id}, content='{message_content}'")
-
-        # Save message to database
-        message = await self.save_message(
-            sender_id=sender_id,
-            recipient_id=recipient_id,
-            item_id=item_id,
-            content=message_content,
-            image=image
+    async def receive(self, text_data=None, bytes_data=None):
+        metrics.frames.inc(kind='text' if bytes_data is None else 'binary')
+        if self.violations >= self.limits['max_violations']:
+            # Already closing this socket
+            return
+        if bytes_data is not None:
+            await self.receive_chunk(bytes_data)
+            return
+        size = len(text_data.encode()) if text_data is not None else 0
+        if size > self.limits['max_frame_bytes']:
+            await self.reject('too_large')
+            return
+        wait = self.bucket.take()
+        if wait:
+            await self.reject('rate_limited', retry_after=wait)
+            return
+        try:
+            text_data_json = json.loads(text_data)
+        except (TypeError, ValueError):
+            await self.reject('invalid')
+            return
+        if not isinstance(text_data_json, dict):
+            await self.reject('invalid')
+            return
+
+        # History request: {"type": "history", "before": <oldest message id shown>}
+        if text_data_json.get('type') == 'history':
+            await self.send(text_data=json.dumps(await self.load_history(text_data_json.get('before'))))
+            return
+
+        # Resume after a reconnect: {"type": "resume", "after": <newest message id seen>}
+        if text_data_json.get('type') == 'resume':
+            await self.send(text_data=json.dumps(await self.load_missed(text_data_json.get('after'))))
+            return
+
+        # Keystrokes: {"type": "typing"}; coalesced before they reach the room
+        if text_data_json.get('type') == 'typing':
+            await self.typing.keystroke()
+            return
+
+        # Sender, recipient and item come from the socket, never from the frame
+        message_content = str(text_data_json.get('message') or '')
+        client_id = str(text_data_json.get('client_id') or uuid.uuid4().hex)[:64]
+
+        if len(message_content) > self.limits['max_message_length']:
+            await self.reject('too_large', client_id=client_id)
+            return
+        # The database is behind: push back on senders rather than queue without bound
+        if len(get_writer()) >= self.limits['max_pending_writes']:
+            await self.reject('busy', client_id=client_id, retry_after=1)
+            return
+
+        # Image upload: {"type": "upload_start", "upload_id", "size", ...}, then binary chunks
+        if text_data_json.get('type') == 'upload_start':
+            await self.start_upload(text_data_json, message_content, client_id)
+            return
+
+        if not message_content:
+            await self.reject('invalid', client_id=client_id)
+            return
+        wait = await take_shared(
+            f'chat:user:{self.user.pk}', self.limits['user_messages'], self.limits['user_window'],
         )
+        if wait:
+            await self.reject('rate_limited', client_id=client_id, retry_after=wait)
+            return
+
+        logger.debug('chat message user=%s room=%s client_id=%s length=%d',
+                     self.user.pk, self.room_group_name, client_id, len(message_content))
+        await self.publish_message(message_content, client_id)
 
-        print(f"💾 Message saved to DB: id={message['id']}")
+    async def publish_message(self, content, client_id, image=None):
+        """Broadcast a message (with an uploads.StoredImage, if any) to the room and queue it for storage.
 
-        # Send message to room group
+        Broadcast first; the writer stores the message in the next batch and
+        the room gets a chat_message_saved event with its id, or
+        chat_message_failed (see writebehind.py)
+        """
+        await self.typing.stop()
+        started = time.perf_counter()
         await self.channel_layer.group_send(
             self.room_group_name,
             {
                 'type': 'chat_message',
-                'message': message_content,
-                'sender_id': sender_id,
-                'sender_username': message['sender_username'],
-                'timestamp': message['timestamp'],
-                'message_id': message['id'],
+                'message': content,
+                'sender_id': self.user.pk,
+                'sender_username': self.user.username,
+                'timestamp': timezone.localtime().strftime(TIMESTAMP_FORMAT),
+                'message_id': None,
+                'client_id': client_id,
+                'image_url': media_storage().url(image.name) if image else None,
+                'image_width': image.width if image else None,
+                'image_height': image.height if image else None,
             }
         )
-        
-        print(f"📤 Broadcasted to room: {self.room_group_name}")
+        get_writer().enqueue(PendingMessage(
+            client_id=client_id,
+            sender_id=self.user.pk,
+            recipient_id=self.other_user.pk,
+            item_id=self.item.pk,
+            content=content,
+            image=image,
+            room=self.room_group_name,
+        ))
+
+        metrics.fan_out_seconds.observe(time.perf_counter() - started)
+        metrics.messages.inc(kind='image' if image else 'text')
+
+    async def start_upload(self, frame, content, client_id):
+        upload_id = frame.get('upload_id')
+        try:
+            upload = await sync_to_async(start_upload)(
+                self.user.pk, upload_id, frame.get('size'), self.limits['max_upload_bytes'],
+            )
+        except UploadError as e:
+            await self.reject(e.reason, client_id=client_id, upload_id=upload_id)
+            return
+        if not upload.resumed:
+            # An image is one message: charge it against the user's budget once, up front
+            wait = await take_shared(
+                f'chat:user:{self.user.pk}', self.limits['user_messages'], self.limits['user_window'],
+            )
+            if wait:
+                await sync_to_async(discard_upload)(upload)
+                await self.reject('rate_limited', client_id=client_id, retry_after=wait, upload_id=upload_id)
+                return
+        self.uploads[upload.upload_id] = {
+            'upload': upload,
+            'content': content,
+            'client_id': client_id,
+        }
+        await self.send(text_data=json.dumps({
+            'type': 'upload_ready',
+            'upload_id': upload.upload_id,
+            'offset': upload.received,
+        }))
+        if upload.complete:
+            # Every byte arrived before the previous socket dropped
+            await self.complete_upload(upload.upload_id)
+
+    async def receive_chunk(self, frame):
+        """Binary frame: one chunk of an upload announced with upload_start"""
+        if len(frame) > self.limits['max_chunk_bytes'] + 1 + 255 + 8:
+            await self.reject('too_large')
+            return
+        try:
+            upload_id, offset, data = parse_chunk(frame)
+        except UploadError as e:
+            await self.reject(e.reason)
+            return
+        wait = self.upload_bucket.take(len(frame))
+        if wait:
+            # The client resends from the offset it gets back with upload_ready
+            await self.reject('rate_limited', retry_after=wait, upload_id=upload_id)
+            return
+        state = self.uploads.get(upload_id)
+        if state is None:
+            await self.reject('unknown_upload', upload_id=upload_id)
+            return
+        upload = state['upload']
+        try:
+            received = await sync_to_async(write_chunk)(upload, offset, data)
+        except UploadError as e:
+            del self.uploads[upload_id]
+            await self.reject(e.reason, client_id=state['client_id'], upload_id=upload_id)
+            return
+        await self.send(text_data=json.dumps({'type': 'upload_ack', 'upload_id': upload_id, 'offset': received}))
+        if upload.complete:
+            await self.complete_upload(upload_id)
+
+    async def complete_upload(self, upload_id):
+        state = self.uploads.pop(upload_id)
+        try:
+            image = await sync_to_async(finish_upload)(state['upload'])
+        except UploadError as e:
+            await self.reject(e.reason, client_id=state['client_id'], upload_id=upload_id)
+            return
+        try:
+            await self.publish_message(state['content'], state['client_id'], image=image)
+        except BaseException:
+            # Never queued, so no message will hold the stored file
+            await database_sync_to_async(release)(image.name, media_storage())
+            raise
+        await self.send(text_data=json.dumps({
+            'type': 'upload_done',
+            'upload_id': upload_id,
+            'client_id': state['client_id'],
+        }))
+
+    async def reject(self, reason, client_id=None, retry_after=None, upload_id=None):
+        """Tell the client a frame was refused; close sockets that keep getting refused"""
+        metrics.rejected_frames.inc(reason=reason)
+        frame = {'type': 'rejected', 'reason': reason, 'client_id': client_id}
+        if upload_id is not None:
+            frame['upload_id'] = upload_id
+        if retry_after:
+            frame['retry_after'] = retry_after_seconds(retry_after)
+        await self.send(text_data=json.dumps(frame))
+        self.violations += 1
+        if self.violations >= self.limits['max_violations']:
+            # 4008: policy violation, in the application range
+            logger.warning('chat closed user=%s room=%s reason=too_many_violations last=%s',
+                           self.user.pk, self.room_group_name, reason)
+            await self.close(code=4008)
 
     # Receive message from room group
     async def chat_message(self, event):
@@ -74,8 +317,6 @@ class ChatConsumer(AsyncWebsocketConsumer):
         timestamp = event['timestamp']
         message_id = event['message_id']
 
-        print(f"📡 Sending to WebSocket client: message_id={message_id}, sender={sender_username}")
-
         # Send message to WebSocket
         await self.send(text_data=json.dumps({
             'message': message,
@@ -83,28 +324,129 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'sender_username': sender_username,
             'timestamp': timestamp,
             'message_id': message_id,
+            'client_id': event.get('client_id'),
+            'image_url': event.get('image_url'),
+            'image_width': event.get('image_width'),
+            'image_height': event.get('image_height'),
+        }))
+
+    async def send_typing(self, typing):
+        await self.channel_layer.group_send(self.room_group_name, {
+            'type': 'chat_typing',
+            'user_id': self.user.pk,
+            'typing': typing,
+        })
+
+    async def chat_typing(self, event):
+        if event['user_id'] == self.user.pk:
+            return
+        await self.send(text_data=json.dumps({
+            'type': 'typing',
+            'user_id': event['user_id'],
+            'typing': event['typing'],
+            # Clients hide the indicator after this long without a refresh, in case the stop is lost
+            'expires_in': presence.TYPING_TIMEOUT + presence.TYPING_THROTTLE,
+        }))
+
+    # The other participant came online or went offline
+    async def presence_changed(self, event):
+        await self.send(text_data=json.dumps(event['presence']))
+
+    # The writer stored a message broadcast earlier, or found it already stored
+    async def chat_message_saved(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'saved',
+            'client_id': event['client_id'],
+            'message_id': event['message_id'],
+            'duplicate': event.get('duplicate', False),
+        }))
+
+    # The writer could not store a message broadcast earlier; its sender may resend it
+    async def chat_message_failed(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'error',
+            'client_id': event['client_id'],
+            'sender_id': event['sender_id'],
         }))
 
     @database_sync_to_async
-    def save_message(self, sender_id, recipient_id, item_id, content, image=None):
+    def authorize(self):
+        """The item and other participant of this socket's conversation, or (None, None)"""
+        from .messaging import can_chat
         from .models import Item
-        sender = User.objects.get(id=sender_id)
-        recipient = User.objects.get(id=recipient_id)
-        item = Item.objects.get(id=item_id)
-        
-        message = Message.objects.create(
-            sender=sender,
-            recipient=recipient,
-            item=item,
-            content=content,
-        )
-        
-        if image:
-            message.image = image
-            message.save()
-        
+        item_id, _, other_user_id = self.conversation_id.partition('-')
+        if not (item_id.isdigit() and other_user_id.isdigit()):
+            return None, None
+        item = Item.objects.filter(id=item_id).first()
+        other_user = User.objects.filter(id=other_user_id).first()
+        if item is None or other_user is None or not can_chat(self.user, item, other_user):
+            return None, None
+        return item, other_user
+
+    def _conversation_messages(self):
+        """Messages of this socket's conversation visible to its user"""
+        return conversation_messages(self.user, self.item, self.other_user)
+
+    @database_sync_to_async
+    def load_history(self, before=None):
+        from django.template.loader import render_to_string
+        messages = self._conversation_messages()
+        try:
+            before_id = int(before) if before is not None else None
+        except (TypeError, ValueError):
+            return {'type': 'history', 'error': 'Invalid cursor'}
+
+        page, has_older = message_history(messages, before_id=before_id)
         return {
-            'id': message.id,
-            'sender_username': sender.username,
-            'timestamp': message.timestamp.strftime('%b. %d, %Y, %I:%M %p'),
+            'type': 'history',
+            'html': render_to_string('FindIt/chat_messages.html', {'messages': page, 'user': self.user}),
+            'count': len(page),
+            'before': page[0].id if page else None,
+            'has_older': has_older,
         }
+
+    @database_sync_to_async
+    def load_missed(self, after):
+        messages = self._conversation_messages()
+        try:
+            after_id = int(after)
+        except (TypeError, ValueError):
+            return {'type': 'replay', 'error': 'Invalid cursor'}
+
+        page, has_more = messages_after(messages, after_id, limit=REPLAY_PAGE_SIZE)
+        return {
+            'type': 'replay',
+            'messages': [message_event(message) for message in page],
+            'after': page[-1].id if page else after_id,
+            'has_more': has_more,
+        }
+
+
+class NotificationConsumer(AsyncWebsocketConsumer):
+    """One socket per open page; see notifications.py for the events"""
+
+    async def connect(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close()
+            return
+        self.group_name = user_group(user.pk)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        metrics.connections.inc(consumer='notify')
+        # Any open page counts as online
+        self.heartbeat = await presence.join(self.channel_layer, user.pk)
+        # Absolute state first; everything after it is a delta
+        await self.send(text_data=json.dumps({
+            'type': 'sync',
+            'unread': await database_sync_to_async(unread_count)(user),
+        }))
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'group_name'):
+            metrics.connections.dec(consumer='notify')
+            await presence.leave(self.channel_layer, self.scope['user'].pk, self.heartbeat)
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def notify(self, event):
+        await self.send(text_data=json.dumps(event['event']))
@@ -0,0 +1,89 @@
+"""
+Category registry and item facet counts.
+
+Categories change rarely but are needed on every page (navbar, filters), so
+they are held in a process-local copy backed by the shared Django cache. A
+version number in the shared cache is bumped by the ItemCategory signal
+handlers in models.py once the change commits; each process re-checks it at most every
+LOCAL_TTL seconds, so edits reach every worker without a query per request.
+
+Facet counts (listed items per category and per status) come from a single
+GROUP BY query and are cached briefly, since they only feed the filter labels.
+"""
+import time
+
+from django.core.cache import cache
+from django.db.models import Count
+
+CATEGORY_VERSION_KEY = 'findit:categories:version'
+CATEGORY_DATA_KEY = 'findit:categories:{version}'
+FACET_KEY = 'findit:facets'
+# Seconds a process trusts its local category copy before re-checking the version
+LOCAL_TTL = 5
+# Superseded versions simply age out of the shared cache
+CATEGORY_DATA_TTL = 24 * 60 * 60
+FACET_TTL = 60
+
+_local = {'version': None, 'checked': 0.0, 'categories': ()}
+
+
+def _current_version():
+    version = cache.get(CATEGORY_VERSION_KEY)
+    if version is None:
+        # add() so concurrent workers agree on the first version
+        cache.add(CATEGORY_VERSION_KEY, 1, timeout=None)
+        version = cache.get(CATEGORY_VERSION_KEY, 1)
+    return version
+
+
+def get_categories():
+    """All item categories, in creation order"""
+    from .models import ItemCategory
+
+    now = time.monotonic()
+    if _local['version'] is not None and now - _local['checked'] < LOCAL_TTL:
+        return _local['categories']
+
+    version = _current_version()
+    if version != _local['version']:
+        key = CATEGORY_DATA_KEY.format(version=version)
+        categories = cache.get(key)
+        if categories is None:
+            categories = tuple(ItemCategory.objects.order_by('id'))
+            cache.set(key, categories, timeout=CATEGORY_DATA_TTL)
+        _local['categories'] = categories
+        _local['version'] = version
+    _local['checked'] = now
+    return _local['categories']
+
+
+def invalidate_categories():
+    try:
+        cache.incr(CATEGORY_VERSION_KEY)
+    except ValueError:
+        cache.set(CATEGORY_VERSION_KEY, 1, timeout=None)
+    _local['version'] = None
+
+
+def facet_counts():
+    """Listed item counts as ``{'category': {id: n}, 'status': {status: n}, 'total': n}``"""
+    from .models import Item
+
+    counts = cache.get(FACET_KEY)
+    if counts is not None:
+        return counts
+
+    counts = {'category': {}, 'status': {}, 'total': 0}
+    rows = Item.objects.filter(state__in=Item.LISTED_STATES).order_by().values(
+        'category_id', 'status',
+    ).annotate(n=Count('id'))
+    for row in rows:
+        counts['category'][row['category_id']] = counts['category'].get(row['category_id'], 0) + row['n']
+        counts['status'][row['status']] = counts['status'].get(row['status'], 0) + row['n']
+        counts['total'] += row['n']
+    cache.set(FACET_KEY, counts, timeout=FACET_TTL)
+    return counts
+
+
+def invalidate_facets():
+    cache.delete(FACET_KEY)
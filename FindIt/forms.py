@@ -1,8 +1,29 @@
 from django import forms
 from django.contrib.auth.models import User
+from django.core.files.uploadedfile import UploadedFile
+from .ingest import ImageRejected, normalize
 from .models import UserProfile, Item
 from .models import UserReview
 from .models import ReturnConfirmation
+
+
+class NormalizedImageField(forms.ImageField):
+    """An ImageField whose new uploads come out of cleaning re-encoded by ingest.normalize()"""
+
+    def __init__(self, *, kind, **kwargs):
+        self.kind = kind
+        super().__init__(**kwargs)
+
+    def clean(self, data, initial=None):
+        value = super().clean(data, initial)
+        # Not the stored file kept, nor False for "clear"
+        if isinstance(value, UploadedFile):
+            try:
+                return normalize(value, self.kind)
+            except ImageRejected as e:
+                raise forms.ValidationError(str(e), code='invalid_image')
+        return value
+
 class UserRegistrationForm(forms.ModelForm):
     email = forms.EmailField(
         label='',
@@ -62,6 +83,8 @@ class LoginForm(forms.Form):
     )
 
 class ItemForm(forms.ModelForm):
+    photo = NormalizedImageField(kind='item_photos', required=False)
+
     class Meta:
         model = Item
         fields = ['title', 'description', 'category', 'location', 'photo', 'status']
@@ -124,7 +147,7 @@ class UserProfileForm(forms.ModelForm):
         label='',
         widget=forms.TextInput(attrs={'placeholder': 'Contact Number'})
     )
-    profile_picture = forms.ImageField(required=False)
+    profile_picture = NormalizedImageField(kind='profile_pics', required=False)
     
     address = forms.CharField(
         label='',
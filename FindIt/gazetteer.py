@@ -0,0 +1,188 @@
+"""
+Location normalization and radius search.
+
+Free-text ``Item.location`` values are resolved against a local gazetteer
+(FindIt/data/gazetteer.json, or ``settings.GAZETTEER_PATH``) so that "Main
+Library", "main lib" and "Library, 2nd floor" all become the same place id and
+coordinates. Items are resolved when created and again whenever their location
+text changes, so a place corrected by hand sticks. Resolved items also get a
+coarse grid cell key; a "within N metres" search of a small radius first narrows
+by the indexed cells covering the search circle. Wider searches, which would need hundreds of cells, narrow by a range on
+the indexed (latitude, longitude) instead. Both then check the bounding box and
+exact great-circle distance. No PostGIS needed.
+"""
+import json
+import math
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+from django.db.models import F
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt
+
+DEFAULT_GAZETTEER_PATH = Path(__file__).resolve().parent / 'data' / 'gazetteer.json'
+EARTH_RADIUS_M = 6371000
+METRES_PER_DEGREE = 111320
+# Side of one grid cell; radius searches touch ceil(2r / GRID_CELL_METRES + 1)^2 cells
+GRID_CELL_METRES = 250
+# The widest "near" choice on item_list
+MAX_RADIUS_METRES = 2000
+# Beyond this many cells (radius ~ 875 m) a coordinate range beats a long IN list
+MAX_GRID_CELLS = 64
+
+# Words that describe a spot inside a place rather than the place itself
+NOISE_WORDS = frozenset(
+    'the a an at in on near beside behind inside outside of by floor flr fl room rm level lvl '
+    'st nd rd th 1st 2nd 3rd 4th 5th ground first second third fourth fifth'.split()
+)
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+@dataclass(frozen=True)
+class Place:
+    id: str
+    name: str
+    lat: float
+    lng: float
+    aliases: tuple = field(default=())
+
+
+def _tokens(text):
+    return tuple(
+        token for token in TOKEN_RE.findall((text or '').lower())
+        if token not in NOISE_WORDS and not token.isdigit()
+    )
+
+
+class Gazetteer:
+    def __init__(self, places):
+        self.places = {place.id: place for place in places}
+        self._by_phrase = {}
+        for place in places:
+            for phrase in (place.name, place.id.replace('-', ' '), *place.aliases):
+                self._by_phrase.setdefault(_tokens(phrase), place)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding='utf-8') as fh:
+            data = json.load(fh)
+        return cls([
+            Place(p['id'], p['name'], float(p['lat']), float(p['lng']), tuple(p.get('aliases', ())))
+            for p in data['places']
+        ])
+
+    def get(self, place_id):
+        return self.places.get(place_id)
+
+    def resolve(self, text):
+        """Best matching place for a free-text location, or None"""
+        tokens = _tokens(text)
+        if not tokens:
+            return None
+        exact = self._by_phrase.get(tokens)
+        if exact:
+            return exact
+
+        best, best_score = None, 0.0
+        for phrase, place in self._by_phrase.items():
+            score = _phrase_score(tokens, phrase)
+            if score > best_score:
+                best, best_score = place, score
+        return best if best_score >= 0.5 else None
+
+
+def _token_matches(query_token, phrase_token):
+    # "lib" -> "library", "eng" -> "engineering"
+    return query_token == phrase_token or (len(query_token) >= 3 and phrase_token.startswith(query_token))
+
+
+def _phrase_score(tokens, phrase):
+    """Share of the phrase covered by the query, penalised by unmatched query words"""
+    if not phrase:
+        return 0.0
+    matched = sum(1 for p in phrase if any(_token_matches(t, p) for t in tokens))
+    if not matched:
+        return 0.0
+    return matched / len(phrase) * (matched / max(len(tokens), matched)) ** 0.5
+
+
+@lru_cache(maxsize=1)
+def get_gazetteer():
+    return Gazetteer.from_file(getattr(settings, 'GAZETTEER_PATH', DEFAULT_GAZETTEER_PATH))
+
+
+def grid_cell(lat, lng):
+    size = GRID_CELL_METRES / METRES_PER_DEGREE
+    return f'{math.floor(lat / size)}:{math.floor(lng / size)}'
+
+
+def cells_within(lat, lng, radius):
+    """All grid cell keys overlapping the bounding box of a circle"""
+    size = GRID_CELL_METRES / METRES_PER_DEGREE
+    min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius)
+    rows = range(math.floor(min_lat / size), math.floor(max_lat / size) + 1)
+    cols = range(math.floor(min_lng / size), math.floor(max_lng / size) + 1)
+    return [f'{row}:{col}' for row in rows for col in cols]
+
+
+def bounding_box(lat, lng, radius):
+    dlat = radius / METRES_PER_DEGREE
+    dlng = radius / (METRES_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return lat - dlat, lat + dlat, lng - dlng, lng + dlng
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Great-circle distance in metres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def normalize_location(item):
+    """Set place_id, coordinates and grid cell on ``item`` from its location text"""
+    place = get_gazetteer().resolve(item.location)
+    if place is None:
+        item.place_id = ''
+        item.latitude = item.longitude = None
+        item.grid_cell = ''
+    else:
+        item.place_id = place.id
+        item.latitude, item.longitude = place.lat, place.lng
+        item.grid_cell = grid_cell(place.lat, place.lng)
+    return place
+
+
+def remember_location(item):
+    """Note the location text as loaded (post_init), to tell later whether it changed"""
+    item._resolved_location = item.__dict__.get('location')
+
+
+def normalize_changed_location(item):
+    """Resolve ``item`` before a save (pre_save) only if it is new or its location text changed.
+
+    A place id or coordinates corrected by hand on an existing item are kept
+    until someone edits the location itself.
+    """
+    if item._state.adding or getattr(item, '_resolved_location', None) != item.__dict__.get('location'):
+        normalize_location(item)
+
+
+def filter_within(queryset, lat, lng, radius):
+    """Items within ``radius`` metres of (lat, lng), annotated with ``distance``"""
+    radius = min(float(radius), MAX_RADIUS_METRES)
+    min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius)
+    queryset = queryset.filter(latitude__range=(min_lat, max_lat), longitude__range=(min_lng, max_lng))
+    cells = cells_within(lat, lng, radius)
+    if len(cells) <= MAX_GRID_CELLS:
+        queryset = queryset.filter(grid_cell__in=cells)
+    lat_r, lng_r = math.radians(lat), math.radians(lng)
+    a = (
+        Power(Sin((Radians(F('latitude')) - lat_r) / 2), 2)
+        + math.cos(lat_r) * Cos(Radians(F('latitude'))) * Power(Sin((Radians(F('longitude')) - lng_r) / 2), 2)
+    )
+    distance = 2 * EARTH_RADIUS_M * ASin(Sqrt(a))
+    return queryset.annotate(distance=distance).filter(distance__lte=radius)
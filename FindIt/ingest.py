@@ -0,0 +1,200 @@
+"""
+Ingest stage for uploaded images.
+
+Phones upload 8-12 MB photos full of EXIF (GPS position included). Every
+item photo, profile picture and chat image goes through normalize() before
+it is stored:
+
+1. ImageBudgetUploadHandler (first in FILE_UPLOAD_HANDLERS) counts the bytes
+   of each image field while the request streams in and drops the file as
+   soon as it passes its kind's ``max_bytes``, so an oversized upload is
+   never spooled whole; the view reports it with add_upload_errors() /
+   upload_errors().
+2. The image is decoded once, at reduced scale for JPEGs where the target
+   size allows, rotated upright from its EXIF orientation and fitted within
+   ``max_side``.
+3. It is re-encoded as WebP (JPEG, or PNG with transparency, when Pillow
+   lacks WebP). EXIF, XMP and comments are dropped; the ICC profile is kept
+   so colours survive.
+4. The result carries its width and height, which the pre_save hook in
+   models.py copies to the ``<field>_width`` / ``<field>_height`` columns so
+   templates can reserve layout space. Item photos also carry their
+   perceptual hash for the similarity index (see visual.py).
+
+HEIC/HEIF uploads are accepted when pillow-heif is installed.
+
+Budgets per kind (the field's upload_to directory) are in DEFAULT_BUDGETS
+and can be overridden with the IMAGE_BUDGETS setting.
+"""
+import io
+import posixpath
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+from django.template.defaultfilters import filesizeformat
+
+from . import visual
+
+try:
+    from pillow_heif import register_heif_opener
+except ImportError:
+    pass
+else:
+    register_heif_opener()
+
+MB = 1024 * 1024
+DEFAULT_BUDGETS = {
+    'item_photos': {'max_bytes': 15 * MB, 'max_side': 2048},
+    'profile_pics': {'max_bytes': 10 * MB, 'max_side': 800},
+    'chat_images': {'max_bytes': 10 * MB, 'max_side': 2048},
+}
+# Kind of the image each upload form field carries
+UPLOAD_FIELDS = {
+    'photo': 'item_photos',
+    'profile_picture': 'profile_pics',
+    'chat_image': 'chat_images',
+}
+# Refused before decoding: a small file can still expand to gigabytes of pixels
+MAX_PIXELS = 50_000_000
+WEBP_QUALITY = 80
+JPEG_QUALITY = 85
+# Kinds whose images get a perceptual hash, while they are decoded anyway
+HASHED_KINDS = frozenset({'item_photos'})
+
+
+class ImageRejected(ValueError):
+    """The upload is not an image we can store; the message is for the user"""
+
+
+class NormalizedImage(ContentFile):
+    """Re-encoded image bytes ready for storage, with their dimensions"""
+
+    def __init__(self, content, name, width, height, dhash=None):
+        super().__init__(content, name=name)
+        self.width = width
+        self.height = height
+        self.dhash = dhash
+
+
+def image_budget(kind):
+    return {**DEFAULT_BUDGETS[kind], **getattr(settings, 'IMAGE_BUDGETS', {}).get(kind, {})}
+
+
+def _too_large(kind):
+    return f'The image is larger than {filesizeformat(image_budget(kind)["max_bytes"])}.'
+
+
+def _output_format(image):
+    from PIL import features
+
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    if features.check('webp'):
+        return ('WEBP', '.webp', 'RGBA' if has_alpha else 'RGB')
+    if has_alpha:
+        return ('PNG', '.png', 'RGBA')
+    return ('JPEG', '.jpg', 'RGB')
+
+
+def normalize(upload, kind):
+    """Re-encode ``upload`` (an uploaded or stored file) within ``kind``'s budget.
+
+    Returns a NormalizedImage named after the upload; raises ImageRejected.
+    """
+    from PIL import Image, ImageOps
+
+    budget = image_budget(kind)
+    if upload.size is not None and upload.size > budget['max_bytes']:
+        raise ImageRejected(_too_large(kind))
+    if hasattr(upload, 'temporary_file_path'):
+        # Spooled to disk by the upload handler; let Pillow read the file itself
+        source = upload.temporary_file_path()
+    else:
+        upload.seek(0)
+        source = upload
+    side = budget['max_side']
+    try:
+        with Image.open(source) as image:
+            if image.width * image.height > MAX_PIXELS:
+                raise ImageRejected('The image has too many pixels.')
+            # An RGB profile still describes the output; a CMYK or grey one would not
+            icc_profile = image.info.get('icc_profile') if image.mode in ('RGB', 'RGBA') else None
+            # A JPEG decodes straight to 1/2, 1/4 or 1/8 scale when that still covers max_side
+            image.draft('RGB', (side, side))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((side, side), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            output_format, extension, mode = _output_format(image)
+            if image.mode != mode:
+                image = image.convert(mode)
+            buffer = io.BytesIO()
+            options = {'icc_profile': icc_profile} if icc_profile else {}
+            if output_format == 'WEBP':
+                options['quality'] = WEBP_QUALITY
+            elif output_format == 'JPEG':
+                options.update(quality=JPEG_QUALITY, optimize=True, progressive=True)
+            else:
+                options['optimize'] = True
+            image.save(buffer, output_format, **options)
+            width, height = image.size
+            dhash = visual.dhash(image) if kind in HASHED_KINDS else None
+    except ImageRejected:
+        raise
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError):
+        # Pillow reports unreadable and truncated files as any of these
+        raise ImageRejected('Upload a valid image. The file you uploaded was either not an image or corrupted.')
+    stem = posixpath.splitext(posixpath.basename(upload.name or 'image'))[0] or 'image'
+    return NormalizedImage(buffer.getvalue(), stem + extension, width, height, dhash)
+
+
+def record_dimensions(instance, field_name):
+    """Copy a newly assigned NormalizedImage's size to ``<field>_width`` / ``<field>_height``"""
+    fieldfile = getattr(instance, field_name)
+    if not fieldfile:
+        setattr(instance, f'{field_name}_width', None)
+        setattr(instance, f'{field_name}_height', None)
+        return
+    pending = getattr(fieldfile, '_file', None)
+    if not fieldfile._committed and isinstance(pending, NormalizedImage):
+        setattr(instance, f'{field_name}_width', pending.width)
+        setattr(instance, f'{field_name}_height', pending.height)
+
+
+class ImageBudgetUploadHandler(FileUploadHandler):
+    """Drop an image upload as soon as it passes its kind's ``max_bytes``.
+
+    Must come first in FILE_UPLOAD_HANDLERS, so the handlers that keep the
+    data never see the rest of it.
+    """
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        kind = UPLOAD_FIELDS.get(field_name)
+        self.limit = image_budget(kind)['max_bytes'] if kind else None
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.limit is not None and start + len(raw_data) > self.limit:
+            if not hasattr(self.request, '_image_upload_errors'):
+                self.request._image_upload_errors = {}
+            self.request._image_upload_errors[self.field_name] = _too_large(UPLOAD_FIELDS[self.field_name])
+            raise SkipFile()
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+def upload_errors(request):
+    """``{field name: message}`` for the image uploads of ``request`` dropped for size"""
+    # Parses the body if nothing has yet, so the handler has had its say
+    request.FILES
+    return getattr(request, '_image_upload_errors', {})
+
+
+def add_upload_errors(request, form):
+    """Report dropped image uploads on ``form``, so it doesn't validate without them"""
+    errors = upload_errors(request)
+    if errors:
+        # add_error() needs the form cleaned first
+        form.errors
+        for field_name, message in errors.items():
+            form.add_error(field_name if field_name in form.fields else None, message)
@@ -0,0 +1,164 @@
+"""
+Socket side of the loadtest_chat command, run in its own processes.
+
+It imports neither Django nor Daphne: Daphne pins txaio to Twisted, and
+autobahn's asyncio client needs it on asyncio. Several of these processes
+also spread the client work over more than one core.
+
+Protocol with the parent, one line each way at a time:
+config JSON on stdin -> ``connected <n>`` on stdout -> ``go`` on stdin ->
+result JSON on stdout.
+"""
+import asyncio
+import json
+import sys
+import time
+from collections import Counter
+
+import txaio
+from autobahn.asyncio.websocket import WebSocketClientFactory, WebSocketClientProtocol
+
+# Marks load test messages and carries the monotonic send time (CLOCK_MONOTONIC is system-wide on Linux)
+MESSAGE_PREFIX = 'loadtest '
+
+
+class ChatClient(WebSocketClientProtocol):
+    def onOpen(self):
+        self.factory.opened.set_result(self)
+
+    def onMessage(self, payload, is_binary):
+        if not is_binary:
+            self.factory.test.on_frame(self, json.loads(payload))
+
+    def onClose(self, was_clean, code, reason):
+        if not self.factory.opened.done():
+            self.factory.opened.set_exception(ConnectionError(reason or code))
+        elif not self.factory.test.stopping:
+            self.factory.test.dropped += 1
+
+
+class LoadTest:
+    def __init__(self, config):
+        self.config = config
+        self.latencies = []
+        self.saved_latencies = []
+        self.rejected = Counter()
+        self.failed = 0
+        self.dropped = 0
+        self.sent = 0
+        self.stopping = False
+
+    async def connect(self, gate, item_id, user_id, session_key, other_user_id):
+        host, port = self.config['host'], self.config['port']
+        factory = WebSocketClientFactory(
+            f'ws://{host}:{port}/ws/chat/{item_id}-{other_user_id}/',
+            origin=f'http://{host}:{port}',
+            headers={'Cookie': f'{self.config["cookie_name"]}={session_key}'},
+        )
+        factory.protocol = ChatClient
+        # An overloaded server is what we are measuring; don't give up on it early
+        factory.setProtocolOptions(openHandshakeTimeout=60, closeHandshakeTimeout=5)
+        factory.test = self
+        factory.opened = asyncio.get_running_loop().create_future()
+        async with gate:
+            try:
+                await asyncio.get_running_loop().create_connection(factory, host, port)
+                client = await asyncio.wait_for(factory.opened, timeout=30)
+            except (OSError, ConnectionError, asyncio.TimeoutError):
+                return None
+        client.user_id = user_id
+        client.pending = {}
+        return client
+
+    async def run(self, read_line):
+        gate = asyncio.Semaphore(self.config['connect_concurrency'])
+        started = time.monotonic()
+        attempts = []
+        for item_id, (a, a_session), (b, b_session) in self.config['pairs']:
+            attempts.append(self.connect(gate, item_id, a, a_session, b))
+            attempts.append(self.connect(gate, item_id, b, b_session, a))
+        results = await asyncio.gather(*attempts)
+        connect_seconds = time.monotonic() - started
+        clients = [client for client in results if client is not None]
+
+        print(f'connected {len(clients)}', flush=True)
+        await read_line()
+
+        # Evenly spaced sends, round-robin over every socket
+        interval = 1 / self.config['rate']
+        started = time.monotonic()
+        deadline = started + self.config['duration']
+        n = 0
+        while clients:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            due = started + n * interval
+            if due > now:
+                await asyncio.sleep(due - now)
+            client = clients[n % len(clients)]
+            n += 1
+            if client.state != client.STATE_OPEN:
+                continue
+            sent_at = time.monotonic()
+            client_id = f'lt{n}'
+            client.pending[client_id] = sent_at
+            client.sendMessage(json.dumps({
+                'message': f'{MESSAGE_PREFIX}{sent_at!r}',
+                'client_id': client_id,
+            }).encode())
+            self.sent += 1
+        send_seconds = time.monotonic() - started
+
+        await asyncio.sleep(self.config['drain'])
+        self.stopping = True
+        for client in clients:
+            client.sendClose()
+        await asyncio.sleep(0.5)
+        return {
+            'connected': len(clients),
+            'connect_failed': len(results) - len(clients),
+            'connect_seconds': connect_seconds,
+            'dropped': self.dropped,
+            'sent': self.sent,
+            'send_seconds': send_seconds,
+            'latencies': self.latencies,
+            'saved_latencies': self.saved_latencies,
+            'rejected': dict(self.rejected),
+            'failed': self.failed,
+        }
+
+    def on_frame(self, client, frame):
+        now = time.monotonic()
+        kind = frame.get('type')
+        if kind is None:
+            message = frame.get('message') or ''
+            # The other participant's copy measures delivery; our own echo does not
+            if frame.get('sender_id') != client.user_id and message.startswith(MESSAGE_PREFIX):
+                self.latencies.append(now - float(message[len(MESSAGE_PREFIX):]))
+        elif kind == 'saved':
+            sent_at = client.pending.pop(frame.get('client_id'), None)
+            if sent_at is not None:
+                self.saved_latencies.append(now - sent_at)
+        elif kind == 'rejected':
+            self.rejected[frame.get('reason')] += 1
+            client.pending.pop(frame.get('client_id'), None)
+        elif kind == 'error':
+            self.failed += 1
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+
+    async def read_line():
+        return await loop.run_in_executor(None, sys.stdin.readline)
+
+    # Timeouts under load are counted in the result; one log line each would flood the terminal
+    txaio.start_logging(level='critical')
+    config = json.loads(await read_line())
+    result = await LoadTest(config).run(read_line)
+    print(json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
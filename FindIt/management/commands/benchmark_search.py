@@ -0,0 +1,85 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from FindIt.models import Item, ItemCategory
+from FindIt.search import legacy_search, search_items, update_search_vector, uses_search_vector
+
+WORDS = (
+    'black', 'blue', 'red', 'leather', 'wallet', 'phone', 'keys', 'bag', 'laptop', 'charger',
+    'umbrella', 'jacket', 'library', 'cafeteria', 'gym', 'parking', 'hall', 'lecture', 'bottle',
+    'headphones', 'glasses', 'card', 'student', 'id', 'notebook', 'calculator', 'watch', 'ring',
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compare the ranked search backend against the legacy icontains filter'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queries', nargs='*', default=['black wallet', 'phone', 'library keys'])
+        parser.add_argument('--runs', type=int, default=20, help='Timed runs per query and backend')
+        parser.add_argument('--limit', type=int, default=24, help='Rows fetched per search, like one list page')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Insert this many synthetic items first (rolled back afterwards)',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                if options['seed']:
+                    self.seed(options['seed'])
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, count):
+        user, _ = User.objects.get_or_create(username='search-benchmark')
+        category, _ = ItemCategory.objects.get_or_create(name='Benchmark')
+        rng = random.Random(0)
+        items = [
+            Item(
+                title=' '.join(rng.choices(WORDS, k=3)),
+                description=' '.join(rng.choices(WORDS, k=25)),
+                location=' '.join(rng.choices(WORDS, k=2)),
+                category=category,
+                status=rng.choice(('lost', 'found')),
+                reported_by=user,
+            )
+            for _ in range(count)
+        ]
+        Item.objects.bulk_create(items, batch_size=1000)
+        # bulk_create skips post_save, so build the vectors in one pass
+        update_search_vector(Item.objects.filter(category=category))
+        self.stdout.write(f'Seeded {count} synthetic items.')
+
+    def run(self, options):
+        backend = 'tsvector + GIN' if uses_search_vector() else 'icontains fallback'
+        self.stdout.write(f'Items: {Item.objects.count()}  backend: {backend}  runs: {options["runs"]}')
+        base = Item.objects.order_by('-date_reported')
+        limit = options['limit']
+        for query in options['queries']:
+            legacy = self.time(lambda: list(legacy_search(base, query)[:limit]), options['runs'])
+            ranked = self.time(lambda: list(search_items(base, query)[:limit]), options['runs'])
+            self.stdout.write(
+                f'{query!r:>24}  legacy median {legacy:8.2f} ms  ranked median {ranked:8.2f} ms'
+                f'  speedup {legacy / ranked if ranked else 0:5.1f}x'
+            )
+
+    def time(self, func, runs):
+        func()  # warm up connection and plan cache
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            func()
+            samples.append((time.perf_counter() - start) * 1000)
+        return statistics.median(samples)
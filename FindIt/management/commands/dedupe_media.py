@@ -0,0 +1,68 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from FindIt import thumbnails
+from FindIt.models import Item, MediaBlob, Message, UserProfile
+from FindIt.storage import is_immutable, media_storage
+
+FIELDS = (
+    (Item, 'photo'),
+    (UserProfile, 'profile_picture'),
+    (Message, 'image'),
+)
+
+
+class Command(BaseCommand):
+    help = 'Move existing item photos, profile pictures and chat images to content-addressed names, sharing duplicates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only count the files that would move')
+
+    def handle(self, *args, **options):
+        storage = media_storage()
+        moved = missing = duplicates = freed = 0
+        for model, field in FIELDS:
+            rows = model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+            names = sorted({name for name in rows.values_list(field, flat=True).iterator() if not is_immutable(name)})
+            self.stdout.write(f'{model.__name__}.{field}: {len(names)} files to move')
+            if options['dry_run']:
+                continue
+            for name in names:
+                if not storage.exists(name):
+                    missing += 1
+                    self.stderr.write(f'  missing: {name}')
+                    continue
+                size = storage.size(name)
+                with transaction.atomic():
+                    referencing = rows.filter(**{field: name})
+                    count = referencing.count()
+                    with storage.open(name, 'rb') as fh:
+                        new_name = storage.save(name, fh)
+                    if count > 1:
+                        storage.add_reference(new_name, count=count - 1)
+                    referencing.update(**{field: new_name})
+                    shared = MediaBlob.objects.get(name=new_name).refs > count
+                self.move_thumbnails(storage, name, new_name)
+                # Names from before content addressing were never shared
+                storage.delete(name)
+                moved += 1
+                if shared:
+                    duplicates += 1
+                    freed += size
+        self.stdout.write(self.style.SUCCESS(
+            f'Moved {moved} files ({missing} missing); {duplicates} were duplicates, '
+            f'freeing {freed / 1024 / 1024:.1f} MB.'
+        ))
+
+    def move_thumbnails(self, storage, old_name, new_name):
+        for size in thumbnails.thumbnail_sizes():
+            old_thumb = thumbnails.thumbnail_name(old_name, size)
+            if not storage.exists(old_thumb):
+                continue
+            new_thumb = thumbnails.thumbnail_name(new_name, size)
+            if storage.exists(new_thumb):
+                os.unlink(storage.path(old_thumb))
+            else:
+                os.replace(storage.path(old_thumb), storage.path(new_thumb))
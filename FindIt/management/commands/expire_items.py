@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from FindIt.facets import invalidate_facets
+from FindIt.models import Item
+
+
+class Command(BaseCommand):
+    help = 'Mark active items older than --days as expired so they drop out of item_list'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=180, help='Age in days after which an active item expires')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many items would expire')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        stale = Item.objects.filter(state=Item.STATE_ACTIVE, date_reported__lt=cutoff)
+        if options['dry_run']:
+            self.stdout.write(f'{stale.count()} items would expire.')
+            return
+        expired = stale.update(state=Item.STATE_EXPIRED)
+        invalidate_facets()
+        self.stdout.write(self.style.SUCCESS(f'Expired {expired} items reported before {cutoff:%Y-%m-%d}.'))
@@ -0,0 +1,62 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from FindIt import thumbnails
+from FindIt.models import Item, Message, UserProfile
+
+SOURCES = {
+    'items': (Item, 'photo'),
+    'profiles': (UserProfile, 'profile_picture'),
+    'messages': (Message, 'image'),
+}
+
+
+def _make(name, force):
+    # Runs in a worker process; only storage and Pillow, no database
+    try:
+        widths, width = thumbnails.make_thumbnails(name, force=force)
+    except Exception as e:
+        return name, None, None, f'{type(e).__name__}: {e}'
+    return name, widths, width, None
+
+
+class Command(BaseCommand):
+    help = 'Make the missing thumbnails of existing item photos, profile pictures and chat images (backfill)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', choices=sorted(SOURCES), action='append', help='Limit to these images')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1, help='Processes resizing images in parallel',
+        )
+        parser.add_argument('--force', action='store_true', help='Remake thumbnails that already exist')
+
+    def handle(self, *args, **options):
+        names = set()
+        for source in options['only'] or sorted(SOURCES):
+            model, field = SOURCES[source]
+            names.update(
+                model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+                .values_list(field, flat=True).iterator(chunk_size=2000)
+            )
+        # Forked workers must not share the parent's database connections
+        connections.close_all()
+
+        done = failed = 0
+        with ProcessPoolExecutor(max_workers=max(1, options['workers']), initializer=django.setup) as pool:
+            futures = [pool.submit(_make, name, options['force']) for name in sorted(names)]
+            for future in as_completed(futures):
+                name, widths, width, error = future.result()
+                if error:
+                    failed += 1
+                    self.stderr.write(f'  {name}: {error}')
+                    continue
+                # Workers have their own (possibly process-local) cache; record here too
+                thumbnails.remember(name, widths, width)
+                done += 1
+                if done % 500 == 0:
+                    self.stdout.write(f'  {done} of {len(names)} images done...')
+        self.stdout.write(self.style.SUCCESS(f'Thumbnails up to date for {done} images, {failed} failed.'))
@@ -0,0 +1,223 @@
+import json
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from FindIt.models import Item, ItemCategory, Message
+from FindIt.ratelimit import chat_limits
+
+USER_PREFIX = 'chat-loadtest-'
+CLIENT_MODULE = 'FindIt.management.commands._chat_load_client'
+
+
+class Command(BaseCommand):
+    help = (
+        'Open many chat sockets against a local Daphne, send messages at a fixed rate '
+        'and report end-to-end delivery latency and database write rate'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8000)
+        parser.add_argument(
+            '--start-server', action='store_true',
+            help='Start Daphne on --port for the run (otherwise one must already be listening)',
+        )
+        parser.add_argument('--conversations', type=int, default=500, help='Rooms, with two sockets each')
+        parser.add_argument('--rate', type=float, default=200.0, help='Messages per second across all rooms')
+        parser.add_argument('--duration', type=float, default=30.0, help='Seconds of sending')
+        parser.add_argument(
+            '--processes', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+            help='Client processes to spread the sockets over',
+        )
+        parser.add_argument('--connect-concurrency', type=int, default=100, help='Handshakes in flight per process')
+        parser.add_argument('--drain', type=float, default=5.0, help='Seconds to wait for stragglers')
+        parser.add_argument('--keep-data', action='store_true', help='Leave the test users, items and messages')
+
+    def handle(self, *args, **options):
+        if options['conversations'] < 1 or options['rate'] <= 0 or options['duration'] <= 0:
+            raise CommandError('--conversations, --rate and --duration must be positive')
+        self.raise_fd_limit(options['conversations'] * 2 + 100)
+        self.warn_about_limits(options)
+
+        server = self.start_server(options) if options['start_server'] else None
+        self.session_keys = []
+        try:
+            pairs = self.create_fixtures(options['conversations'])
+            before = Message.objects.filter(sender__username__startswith=USER_PREFIX).count()
+            stats = self.run_clients(pairs, options)
+            written = Message.objects.filter(sender__username__startswith=USER_PREFIX).count() - before
+            self.report(stats, written, options)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait(timeout=10)
+            if not options['keep_data']:
+                store_class = import_string(f'{settings.SESSION_ENGINE}.SessionStore')
+                for session_key in self.session_keys:
+                    store_class(session_key).delete()
+                # Cascades to their items, conversations and messages
+                User.objects.filter(username__startswith=USER_PREFIX).delete()
+
+    def raise_fd_limit(self, wanted):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+            if hard < wanted:
+                self.stderr.write(f'Open file limit is {hard}; some sockets will fail to connect')
+
+    def warn_about_limits(self, options):
+        limits = chat_limits()
+        per_user = options['rate'] / (options['conversations'] * 2) * limits['user_window']
+        if per_user > limits['user_messages']:
+            self.stderr.write(self.style.WARNING(
+                f'Each user sends ~{per_user:.0f} messages per {limits["user_window"]}s, above '
+                f'CHAT_LIMITS user_messages={limits["user_messages"]}; expect rate_limited rejections. '
+                'Add conversations or lower --rate to measure delivery rather than the limiter.'
+            ))
+
+    def start_server(self, options):
+        with socket.socket() as probe:
+            if probe.connect_ex((options['host'], options['port'])) == 0:
+                raise CommandError(f'Port {options["port"]} is in use; pick another --port')
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'lost_and_found.settings')}
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'daphne', '-b', options['host'], '-p', str(options['port']),
+             'lost_and_found.asgi:application'],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError('Daphne exited during startup')
+            with socket.socket() as probe:
+                if probe.connect_ex((options['host'], options['port'])) == 0:
+                    return server
+            time.sleep(0.2)
+        server.terminate()
+        raise CommandError('Daphne did not start listening within 30 seconds')
+
+    def create_fixtures(self, count):
+        """One item and two signed-in users per conversation; returns (item id, (user id, session key) x2)"""
+        User.objects.filter(username__startswith=USER_PREFIX).delete()
+        users = User.objects.bulk_create([User(username=f'{USER_PREFIX}{n}') for n in range(count * 2)])
+        for user in users:
+            user.set_unusable_password()
+        User.objects.bulk_update(users, ['password'])
+        category, _ = ItemCategory.objects.get_or_create(name='Load test')
+        items = Item.objects.bulk_create([
+            Item(
+                title=f'Load test item {n}', description='Created by loadtest_chat', location='Nowhere',
+                category=category, status='lost', reported_by=users[n * 2],
+            )
+            for n in range(count)
+        ])
+
+        store_class = import_string(f'{settings.SESSION_ENGINE}.SessionStore')
+        sessions = {}
+        for user in users:
+            store = store_class()
+            store[SESSION_KEY] = str(user.pk)
+            store[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+            store[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            store.create()
+            sessions[user.pk] = store.session_key
+        self.session_keys = list(sessions.values())
+        return [
+            (item.pk, (a.pk, sessions[a.pk]), (b.pk, sessions[b.pk]))
+            for item, a, b in zip(items, users[0::2], users[1::2])
+        ]
+
+    def run_clients(self, pairs, options):
+        """Drive the sockets from client processes; returns their merged results"""
+        count = max(1, min(options['processes'], len(pairs)))
+        shares = [pairs[n::count] for n in range(count)]
+        clients = [
+            subprocess.Popen(
+                [sys.executable, '-m', CLIENT_MODULE],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+            )
+            for _ in shares
+        ]
+        try:
+            for client, share in zip(clients, shares):
+                client.stdin.write(json.dumps({
+                    'host': options['host'],
+                    'port': options['port'],
+                    'cookie_name': settings.SESSION_COOKIE_NAME,
+                    'pairs': share,
+                    # Each process sends its share of the rate
+                    'rate': options['rate'] * len(share) / len(pairs),
+                    'duration': options['duration'],
+                    'drain': options['drain'],
+                    'connect_concurrency': options['connect_concurrency'],
+                }) + '\n')
+                client.stdin.flush()
+            started = time.monotonic()
+            for client in clients:
+                if not client.stdout.readline().startswith('connected'):
+                    raise CommandError('A client process failed while connecting')
+            connect_seconds = time.monotonic() - started
+            # Everyone is connected: start sending together
+            for client in clients:
+                client.stdin.write('go\n')
+                client.stdin.flush()
+            results = [json.loads(client.stdout.readline()) for client in clients]
+        finally:
+            for client in clients:
+                if client.poll() is None:
+                    client.kill()
+
+        merged = {
+            'connected': 0, 'connect_failed': 0, 'dropped': 0, 'sent': 0, 'failed': 0,
+            'latencies': [], 'saved_latencies': [], 'rejected': Counter(),
+            'connect_seconds': connect_seconds,
+            'send_seconds': max(result['send_seconds'] for result in results),
+        }
+        for result in results:
+            for key in ('connected', 'connect_failed', 'dropped', 'sent', 'failed', 'latencies', 'saved_latencies'):
+                merged[key] += result[key]
+            merged['rejected'].update(result['rejected'])
+        if not merged['connected']:
+            raise CommandError(f'No socket could connect to ws://{options["host"]}:{options["port"]}/')
+        return merged
+
+    def report(self, stats, written, options):
+        elapsed = stats['send_seconds']
+        latencies = stats['latencies']
+        self.stdout.write(f'Sockets connected: {stats["connected"]} of {options["conversations"] * 2}'
+                          f' (failed: {stats["connect_failed"]}, dropped: {stats["dropped"]})')
+        self.stdout.write(f'Connect time: {stats["connect_seconds"]:.1f}s')
+        self.stdout.write(f'Messages sent: {stats["sent"]} in {elapsed:.1f}s ({stats["sent"] / elapsed:.0f}/s)')
+        self.stdout.write(f'Delivered to the other side: {len(latencies)}')
+        if stats['rejected']:
+            self.stdout.write('Rejected: ' + ', '.join(f'{reason}={n}' for reason, n in stats['rejected'].most_common()))
+        if stats['failed']:
+            self.stdout.write(f'Write failures reported: {stats["failed"]}')
+        if len(latencies) >= 2:
+            cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+            self.stdout.write(
+                'Delivery latency ms: '
+                f'p50={cuts[49] * 1000:.1f} p95={cuts[94] * 1000:.1f} p99={cuts[98] * 1000:.1f} '
+                f'max={max(latencies) * 1000:.1f}'
+            )
+        saved = stats['saved_latencies']
+        if len(saved) >= 2:
+            cuts = statistics.quantiles(saved, n=100, method='inclusive')
+            self.stdout.write(
+                'Send-to-saved latency ms: '
+                f'p50={cuts[49] * 1000:.1f} p95={cuts[94] * 1000:.1f} p99={cuts[98] * 1000:.1f}'
+            )
+        total = elapsed + options['drain']
+        self.stdout.write(f'Rows written: {written} ({written / total:.0f}/s over send + drain)')
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from FindIt.gazetteer import get_gazetteer, normalize_location
+from FindIt.models import Item
+
+
+class Command(BaseCommand):
+    help = 'Resolve every Item.location against the gazetteer and store place ids and coordinates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--show-unresolved', action='store_true', help='List locations that matched no place')
+
+    def handle(self, *args, **options):
+        get_gazetteer.cache_clear()
+        fields = ['place_id', 'latitude', 'longitude', 'grid_cell']
+        batch, resolved, unresolved = [], 0, {}
+        for item in Item.objects.only('id', 'location', *fields).iterator(chunk_size=1000):
+            if normalize_location(item):
+                resolved += 1
+            else:
+                unresolved[item.location] = unresolved.get(item.location, 0) + 1
+            batch.append(item)
+            if len(batch) >= 1000:
+                Item.objects.bulk_update(batch, fields)
+                batch = []
+        Item.objects.bulk_update(batch, fields)
+
+        total = resolved + sum(unresolved.values())
+        self.stdout.write(self.style.SUCCESS(f'Resolved {resolved} of {total} item locations.'))
+        if options['show_unresolved']:
+            for location, count in sorted(unresolved.items(), key=lambda pair: -pair[1]):
+                self.stdout.write(f'  {count:5d}  {location}')
@@ -0,0 +1,56 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from FindIt import visual
+from FindIt.models import Item
+from FindIt.storage import media_storage
+
+
+def _hash(item_id, name):
+    # Runs in a worker process; only storage and Pillow, no database
+    try:
+        return item_id, visual.hash_file(name, media_storage()), None
+    except Exception as e:
+        return item_id, None, f'{type(e).__name__}: {e}'
+
+
+class Command(BaseCommand):
+    help = 'Compute the perceptual hash of item photos that lack one, for the visual similarity index'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1, help='Processes decoding photos in parallel',
+        )
+        parser.add_argument('--force', action='store_true', help='Recompute hashes that are already stored')
+        parser.add_argument('--batch-size', type=int, default=500, help='Items updated per UPDATE statement')
+
+    def handle(self, *args, **options):
+        items = Item.objects.exclude(photo='').exclude(photo__isnull=True)
+        if not options['force']:
+            items = items.filter(photo_hash__isnull=True)
+        rows = list(items.order_by('id').values_list('id', 'photo'))
+        # Forked workers must not share the parent's database connections
+        connections.close_all()
+
+        done, failed, pending = 0, 0, []
+        with ProcessPoolExecutor(max_workers=max(1, options['workers']), initializer=django.setup) as pool:
+            futures = [pool.submit(_hash, item_id, name) for item_id, name in rows]
+            for future in as_completed(futures):
+                item_id, value, error = future.result()
+                if error:
+                    failed += 1
+                    self.stderr.write(f'  item {item_id}: {error}')
+                    continue
+                pending.append(Item(pk=item_id, photo_hash=visual.to_signed(value)))
+                if len(pending) >= options['batch_size']:
+                    done += Item.objects.bulk_update(pending, ['photo_hash'])
+                    pending = []
+                    self.stdout.write(f'  {done} of {len(rows)} photos hashed...')
+        done += Item.objects.bulk_update(pending, ['photo_hash'])
+        # bulk_update skips signals; have every process reload its index
+        visual.invalidate_index()
+        self.stdout.write(self.style.SUCCESS(f'Hashed {done} item photos, {failed} failed.'))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from FindIt.models import Item
+from FindIt.search import update_search_vector, uses_search_vector
+
+
+class Command(BaseCommand):
+    help = 'Recompute the full-text search vector for every item'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Items updated per UPDATE statement')
+
+    def handle(self, *args, **options):
+        if not uses_search_vector():
+            self.stdout.write(self.style.WARNING(
+                'This database uses the icontains search fallback; there is no index to rebuild.'
+            ))
+            return
+
+        batch_size = options['batch_size']
+        ids = list(Item.objects.order_by('id').values_list('id', flat=True))
+        updated = 0
+        for start in range(0, len(ids), batch_size):
+            updated += update_search_vector(Item.objects.filter(id__in=ids[start:start + batch_size]))
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt search vectors for {updated} items.'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from FindIt.messaging import reconcile_unread
+
+
+class Command(BaseCommand):
+    help = 'Recompute per-user and per-conversation unread counters from Message rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids', help='Only reconcile this user id')
+
+    def handle(self, *args, **options):
+        corrected = reconcile_unread(options['user_ids'])
+        if corrected:
+            self.stdout.write(self.style.WARNING(f'Corrected unread counters for {corrected} users.'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Unread counters are consistent.'))
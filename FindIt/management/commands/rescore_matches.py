@@ -0,0 +1,30 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from FindIt.matching import score_item
+from FindIt.models import Item
+
+
+class Command(BaseCommand):
+    help = 'Recompute lost/found match candidates for listed items (backfill)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='Only rescore items reported in the last N days')
+        parser.add_argument('--item', type=int, action='append', dest='item_ids', help='Rescore a specific item id')
+
+    def handle(self, *args, **options):
+        items = Item.objects.filter(state__in=Item.LISTED_STATES).order_by('id')
+        if options['item_ids']:
+            items = items.filter(id__in=options['item_ids'])
+        if options['days'] is not None:
+            items = items.filter(date_reported__gte=timezone.now() - timedelta(days=options['days']))
+
+        scored = matched = 0
+        for item in items.iterator(chunk_size=500):
+            matched += score_item(item)
+            scored += 1
+            if scored % 500 == 0:
+                self.stdout.write(f'  {scored} items scored...')
+        self.stdout.write(self.style.SUCCESS(f'Scored {scored} items, stored {matched} matches.'))
@@ -0,0 +1,187 @@
+"""
+Lost/found matching engine.
+
+Each newly reported item is scored against recent, still-listed items of the
+opposite status (lost vs found) and the best candidates are stored in the
+ItemMatch table in both directions (see score_item for how rescoring keeps
+pairs stored from the other side), so the "possible matches" panel on
+item_detail is a single indexed read. Scoring runs after the report has been
+committed, on a background worker thread, so it never delays the response.
+"""
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+from .gazetteer import haversine
+
+logger = logging.getLogger(__name__)
+
+# Relative weight of each signal in the final 0..1 score
+WEIGHTS = {
+    'category': 0.3,
+    'text': 0.4,
+    'location': 0.2,
+    'date': 0.1,
+}
+DATE_WINDOW = timedelta(days=30)
+# Distance at which two resolved locations stop counting as the same area
+LOCATION_RADIUS_METRES = 500
+MIN_SCORE = 0.25
+MAX_MATCHES = 10
+# Upper bound on rows pulled from the database per scored item
+CANDIDATE_LIMIT = 500
+
+OPPOSITE_STATUS = {'lost': 'found', 'found': 'lost'}
+STOPWORDS = frozenset(
+    'a an and at by for from i in is it my of on or the this to was with near lost found item'.split()
+)
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+_executor = None
+
+
+def tokenize(text):
+    return {token for token in TOKEN_RE.findall((text or '').lower()) if len(token) > 1 and token not in STOPWORDS}
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def location_similarity(item, candidate):
+    # Prefer gazetteer coordinates; fall back to comparing the free text
+    if item.latitude is not None and candidate.latitude is not None:
+        metres = haversine(item.latitude, item.longitude, candidate.latitude, candidate.longitude)
+        return max(0.0, 1 - metres / LOCATION_RADIUS_METRES)
+    return jaccard(tokenize(item.location), tokenize(candidate.location))
+
+
+def score_pair(item, candidate):
+    """Score how likely ``candidate`` is the counterpart of ``item`` (0..1)"""
+    category = 1.0 if item.category_id and item.category_id == candidate.category_id else 0.0
+    text = jaccard(
+        tokenize(f'{item.title} {item.description}'),
+        tokenize(f'{candidate.title} {candidate.description}'),
+    )
+    location = location_similarity(item, candidate)
+    days_apart = abs((item.date_reported - candidate.date_reported).total_seconds()) / 86400
+    date = max(0.0, 1 - days_apart / DATE_WINDOW.days)
+    return (
+        WEIGHTS['category'] * category
+        + WEIGHTS['text'] * text
+        + WEIGHTS['location'] * location
+        + WEIGHTS['date'] * date
+    )
+
+
+def candidates_for(item):
+    from .models import Item
+
+    opposite = OPPOSITE_STATUS.get(item.status)
+    if not opposite:
+        return Item.objects.none()
+    return Item.objects.filter(
+        status=opposite,
+        state__in=Item.LISTED_STATES,
+        date_reported__gte=item.date_reported - DATE_WINDOW,
+        date_reported__lte=item.date_reported + DATE_WINDOW,
+    ).exclude(reported_by_id=item.reported_by_id).order_by('-date_reported')[:CANDIDATE_LIMIT]
+
+
+def _eligible(item, candidate):
+    """Whether ``candidate`` could be ``item``'s counterpart at all (as candidates_for selects)"""
+    return (
+        candidate.status == OPPOSITE_STATUS.get(item.status)
+        and candidate.state in candidate.LISTED_STATES
+        and abs(candidate.date_reported - item.date_reported) <= DATE_WINDOW
+        and candidate.reported_by_id != item.reported_by_id
+    )
+
+
+def score_item(item):
+    """Recompute the stored pairs involving ``item``; returns the number of its top matches.
+
+    ``item``'s best MAX_MATCHES candidates are stored in both directions. Pairs
+    stored earlier, when the other side was scored, are kept with a fresh
+    score while they still reach MIN_SCORE, so rescoring one item never
+    trims another item's list. Since the pair score is symmetric, the stored
+    pairs after rescoring every item don't depend on the order.
+    """
+    from .models import Item, ItemMatch
+
+    scores = {}
+    if item.state in item.LISTED_STATES:
+        for candidate in candidates_for(item):
+            scores[candidate.pk] = score_pair(item, candidate)
+    top = sorted((pk for pk, score in scores.items() if score >= MIN_SCORE), key=lambda pk: (-scores[pk], pk))
+    top = top[:MAX_MATCHES]
+
+    linked = set(ItemMatch.objects.filter(item=item).values_list('candidate_id', flat=True))
+    linked |= set(ItemMatch.objects.filter(candidate=item).values_list('item_id', flat=True))
+    # Partners past candidates_for's row limit are scored one by one
+    unscored = linked - scores.keys()
+    if unscored and item.state in item.LISTED_STATES:
+        for candidate in Item.objects.filter(pk__in=unscored):
+            if _eligible(item, candidate):
+                scores[candidate.pk] = score_pair(item, candidate)
+    keep = set(top) | {pk for pk in linked if scores.get(pk, 0.0) >= MIN_SCORE}
+
+    rows = []
+    for pk in sorted(keep):
+        rows.append(ItemMatch(item=item, candidate_id=pk, score=scores[pk]))
+        rows.append(ItemMatch(item_id=pk, candidate=item, score=scores[pk]))
+    with transaction.atomic():
+        ItemMatch.objects.filter(item=item).exclude(candidate_id__in=keep).delete()
+        ItemMatch.objects.filter(candidate=item).exclude(item_id__in=keep).delete()
+        ItemMatch.objects.bulk_create(
+            rows, update_conflicts=True, unique_fields=['item', 'candidate'], update_fields=['score', 'scored_at'],
+        )
+    return len(top)
+
+
+def score_item_by_id(item_id):
+    from .models import Item
+
+    item = Item.objects.filter(pk=item_id).first()
+    if item is not None:
+        score_item(item)
+
+
+def _run_in_background(item_id):
+    close_old_connections()
+    try:
+        score_item_by_id(item_id)
+    except Exception:
+        logger.exception('Matching failed for item %s', item_id)
+    finally:
+        connection.close()
+
+
+def schedule_scoring(item):
+    """Score ``item`` once the current transaction commits, off the request thread.
+
+    Set ``ITEM_MATCHING_ASYNC = False`` to score inline (e.g. in tests).
+    """
+    global _executor
+    item_id = item.pk
+    if not getattr(settings, 'ITEM_MATCHING_ASYNC', True):
+        transaction.on_commit(lambda: score_item_by_id(item_id))
+        return
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='item-matching')
+    transaction.on_commit(lambda: _executor.submit(_run_in_background, item_id))
+
+
+def matches_for(item, limit=5):
+    """Best stored matches for ``item`` that are still listed"""
+    from .models import Item
+
+    return item.matches.filter(
+        candidate__state__in=Item.LISTED_STATES,
+    ).select_related('candidate', 'candidate__category').order_by('-score')[:limit]
@@ -0,0 +1,226 @@
+"""
+Serving uploaded media.
+
+django.conf.urls.static only serves MEDIA_URL with DEBUG on, and to anyone.
+serve() is the view for MEDIA_URL in every environment:
+
+- Files under PRIVATE_DIRS are only served to the people they belong to:
+  chat images to the two sides of the conversation (until they clear it),
+  return evidence to the item's reporter and owner, everything to
+  superusers. Thumbnails follow their original. Anyone else gets a 404, so
+  private names can't be probed. Other directories are public and never
+  touch the session, so shared caches can keep them.
+- Responses carry an ETag and Last-Modified from the file's size and mtime;
+  conditional requests are answered with 304 without opening the file.
+- A single byte range (with If-Range) is answered with 206.
+- Content-addressed names (storage.is_immutable) are cached for a year as
+  immutable, privately for private files. Other names are revalidated.
+- With MEDIA_SENDFILE set the front server sends the file itself once the
+  checks above have passed, instead of a Python worker streaming it:
+
+    MEDIA_SENDFILE = 'x-accel-redirect'   # nginx
+    MEDIA_SENDFILE = 'x-sendfile'         # Apache mod_xsendfile, lighttpd
+
+  nginx needs an internal location at MEDIA_ACCEL_PREFIX aliased to
+  MEDIA_ROOT, e.g.
+
+    location /protected-media/ { internal; alias /srv/findit/media/; }
+
+  and Apache needs XSendFilePath set to MEDIA_ROOT. Both handle ranges and
+  conditional requests for the handed-off file themselves.
+"""
+import mimetypes
+import os
+import posixpath
+import re
+import stat
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.db.models import Q
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+from . import thumbnails
+from .storage import is_immutable, media_storage
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+DEFAULT_ACCEL_PREFIX = '/protected-media/'
+# One range only; several are answered with the whole file, which RFC 9110 allows
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _references(queryset, fields, name):
+    """Whether a row of ``queryset`` holds ``name``, or the original of thumbnail ``name``, in ``fields``"""
+    source = thumbnails.thumbnail_source(name)
+    if source is None:
+        query = Q()
+        for field in fields:
+            query |= Q(**{field: name})
+        return queryset.filter(query).exists()
+    # The thumbnail's extension may differ from the original's
+    base = posixpath.join(*source)
+    query = Q()
+    for field in fields:
+        query |= Q(**{f'{field}__startswith': base + '.'})
+    return any(
+        posixpath.splitext(value)[0] == base
+        for row in queryset.filter(query).values_list(*fields)
+        for value in row if value
+    )
+
+
+def _can_view_chat_image(user, name):
+    from .models import Message
+
+    messages = Message.objects.filter(
+        Q(sender=user, deleted_by_sender=False) | Q(recipient=user, deleted_by_recipient=False)
+    )
+    return _references(messages, ('image',), name)
+
+
+def _can_view_return_evidence(user, name):
+    from .models import ReturnConfirmation
+
+    confirmations = ReturnConfirmation.objects.filter(Q(item__reported_by=user) | Q(item__owner=user))
+    return _references(confirmations, ('finder_photo', 'owner_photo'), name)
+
+
+# Top-level media directory -> check(user, name) for files only some users may see
+PRIVATE_DIRS = {
+    'chat_images': _can_view_chat_image,
+    'return_evidence': _can_view_return_evidence,
+}
+
+
+def is_private(name):
+    return name.split('/', 1)[0] in PRIVATE_DIRS
+
+
+def can_view(user, name):
+    check = PRIVATE_DIRS.get(name.split('/', 1)[0])
+    if check is None:
+        return True
+    if not user.is_authenticated:
+        return False
+    return user.is_superuser or check(user, name)
+
+
+def _byte_range(request, size, etag, last_modified):
+    """(first, last) byte of the range asked for, or None to send the whole file.
+
+    Raises ValueError when the range lies past the end of the file.
+    """
+    match = RANGE_RE.match(request.headers.get('Range', '').strip())
+    if not match or not size:
+        return None
+    if_range = request.headers.get('If-Range')
+    if if_range and if_range != etag and parse_http_date_safe(if_range) != last_modified:
+        # The client's partial copy is stale; it needs all of it
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # "bytes=-N": the last N bytes
+        if int(last) == 0:
+            raise ValueError(request.headers['Range'])
+        return max(size - int(last), 0), size - 1
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        raise ValueError(request.headers['Range'])
+    return first, min(int(last), size - 1) if last else size - 1
+
+
+class _FileSlice:
+    """The next ``length`` bytes of ``file``, for FileResponse to stream"""
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def _sendfile_response(name, path, content_type):
+    response = HttpResponse(content_type=content_type)
+    if settings.MEDIA_SENDFILE == 'x-accel-redirect':
+        prefix = getattr(settings, 'MEDIA_ACCEL_PREFIX', DEFAULT_ACCEL_PREFIX)
+        response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(name)
+    elif settings.MEDIA_SENDFILE == 'x-sendfile':
+        response['X-Sendfile'] = path
+    else:
+        raise ValueError(f'Unknown MEDIA_SENDFILE {settings.MEDIA_SENDFILE!r}')
+    return response
+
+
+def _file_response(request, name, path, size, etag, last_modified):
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if getattr(settings, 'MEDIA_SENDFILE', ''):
+        return _sendfile_response(name, path, content_type)
+    try:
+        byte_range = _byte_range(request, size, etag, last_modified)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+    first, last = byte_range or (0, size - 1)
+    length = last - first + 1
+    if request.method == 'HEAD':
+        response = HttpResponse(content_type=content_type, status=206 if byte_range else 200)
+    else:
+        file = open(path, 'rb')
+        if byte_range:
+            file.seek(first)
+            response = FileResponse(_FileSlice(file, length), content_type=content_type, status=206)
+        else:
+            response = FileResponse(file, content_type=content_type)
+    response['Content-Length'] = length
+    if byte_range:
+        response['Content-Range'] = f'bytes {first}-{last}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def serve(request, path):
+    """Uploaded file ``path`` under MEDIA_ROOT, if the user may see it; GET and HEAD only"""
+    # Only canonical names: the permission check goes by the first directory
+    if posixpath.normpath(path) != path or any(part.startswith('.') for part in path.split('/')):
+        raise Http404
+    if not can_view(request.user, path):
+        raise Http404
+    try:
+        full_path = media_storage().path(path)
+        info = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404
+    if not stat.S_ISREG(info.st_mode):
+        raise Http404
+
+    etag = quote_etag(f'{info.st_mtime_ns:x}-{info.st_size:x}')
+    last_modified = int(info.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = _file_response(request, path, full_path, info.st_size, etag, last_modified)
+    elif response.status_code != 304:
+        return response
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    scope = {'private': True} if is_private(path) else {'public': True}
+    if is_immutable(path):
+        patch_cache_control(response, max_age=IMMUTABLE_MAX_AGE, immutable=True, **scope)
+    else:
+        patch_cache_control(response, no_cache=True, **scope)
+    return response
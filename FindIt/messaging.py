@@ -0,0 +1,361 @@
+"""
+Message writes, conversations and unread counters.
+
+All code paths that create messages, mark them read or archive a chat (the
+inbox and send_message views, clear_conversation, ChatConsumer) go through
+this module so the denormalized state stays in step with Message:
+
+* Conversation - one row per (item, pair of users) with the last message,
+  last activity time and per-participant unread counts and archived flags
+* UserProfile.unread_messages - total unread messages for the navbar badge
+
+Counters are changed with F() expressions inside the same transaction as the
+message rows, so concurrent writers never lose an increment. The
+reconcile_unread management command recomputes them, and any missing
+Conversation rows, from Message if they ever drift. Each change is also pushed to the participants' open pages as a small
+delta event once it commits (see notifications.py).
+"""
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Q
+from django.db.models.functions import Greatest
+
+from .models import Conversation, Message, UserProfile
+from .notifications import conversation_key, message_events, send_to_users
+from .thumbnails import schedule_thumbnails
+
+# Messages per page of chat history; older pages are fetched by message id
+MESSAGE_PAGE_SIZE = 30
+
+
+def get_conversation(item, user, other_user):
+    user_a_id, user_b_id = Conversation.participants(user.pk, other_user.pk)
+    return Conversation.objects.filter(item=item, user_a_id=user_a_id, user_b_id=user_b_id).first()
+
+
+def can_chat(user, item, other_user):
+    """Whether ``user`` may talk to ``other_user`` about ``item``.
+
+    One of them has to have reported or own the item, unless they already
+    have a conversation about it.
+    """
+    if user.pk == other_user.pk or not other_user.is_active:
+        return False
+    if {item.reported_by_id, item.owner_id} & {user.pk, other_user.pk}:
+        return True
+    return get_conversation(item, user, other_user) is not None
+
+
+def conversations_for(user, archived=False):
+    """Sidebar conversations for ``user``, most recent activity first"""
+    return Conversation.objects.filter(
+        Q(user_a=user, archived_a=archived) | Q(user_b=user, archived_b=archived)
+    ).select_related(
+        'item', 'last_message', 'user_a__userprofile', 'user_b__userprofile',
+    ).order_by('-last_activity', '-id')
+
+
+def conversation_messages(user, item, other_user, include_archived=False):
+    """Messages between two users about ``item`` that ``user`` can see"""
+    messages = Message.objects.filter(
+        item=item,
+        sender__in=[user, other_user],
+        recipient__in=[user, other_user]
+    )
+    if not include_archived:
+        messages = messages.filter(
+            Q(sender=user, deleted_by_sender=False) |
+            Q(recipient=user, deleted_by_recipient=False)
+        )
+    return messages
+
+
+def message_history(messages, before_id=None, limit=MESSAGE_PAGE_SIZE):
+    """The newest ``limit`` messages older than ``before_id``, oldest first.
+
+    Returns ``(messages, has_older)``. Message ids grow with their timestamps,
+    so paging on the primary key is a bounded index range scan however long
+    the conversation is.
+    """
+    if before_id is not None:
+        messages = messages.filter(pk__lt=before_id)
+    page = list(messages.select_related('sender').order_by('-id')[:limit + 1])
+    has_older = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+    return page, has_older
+
+
+def messages_after(messages, after_id, limit=MESSAGE_PAGE_SIZE):
+    """Up to ``limit`` messages newer than ``after_id``, oldest first, plus whether more follow"""
+    page = list(messages.filter(pk__gt=after_id).select_related('sender').order_by('id')[:limit + 1])
+    return page[:limit], len(page) > limit
+
+
+def _side(user_id, user_a_id):
+    return 'a' if user_id == user_a_id else 'b'
+
+
+def _record_messages(messages):
+    """Point each conversation at its newest message and count them unread for the recipients"""
+    conversations = {}
+    for message in messages:
+        user_a_id, user_b_id = Conversation.participants(message.sender_id, message.recipient_id)
+        key = (message.item_id, user_a_id, user_b_id)
+        last, unread = conversations.get(key, (message, {'unread_a': 0, 'unread_b': 0}))
+        unread[f'unread_{_side(message.recipient_id, user_a_id)}'] += 1
+        conversations[key] = (message if message.pk > last.pk else last, unread)
+
+    for (item_id, user_a_id, user_b_id), (last, unread) in conversations.items():
+        lookup = {'item_id': item_id, 'user_a_id': user_a_id, 'user_b_id': user_b_id}
+        # A new message brings an archived conversation back for both participants
+        changes = {
+            'last_message': last,
+            'last_activity': last.timestamp,
+            'archived_a': False,
+            'archived_b': False,
+        }
+        increments = {field: F(field) + n for field, n in unread.items() if n}
+        if Conversation.objects.filter(**lookup).update(**changes, **increments):
+            continue
+        try:
+            with transaction.atomic():
+                Conversation.objects.create(**lookup, **changes, **unread)
+        except IntegrityError:
+            # Another writer created the row first; add to it instead
+            Conversation.objects.filter(**lookup).update(**changes, **increments)
+
+
+def _bump_unread(user_id, item_id, other_user_id, delta):
+    user_a_id, user_b_id = Conversation.participants(user_id, other_user_id)
+    unread = f'unread_{_side(user_id, user_a_id)}'
+    Conversation.objects.filter(item_id=item_id, user_a_id=user_a_id, user_b_id=user_b_id).update(
+        **{unread: Greatest(F(unread) + delta, 0)}
+    )
+
+
+def create_message(sender, recipient, item, content='', image=None):
+    """Create a message and record it on its conversation"""
+    with transaction.atomic():
+        message = Message.objects.create(
+            sender=sender,
+            recipient=recipient,
+            item=item,
+            content=content,
+            image=image,
+        )
+        UserProfile.objects.filter(user=recipient).update(unread_messages=F('unread_messages') + 1)
+        _record_messages([message])
+        send_to_users(message_events([message]))
+        schedule_thumbnails(message.image)
+    return message
+
+
+def create_messages(messages):
+    """Insert unsaved ``messages`` with one bulk INSERT and record them on their conversations.
+
+    A message whose (sender, client_id) is already stored is not inserted
+    again; the stored copy is returned in its place, so clients can resend
+    safely. Returns the saved messages in input order.
+    """
+    with transaction.atomic():
+        keyed = [message for message in messages if message.client_id]
+        saved = {}
+        if keyed:
+            stored = Message.objects.filter(
+                sender_id__in={message.sender_id for message in keyed},
+                client_id__in={message.client_id for message in keyed},
+            )
+            saved = {(message.sender_id, message.client_id): message for message in stored}
+
+        new = []
+        for message in messages:
+            key = (message.sender_id, message.client_id)
+            if message.client_id:
+                if key in saved:
+                    continue
+                saved[key] = message
+            new.append(message)
+        Message.objects.bulk_create(new)
+
+        per_recipient = Counter(message.recipient_id for message in new)
+        for recipient_id, n in per_recipient.items():
+            UserProfile.objects.filter(user_id=recipient_id).update(unread_messages=F('unread_messages') + n)
+        _record_messages(new)
+        send_to_users(message_events(new))
+    return [saved[(m.sender_id, m.client_id)] if m.client_id else m for m in messages]
+
+
+def mark_read(user, messages=None):
+    """Mark ``messages`` (default: everything) received by ``user`` as read"""
+    with transaction.atomic():
+        # Lock the profile row so concurrent create_message() calls queue up behind us
+        list(UserProfile.objects.select_for_update().filter(user=user).values_list('pk'))
+        unread = Message.objects.filter(recipient=user, is_read=False)
+        if messages is not None:
+            unread = unread.filter(pk__in=messages.values('pk'))
+        per_conversation = list(
+            unread.order_by().values('item_id', 'sender_id').annotate(n=Count('id'))
+        )
+        if not per_conversation:
+            return 0
+        marked = unread.update(is_read=True)
+        UserProfile.objects.filter(user=user).update(
+            unread_messages=Greatest(F('unread_messages') - marked, 0)
+        )
+        for row in per_conversation:
+            _bump_unread(user.pk, row['item_id'], row['sender_id'], -row['n'])
+        send_to_users([(user.pk, {
+            'type': 'read',
+            'conversations': [conversation_key(row['item_id'], row['sender_id']) for row in per_conversation],
+            'unread_delta': -marked,
+        })])
+    return marked
+
+
+def forget_unread(messages):
+    """Remove unread messages that are about to be deleted from the counters.
+
+    Returns ``{recipient id: unread messages removed}``.
+    """
+    rows = messages.filter(is_read=False).order_by().values('recipient_id', 'item_id', 'sender_id').annotate(
+        n=Count('id')
+    )
+    forgotten = Counter()
+    with transaction.atomic():
+        for row in rows:
+            UserProfile.objects.filter(user_id=row['recipient_id']).update(
+                unread_messages=Greatest(F('unread_messages') - row['n'], 0)
+            )
+            _bump_unread(row['recipient_id'], row['item_id'], row['sender_id'], -row['n'])
+            forgotten[row['recipient_id']] += row['n']
+    return forgotten
+
+
+def delete_conversation(item, user, other_user):
+    """Permanently delete every message between two users about ``item``"""
+    with transaction.atomic():
+        conversation_messages = Message.objects.filter(
+            item=item,
+            sender__in=[user, other_user],
+            recipient__in=[user, other_user]
+        )
+        forgotten = forget_unread(conversation_messages)
+        deleted_count, _ = conversation_messages.delete()
+        user_a_id, user_b_id = Conversation.participants(user.pk, other_user.pk)
+        Conversation.objects.filter(item=item, user_a_id=user_a_id, user_b_id=user_b_id).delete()
+        send_to_users([
+            (participant.pk, {
+                'type': 'deleted',
+                'conversation_id': conversation_key(item.pk, other.pk),
+                'unread_delta': -forgotten[participant.pk],
+            })
+            for participant, other in ((user, other_user), (other_user, user))
+        ])
+    return deleted_count
+
+
+def set_archived(item, user, other_user, archived):
+    """Archive or restore a conversation for ``user`` only; returns messages affected"""
+    with transaction.atomic():
+        sender_count = Message.objects.filter(
+            item=item, sender=user, recipient=other_user,
+        ).update(deleted_by_sender=archived)
+        recipient_count = Message.objects.filter(
+            item=item, sender=other_user, recipient=user,
+        ).update(deleted_by_recipient=archived)
+        user_a_id, user_b_id = Conversation.participants(user.pk, other_user.pk)
+        Conversation.objects.filter(item=item, user_a_id=user_a_id, user_b_id=user_b_id).update(
+            **{f'archived_{_side(user.pk, user_a_id)}': archived}
+        )
+        send_to_users([(user.pk, {
+            'type': 'archived',
+            'conversation_id': conversation_key(item.pk, other_user.pk),
+            'archived': archived,
+        })])
+    return sender_count + recipient_count
+
+
+def unread_count(user):
+    """Total unread messages for ``user`` from the maintained counter"""
+    return UserProfile.objects.filter(user=user).values_list('unread_messages', flat=True).first() or 0
+
+
+def _restore_conversations(user_id):
+    """Create the missing Conversation rows of ``user_id`` from its Message groups; returns how many.
+
+    Archived flags and the last message follow the 0013 backfill: a side is
+    archived when none of the conversation is still visible to it. Unread
+    counts start at zero for reconcile_unread to fill in.
+    """
+    existing = {
+        (item_id, user_a_id, user_b_id)
+        for item_id, user_a_id, user_b_id in Conversation.objects.filter(
+            Q(user_a_id=user_id) | Q(user_b_id=user_id)
+        ).values_list('item_id', 'user_a_id', 'user_b_id')
+    }
+    groups = Message.objects.filter(Q(sender_id=user_id) | Q(recipient_id=user_id)).order_by().values(
+        'item_id', 'sender_id', 'recipient_id',
+    ).annotate(
+        last_id=Max('id'),
+        kept_by_sender=Count('id', filter=Q(deleted_by_sender=False)),
+        kept_by_recipient=Count('id', filter=Q(deleted_by_recipient=False)),
+    )
+    missing = {}
+    for group in groups:
+        user_a_id, user_b_id = Conversation.participants(group['sender_id'], group['recipient_id'])
+        key = (group['item_id'], user_a_id, user_b_id)
+        if key in existing:
+            continue
+        conversation = missing.setdefault(key, Conversation(
+            item_id=group['item_id'], user_a_id=user_a_id, user_b_id=user_b_id,
+            archived_a=True, archived_b=True,
+        ))
+        conversation.last_message_id = max(conversation.last_message_id or 0, group['last_id'])
+        if group['kept_by_sender']:
+            setattr(conversation, f'archived_{_side(group["sender_id"], user_a_id)}', False)
+        if group['kept_by_recipient']:
+            setattr(conversation, f'archived_{_side(group["recipient_id"], user_a_id)}', False)
+    if not missing:
+        return 0
+    timestamps = dict(Message.objects.filter(
+        pk__in=[conversation.last_message_id for conversation in missing.values()]
+    ).values_list('pk', 'timestamp'))
+    for conversation in missing.values():
+        conversation.last_activity = timestamps[conversation.last_message_id]
+    Conversation.objects.bulk_create(missing.values(), ignore_conflicts=True)
+    return len(missing)
+
+
+def reconcile_unread(user_ids=None):
+    """Recompute counters and lost Conversation rows from Message; returns the number of users corrected"""
+    profiles = UserProfile.objects.all()
+    if user_ids is not None:
+        profiles = profiles.filter(user_id__in=user_ids)
+
+    corrected = 0
+    for profile in profiles.iterator(chunk_size=500):
+        user_id = profile.user_id
+        with transaction.atomic():
+            UserProfile.objects.select_for_update().filter(pk=profile.pk).first()
+            rows = Message.objects.filter(recipient_id=user_id, is_read=False).order_by().values(
+                'item_id', 'sender_id',
+            ).annotate(n=Count('id'))
+            actual = {(row['item_id'], row['sender_id']): row['n'] for row in rows}
+            total = sum(actual.values())
+
+            drifted = profile.unread_messages != total
+            if _restore_conversations(user_id):
+                drifted = True
+            for conversation in Conversation.objects.filter(Q(user_a_id=user_id) | Q(user_b_id=user_id)):
+                side = _side(user_id, conversation.user_a_id)
+                other_user_id = conversation.user_b_id if side == 'a' else conversation.user_a_id
+                expected = actual.get((conversation.item_id, other_user_id), 0)
+                if getattr(conversation, f'unread_{side}') != expected:
+                    Conversation.objects.filter(pk=conversation.pk).update(**{f'unread_{side}': expected})
+                    drifted = True
+            if drifted:
+                UserProfile.objects.filter(pk=profile.pk).update(unread_messages=total)
+                corrected += 1
+    return corrected
@@ -0,0 +1,144 @@
+"""
+In-process metrics for the chat sockets, in the Prometheus text format.
+
+Consumers and the write-behind writer update the metrics below as they go;
+the ``metrics`` view renders them for a scraper. Updating a metric is a dict
+lookup and an add under a lock, cheap enough for every frame, and rendering
+walks a few dozen numbers, so scraping often costs nothing noticeable.
+
+Every process keeps its own numbers. Scrape each ASGI worker (the endpoint
+is served by the same process as its sockets) and aggregate in Prometheus,
+which is what counters and cumulative histogram buckets are made for.
+"""
+import threading
+
+_lock = threading.Lock()
+_registry = []
+
+# Seconds; latency of a batch insert or a group_send rarely leaves this range
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, _label_text(self.label_names, key), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{name}{labels} {_number(value)}' for name, labels, value in self.samples()]
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, then the sum
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    def samples(self):
+        for key, counts in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _label_text(self.label_names + ('le',), key + (_number(bound),))
+                yield f'{self.name}_bucket', labels, cumulative
+            labels = _label_text(self.label_names, key)
+            yield f'{self.name}_count', labels, cumulative
+            yield f'{self.name}_sum', labels, counts[-1]
+
+
+def render():
+    """Every metric in the Prometheus text exposition format"""
+    with _lock:
+        lines = [line for metric in _registry for line in metric.render()]
+    return '\n'.join(lines) + '\n'
+
+
+connections = Gauge(
+    'findit_ws_connections', 'Open WebSocket connections', labels=('consumer',),
+)
+frames = Counter(
+    'findit_ws_frames_received_total', 'Frames received from chat sockets', labels=('kind',),
+)
+rejected_frames = Counter(
+    'findit_ws_frames_rejected_total', 'Chat frames refused, by reason', labels=('reason',),
+)
+messages = Counter(
+    'findit_chat_messages_total', 'Chat messages broadcast', labels=('kind',),
+)
+fan_out_seconds = Histogram(
+    'findit_chat_group_send_seconds', 'Time to hand a chat message to the channel layer for its room',
+)
+save_batch_seconds = Histogram(
+    'findit_chat_save_batch_seconds', 'Time to insert one batch of chat messages',
+)
+save_latency_seconds = Histogram(
+    'findit_chat_save_latency_seconds', 'Time from a chat message arriving to its batch committing',
+)
+save_failures = Counter(
+    'findit_chat_save_failures_total', 'Chat messages that could not be stored',
+)
@@ -0,0 +1,40 @@
+import django.contrib.postgres.search
+from django.db import migrations
+
+INDEX_NAME = 'findit_item_search_vector_gin'
+
+
+def create_search_index(apps, schema_editor):
+    # GIN indexes and to_tsvector() only exist on PostgreSQL; other backends
+    # use the icontains fallback in FindIt.search and need neither.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    from FindIt.search import item_search_vector
+
+    Item = apps.get_model('FindIt', 'Item')
+    schema_editor.execute(
+        f'CREATE INDEX IF NOT EXISTS {INDEX_NAME} ON "{Item._meta.db_table}" USING GIN ("search_vector")'
+    )
+    Item.objects.update(search_vector=item_search_vector())
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f'DROP INDEX IF EXISTS {INDEX_NAME}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FindIt', '0006_userprofile_reputation_score_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:32
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FindIt', '0007_item_search_vector'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['-date_reported', '-id'], name='item_date_reported_id_idx'),
+        ),
+    ]
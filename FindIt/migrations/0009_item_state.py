@@ -0,0 +1,32 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:32
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_item_state(apps, schema_editor):
+    Item = apps.get_model('FindIt', 'Item')
+    RecoveredItem = apps.get_model('FindIt', 'RecoveredItem')
+    Item.objects.filter(is_returned=True).update(state='pending_return')
+    Item.objects.filter(id__in=RecoveredItem.objects.values('item_id')).update(state='recovered')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FindIt', '0008_item_date_reported_id_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='state',
+            field=models.CharField(choices=[('active', 'Active'), ('pending_return', 'Pending return'), ('recovered', 'Recovered'), ('expired', 'Expired')], db_index=True, default='active', max_length=20),
+        ),
+        migrations.RunPython(backfill_item_state, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(condition=models.Q(('state__in', ['active', 'pending_return'])), fields=['-date_reported', '-id'], name='item_listed_date_idx'),
+        ),
+    ]
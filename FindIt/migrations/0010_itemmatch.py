@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FindIt', '0009_item_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemMatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('scored_at', models.DateTimeField(auto_now=True)),
+                ('candidate', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='FindIt.item')),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matches', to='FindIt.item')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['item', '-score'], name='itemmatch_item_score_idx')],
+                'unique_together': {('item', 'candidate')},
+            },
+        ),
+    ]
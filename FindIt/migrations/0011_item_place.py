@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FindIt', '0010_itemmatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='grid_cell',
+            field=models.CharField(blank=True, db_index=True, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='place_id',
+            field=models.CharField(blank=True, db_index=True, max_length=50),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:37
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_unread_counters(apps, schema_editor):
+    Message = apps.get_model('FindIt', 'Message')
+    UserProfile = apps.get_model('FindIt', 'UserProfile')
+    ConversationUnread = apps.get_model('FindIt', 'ConversationUnread')
+
+    rows = Message.objects.filter(is_read=False).order_by().values(
+        'recipient_id', 'item_id', 'sender_id',
+    ).annotate(n=Count('id'))
+    totals = {}
+    counters = []
+    for row in rows:
+        totals[row['recipient_id']] = totals.get(row['recipient_id'], 0) + row['n']
+        counters.append(ConversationUnread(
+            user_id=row['recipient_id'], item_id=row['item_id'], other_user_id=row['sender_id'], count=row['n'],
+        ))
+    ConversationUnread.objects.bulk_create(counters, batch_size=1000)
+    for user_id, total in totals.items():
+        UserProfile.objects.filter(user_id=user_id).update(unread_messages=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FindIt', '0011_item_place'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='unread_messages',
+            field=models.IntegerField(default=0, help_text='Unread messages received'),
+        ),
+        migrations.CreateModel(
+            name='ConversationUnread',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='FindIt.item')),
+                ('other_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_unreads', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'item', 'other_user')},
+            },
+        ),
+        migrations.RunPython(backfill_unread_counters, migrations.RunPython.noop),
+    ]
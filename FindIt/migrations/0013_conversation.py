@@ -0,0 +1,82 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:38
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def build_conversations(apps, schema_editor):
+    Message = apps.get_model('FindIt', 'Message')
+    Conversation = apps.get_model('FindIt', 'Conversation')
+
+    conversations = {}
+    rows = Message.objects.order_by('timestamp', 'id').values_list(
+        'id', 'item_id', 'sender_id', 'recipient_id', 'timestamp', 'is_read',
+        'deleted_by_sender', 'deleted_by_recipient',
+    )
+    for (message_id, item_id, sender_id, recipient_id, timestamp, is_read,
+         deleted_by_sender, deleted_by_recipient) in rows.iterator(chunk_size=2000):
+        user_a_id, user_b_id = sorted((sender_id, recipient_id))
+        key = (item_id, user_a_id, user_b_id)
+        convo = conversations.get(key)
+        if convo is None:
+            convo = conversations[key] = Conversation(
+                item_id=item_id, user_a_id=user_a_id, user_b_id=user_b_id,
+                # Archived until a message proves otherwise
+                archived_a=True, archived_b=True,
+            )
+        convo.last_message_id = message_id
+        convo.last_activity = timestamp
+        recipient_side = 'a' if recipient_id == user_a_id else 'b'
+        sender_side = 'a' if sender_id == user_a_id else 'b'
+        if not is_read:
+            setattr(convo, f'unread_{recipient_side}', getattr(convo, f'unread_{recipient_side}') + 1)
+        # A participant has archived the conversation if none of it is still visible to them
+        if not deleted_by_sender:
+            setattr(convo, f'archived_{sender_side}', False)
+        if not deleted_by_recipient:
+            setattr(convo, f'archived_{recipient_side}', False)
+    Conversation.objects.bulk_create(conversations.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FindIt', '0012_unread_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_activity', models.DateTimeField(default=django.utils.timezone.now)),
+                ('unread_a', models.IntegerField(default=0)),
+                ('unread_b', models.IntegerField(default=0)),
+                ('archived_a', models.BooleanField(default=False)),
+                ('archived_b', models.BooleanField(default=False)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations', to='FindIt.item')),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='FindIt.message')),
+                ('user_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.DeleteModel(
+            name='ConversationUnread',
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_a', 'archived_a', '-last_activity', '-id'], name='convo_user_a_activity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_b', 'archived_b', '-last_activity', '-id'], name='convo_user_b_activity_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='conversation',
+            unique_together={('item', 'user_a', 'user_b')},
+        ),
+        migrations.RunPython(build_conversations, migrations.RunPython.noop),
+    ]
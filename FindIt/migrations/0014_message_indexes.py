@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:41
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FindIt', '0013_conversation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['item', 'sender', 'recipient', '-id'], name='message_convo_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['recipient', 'item', 'sender'], name='message_unread_idx'),
+        ),
+    ]
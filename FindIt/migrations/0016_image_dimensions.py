@@ -0,0 +1,43 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FindIt', '0015_message_client_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='photo_height',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='photo_width',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='image_height',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='image_width',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='profile_picture_height',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='profile_picture_width',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
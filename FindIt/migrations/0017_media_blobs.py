@@ -0,0 +1,39 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:28
+
+import FindIt.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FindIt', '0016_image_dimensions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('refs', models.PositiveIntegerField(default=0)),
+                ('size', models.PositiveBigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='photo',
+            field=models.ImageField(blank=True, null=True, storage=FindIt.storage.media_storage, upload_to='item_photos/'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=FindIt.storage.media_storage, upload_to='chat_images/'),
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='profile_picture',
+            field=models.ImageField(blank=True, null=True, storage=FindIt.storage.media_storage, upload_to='profile_pics/'),
+        ),
+    ]
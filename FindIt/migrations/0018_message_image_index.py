@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:32
+
+import FindIt.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FindIt', '0017_media_blobs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='image',
+            field=models.ImageField(blank=True, db_index=True, null=True, storage=FindIt.storage.media_storage, upload_to='chat_images/'),
+        ),
+    ]
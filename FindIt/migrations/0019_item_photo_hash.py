@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FindIt', '0018_message_image_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='photo_hash',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
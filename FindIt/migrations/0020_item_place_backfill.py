@@ -0,0 +1,36 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:44
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_item_places(apps, schema_editor):
+    # 0011 added the place columns empty; resolve the items reported before it
+    from FindIt.gazetteer import normalize_location
+
+    Item = apps.get_model('FindIt', 'Item')
+    fields = ['place_id', 'latitude', 'longitude', 'grid_cell']
+    batch = []
+    for item in Item.objects.filter(place_id='').only('id', 'location', *fields).iterator(chunk_size=1000):
+        if normalize_location(item):
+            batch.append(item)
+        if len(batch) >= 1000:
+            Item.objects.bulk_update(batch, fields)
+            batch = []
+    Item.objects.bulk_update(batch, fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FindIt', '0019_item_photo_hash'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_item_places, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['latitude', 'longitude'], name='item_lat_lng_idx'),
+        ),
+    ]
@@ -1,10 +1,13 @@
 # Store account deletion feedback
  # Force migration detection
 from django.utils import timezone
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.contrib.postgres.search import SearchVectorField
+from django.db.models.signals import post_delete, post_init, post_save, pre_save
 from django.dispatch import receiver
+
+from .storage import ReleaseOnFailedSave, media_storage
 class AccountDeletionFeedback(models.Model):
 	username = models.CharField(max_length=150)
 	email = models.EmailField()
@@ -14,13 +17,16 @@ class AccountDeletionFeedback(models.Model):
 
 
 
-class UserProfile(models.Model):
+class UserProfile(ReleaseOnFailedSave, models.Model):
 	address = models.CharField(max_length=255, blank=True, null=True)
 	bio = models.TextField(blank=True, null=True)
 	social_links = models.URLField(blank=True, null=True)
 	user = models.OneToOneField(User, on_delete=models.CASCADE)
 	contact_number = models.CharField(max_length=20)
-	profile_picture = models.ImageField(upload_to='profile_pics/', blank=True, null=True)
+	profile_picture = models.ImageField(upload_to='profile_pics/', storage=media_storage, blank=True, null=True)
+	# Stored size of profile_picture, set at upload (see ingest.py)
+	profile_picture_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+	profile_picture_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
 	notify_email = models.BooleanField(default=True)
 	notify_sms = models.BooleanField(default=False)
 	PROFILE_VISIBILITY_CHOICES = [
@@ -41,6 +47,9 @@ class UserProfile(models.Model):
 	total_returns = models.IntegerField(default=0, help_text='Total items returned to owners')
 	total_ratings = models.IntegerField(default=0, help_text='Total ratings received')
 
+	# Maintained by FindIt.messaging; see reconcile_unread for drift repair
+	unread_messages = models.IntegerField(default=0, help_text='Unread messages received')
+
 	def __str__(self):
 		return f"{self.user.username} Profile"
 	
@@ -101,41 +110,249 @@ class ItemCategory(models.Model):
 	def __str__(self):
 		return self.name
 
-class Item(models.Model):
+class Item(ReleaseOnFailedSave, models.Model):
 	STATUS_CHOICES = [
 		('lost', 'Lost'),
 		('found', 'Found'),
 	]
+	STATE_ACTIVE = 'active'
+	STATE_PENDING_RETURN = 'pending_return'
+	STATE_RECOVERED = 'recovered'
+	STATE_EXPIRED = 'expired'
+	STATE_CHOICES = [
+		(STATE_ACTIVE, 'Active'),
+		(STATE_PENDING_RETURN, 'Pending return'),
+		(STATE_RECOVERED, 'Recovered'),
+		(STATE_EXPIRED, 'Expired'),
+	]
+	# States that still show up in item_list
+	LISTED_STATES = (STATE_ACTIVE, STATE_PENDING_RETURN)
 	title = models.CharField(max_length=100)
 	description = models.TextField()
 	category = models.ForeignKey(ItemCategory, on_delete=models.SET_NULL, null=True)
 	location = models.CharField(max_length=100)
-	photo = models.ImageField(upload_to='item_photos/', blank=True, null=True)
+	# Normalized from location against the gazetteer (see gazetteer.py)
+	place_id = models.CharField(max_length=50, blank=True, db_index=True)
+	latitude = models.FloatField(null=True, blank=True)
+	longitude = models.FloatField(null=True, blank=True)
+	grid_cell = models.CharField(max_length=32, blank=True, db_index=True)
+	photo = models.ImageField(upload_to='item_photos/', storage=media_storage, blank=True, null=True)
+	# Stored size of photo, set at upload (see ingest.py)
+	photo_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+	photo_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+	# 64-bit dHash of photo, stored signed, for the visual similarity index (see visual.py)
+	photo_hash = models.BigIntegerField(null=True, blank=True, editable=False)
 	status = models.CharField(max_length=5, choices=STATUS_CHOICES)
 	date_reported = models.DateTimeField(auto_now_add=True)
 	reported_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='items_reported')
 	owner = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='items_owned')
 	is_returned = models.BooleanField(default=False)
+	# Lifecycle state, kept in sync with is_returned and RecoveredItem
+	state = models.CharField(max_length=20, choices=STATE_CHOICES, default=STATE_ACTIVE, db_index=True)
+	# Maintained by update_item_search_vector below; GIN-indexed on PostgreSQL
+	search_vector = SearchVectorField(null=True, blank=True, editable=False)
+
+	class Meta:
+		indexes = [
+			# Keyset pagination of item_list walks this index (see pagination.py)
+			models.Index(fields=['-date_reported', '-id'], name='item_date_reported_id_idx'),
+			# The same ordering restricted to live rows, used by the item_list hot path
+			models.Index(
+				fields=['-date_reported', '-id'],
+				name='item_listed_date_idx',
+				condition=models.Q(state__in=['active', 'pending_return']),
+			),
+			# Radius searches too wide for the grid cells (see gazetteer.py)
+			models.Index(fields=['latitude', 'longitude'], name='item_lat_lng_idx'),
+		]
 
 	def __str__(self):
 		return f"{self.title} ({self.get_status_display()})"
+
+	def sync_returned_state(self):
+		"""Derive the lifecycle state from is_returned; recovered items stay recovered"""
+		if self.state != self.STATE_RECOVERED:
+			self.state = self.STATE_PENDING_RETURN if self.is_returned else self.STATE_ACTIVE
+
+@receiver(pre_save, sender=Item)
+def normalize_item_location(sender, instance, **kwargs):
+	from .gazetteer import normalize_changed_location
+	normalize_changed_location(instance)
+
+@receiver(post_init, sender=Item)
+def remember_item_search_fields(sender, instance, **kwargs):
+	from .search import remember_indexed_values
+	remember_indexed_values(instance)
+
+@receiver(post_init, sender=Item)
+def remember_item_location(sender, instance, **kwargs):
+	from .gazetteer import remember_location
+	remember_location(instance)
+
+@receiver(post_save, sender=Item)
+def update_item_location_snapshot(sender, instance, **kwargs):
+	from .gazetteer import remember_location
+	remember_location(instance)
+
+@receiver(post_save, sender=Item)
+def update_item_search_vector(sender, instance, created, **kwargs):
+	from .search import refresh_search_vector
+	refresh_search_vector(instance, created)
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def invalidate_item_facets(sender, **kwargs):
+	from .facets import invalidate_facets
+	# After commit: a worker reading before it would cache the old counts again
+	transaction.on_commit(invalidate_facets)
+
+@receiver(post_save, sender=ItemCategory)
+@receiver(post_delete, sender=ItemCategory)
+def invalidate_category_registry(sender, **kwargs):
+	from .facets import invalidate_categories
+	# After commit: a worker seeing the new version first would cache the old rows under it
+	transaction.on_commit(invalidate_categories)
+
+@receiver(post_save, sender=ItemCategory)
+def update_category_search_vectors(sender, instance, created, **kwargs):
+	if not created:
+		from .search import update_search_vector
+		update_search_vector(Item.objects.filter(category=instance))
 # Trigger migration recreation
 
 
-class Message(models.Model):
+# Precomputed lost/found match candidates, written by FindIt.matching
+class ItemMatch(models.Model):
+	item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='matches')
+	candidate = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='+')
+	score = models.FloatField()
+	scored_at = models.DateTimeField(auto_now=True)
+
+	class Meta:
+		unique_together = ('item', 'candidate')
+		indexes = [
+			models.Index(fields=['item', '-score'], name='itemmatch_item_score_idx'),
+		]
+
+	def __str__(self):
+		return f"{self.item.title} ~ {self.candidate.title} ({self.score:.2f})"
+
+
+class Message(ReleaseOnFailedSave, models.Model):
 	sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
 	recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
 	item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='messages')
 	content = models.TextField(blank=True)
-	image = models.ImageField(upload_to='chat_images/', blank=True, null=True)
+	# Indexed: serving a chat image looks up the messages holding it (see media.py)
+	image = models.ImageField(upload_to='chat_images/', storage=media_storage, blank=True, null=True, db_index=True)
+	# Stored size of image, set at upload (see ingest.py)
+	image_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+	image_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
 	timestamp = models.DateTimeField(auto_now_add=True)
 	is_read = models.BooleanField(default=False)
 	deleted_by_sender = models.BooleanField(default=False)
 	deleted_by_recipient = models.BooleanField(default=False)
+	# Id the sending client gave the message; makes resends idempotent (see writebehind.py)
+	client_id = models.CharField(max_length=64, blank=True, default='')
+
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(
+				fields=['sender', 'client_id'],
+				name='message_sender_client_id_uniq',
+				condition=~models.Q(client_id=''),
+			),
+		]
+		indexes = [
+			# One conversation (item + both participants), newest first: chat history
+			# pages, archive and delete in FindIt.messaging
+			models.Index(fields=['item', 'sender', 'recipient', '-id'], name='message_convo_idx'),
+			# Only unread rows: mark_read, forget_unread and reconcile_unread
+			models.Index(
+				fields=['recipient', 'item', 'sender'],
+				name='message_unread_idx',
+				condition=models.Q(is_read=False),
+			),
+		]
 
 	def __str__(self):
 		return f"From {self.sender.username} to {self.recipient.username} about {self.item.title}"
 
+# Image field of each model whose stored dimensions are kept in columns.
+# bulk_create skips signals; writebehind.py sets Message's itself.
+IMAGE_DIMENSION_FIELDS = {
+	Item: 'photo',
+	UserProfile: 'profile_picture',
+	Message: 'image',
+}
+
+@receiver(pre_save, sender=Item)
+@receiver(pre_save, sender=UserProfile)
+@receiver(pre_save, sender=Message)
+def record_image_dimensions(sender, instance, **kwargs):
+	from .ingest import record_dimensions
+	record_dimensions(instance, IMAGE_DIMENSION_FIELDS[sender])
+
+@receiver(pre_save, sender=Item)
+def record_item_photo_hash(sender, instance, **kwargs):
+	from .visual import record_photo_hash
+	record_photo_hash(instance)
+
+@receiver(post_delete, sender=Item)
+@receiver(post_delete, sender=UserProfile)
+@receiver(post_delete, sender=Message)
+def release_image_file(sender, instance, **kwargs):
+	from .storage import release
+	release(getattr(instance, IMAGE_DIMENSION_FIELDS[sender]))
+
+# A file in media storage (see storage.py) and the number of rows pointing at it
+class MediaBlob(models.Model):
+	name = models.CharField(max_length=255, unique=True)
+	refs = models.PositiveIntegerField(default=0)
+	size = models.PositiveBigIntegerField(default=0)
+	created_at = models.DateTimeField(auto_now_add=True)
+
+	def __str__(self):
+		return f"{self.name} ({self.refs} refs)"
+
+# One row per (item, pair of users), maintained by FindIt.messaging on every
+# message write so the inbox sidebar never has to scan Message.
+# user_a is always the participant with the lower user id.
+class Conversation(models.Model):
+	item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='conversations')
+	user_a = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+	user_b = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+	last_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+	last_activity = models.DateTimeField(default=timezone.now)
+	unread_a = models.IntegerField(default=0)
+	unread_b = models.IntegerField(default=0)
+	archived_a = models.BooleanField(default=False)
+	archived_b = models.BooleanField(default=False)
+
+	class Meta:
+		unique_together = ('item', 'user_a', 'user_b')
+		indexes = [
+			models.Index(fields=['user_a', 'archived_a', '-last_activity', '-id'], name='convo_user_a_activity_idx'),
+			models.Index(fields=['user_b', 'archived_b', '-last_activity', '-id'], name='convo_user_b_activity_idx'),
+		]
+
+	def __str__(self):
+		return f"{self.user_a.username} & {self.user_b.username} about {self.item.title}"
+
+	@staticmethod
+	def participants(user_id, other_user_id):
+		"""(user_a_id, user_b_id) for a pair of users"""
+		return (user_id, other_user_id) if user_id <= other_user_id else (other_user_id, user_id)
+
+	def side(self, user):
+		return 'a' if user.pk == self.user_a_id else 'b'
+
+	def other_user(self, user):
+		return self.user_b if self.side(user) == 'a' else self.user_a
+
+	def unread_for(self, user):
+		return getattr(self, f'unread_{self.side(user)}')
+
 # Return confirmation model
 class ReturnConfirmation(models.Model):
 	item = models.OneToOneField('Item', on_delete=models.CASCADE, related_name='return_confirmation')
@@ -178,3 +395,18 @@ class RecoveredItem(models.Model):
 	
 	def __str__(self):
 		return f"{self.item.title} - Returned by {self.finder.username} to {self.owner.username}"
+
+@receiver(post_save, sender=RecoveredItem)
+def mark_item_recovered(sender, instance, created, **kwargs):
+	if created:
+		from .facets import invalidate_facets
+		instance.item.state = Item.STATE_RECOVERED
+		Item.objects.filter(pk=instance.item_id).update(state=Item.STATE_RECOVERED)
+		transaction.on_commit(invalidate_facets)
+
+@receiver(post_delete, sender=RecoveredItem)
+def unmark_item_recovered(sender, instance, **kwargs):
+	state = Item.STATE_PENDING_RETURN if instance.item.is_returned else Item.STATE_ACTIVE
+	Item.objects.filter(pk=instance.item_id, state=Item.STATE_RECOVERED).update(state=state)
+	from .facets import invalidate_facets
+	transaction.on_commit(invalidate_facets)
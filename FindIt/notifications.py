@@ -0,0 +1,109 @@
+"""
+Per-user notification events.
+
+Every signed-in page keeps one socket on ws/notify/ (NotificationConsumer)
+joined to the group ``notify_<user id>``, so one group_send reaches all of a
+user's open tabs. FindIt.messaging sends compact deltas once the change has
+committed; conversations are keyed "<item id>-<other user id>" as in the
+inbox sidebar:
+
+* message  - new message in a conversation: preview, time, and how much the
+  conversation's unread count went up for this user
+* read     - conversations whose unread messages the user just read
+* archived - a conversation archived or restored by this user
+* deleted  - a conversation deleted by either participant
+
+A socket starts with a ``sync`` event carrying the absolute unread total, so
+deltas missed while a tab was disconnected never leave the badge wrong.
+"""
+import logging
+from functools import partial
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_LENGTH = 80
+
+
+def user_group(user_id):
+    return f'notify_{user_id}'
+
+
+def conversation_key(item_id, other_user_id):
+    return f'{item_id}-{other_user_id}'
+
+
+def send_to_users(events):
+    """Send ``(user_id, event)`` pairs to the users' sockets once the transaction commits"""
+    if events:
+        transaction.on_commit(partial(_send, list(events)))
+
+
+async def _group_send_all(channel_layer, events):
+    for user_id, event in events:
+        await channel_layer.group_send(user_group(user_id), {'type': 'notify', 'event': event})
+
+
+def _send(events):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        async_to_sync(_group_send_all)(channel_layer, events)
+    except Exception:
+        logger.exception('Could not send %d notifications', len(events))
+
+
+def _display_name(user):
+    return user.get_full_name() or user.username
+
+
+def message_events(messages):
+    """``message`` events for the sender and recipient of each saved message"""
+    from django.contrib.auth.models import User
+    from .models import Item, Message
+
+    # Use related objects already loaded by the caller; fetch the rest in one query each
+    users, items = {}, {}
+    for message in messages:
+        for field in ('sender', 'recipient'):
+            if Message._meta.get_field(field).is_cached(message):
+                user = getattr(message, field)
+                users[user.pk] = user
+        if Message._meta.get_field('item').is_cached(message):
+            items[message.item_id] = message.item
+    user_ids = {m.sender_id for m in messages} | {m.recipient_id for m in messages}
+    users.update(User.objects.only('username', 'first_name', 'last_name').in_bulk(user_ids - users.keys()))
+    items.update(Item.objects.only('title').in_bulk({m.item_id for m in messages} - items.keys()))
+
+    events = []
+    for message in messages:
+        if message.item_id not in items:
+            # The item is gone; the insert will fail and nothing is announced
+            continue
+        common = {
+            'type': 'message',
+            'item_id': message.item_id,
+            'item_title': items[message.item_id].title,
+            'message_id': message.pk,
+            'sender_id': message.sender_id,
+            'preview': message.content[:PREVIEW_LENGTH] if message.content else '[image]',
+            'date': message.timestamp.isoformat(),
+        }
+        for user_id, other_user_id, unread_delta in (
+            (message.recipient_id, message.sender_id, 1),
+            (message.sender_id, message.recipient_id, 0),
+        ):
+            events.append((user_id, {
+                **common,
+                'conversation_id': conversation_key(message.item_id, other_user_id),
+                'other_user_id': other_user_id,
+                'name': _display_name(users[other_user_id]) if other_user_id in users else '',
+                'unread_delta': unread_delta,
+            }))
+        if message.sender_id == message.recipient_id:
+            events.pop()
+    return events
@@ -0,0 +1,98 @@
+"""
+Keyset (cursor) pagination.
+
+Instead of OFFSET, each page continues strictly after the last row of the
+previous one, using the values of the queryset's ordering keys. The ordering
+must end in a unique column (``id``), so cursors stay stable when new rows are
+inserted while someone is scrolling and every page costs the same index range
+scan no matter how deep it is.
+"""
+from dataclasses import dataclass, field
+
+from django.core import signing
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+
+CURSOR_SALT = 'FindIt.pagination.cursor'
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+@dataclass
+class KeysetPage:
+    object_list: list
+    next_cursor: str = ''
+    ordering: tuple = field(default=())
+
+    @property
+    def has_next(self):
+        return bool(self.next_cursor)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def _ordering(queryset):
+    ordering = tuple(queryset.query.order_by)
+    if not ordering or ordering[-1].lstrip('-') != 'id':
+        raise ValueError('Keyset pagination needs an ordering that ends in a unique id')
+    return ordering
+
+
+def encode_cursor(values):
+    return signing.dumps([str(value) for value in values], salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(queryset, ordering, cursor):
+    try:
+        raw_values = signing.loads(cursor, salt=CURSOR_SALT)
+    except signing.BadSignature:
+        raise InvalidCursor('Malformed or tampered cursor')
+    if not isinstance(raw_values, list) or len(raw_values) != len(ordering):
+        raise InvalidCursor('Cursor does not match this listing')
+
+    values = []
+    for key, raw in zip(ordering, raw_values):
+        name = key.lstrip('-')
+        try:
+            model_field = queryset.model._meta.get_field(name)
+        except FieldDoesNotExist:
+            # Annotations such as the integer search rank
+            model_field = queryset.query.annotations[name].output_field
+        try:
+            values.append(model_field.to_python(raw))
+        except ValidationError:
+            raise InvalidCursor('Cursor does not match this listing')
+    return values
+
+
+def _after(ordering, values):
+    """Rows that sort strictly after ``values`` under ``ordering``"""
+    condition = Q()
+    for i, key in enumerate(ordering):
+        name = key.lstrip('-')
+        lookup = 'lt' if key.startswith('-') else 'gt'
+        step = Q(**{f'{name}__{lookup}': values[i]})
+        for prev_key, prev_value in zip(ordering[:i], values[:i]):
+            step &= Q(**{prev_key.lstrip('-'): prev_value})
+        condition |= step
+    return condition
+
+
+def paginate_keyset(queryset, cursor=None, per_page=24):
+    """Return the page of ``queryset`` that follows ``cursor``"""
+    ordering = _ordering(queryset)
+    if cursor:
+        queryset = queryset.filter(_after(ordering, decode_cursor(queryset, ordering, cursor)))
+
+    rows = list(queryset[:per_page + 1])
+    page = KeysetPage(rows[:per_page], ordering=ordering)
+    if len(rows) > per_page:
+        last = page.object_list[-1]
+        page.next_cursor = encode_cursor(getattr(last, key.lstrip('-')) for key in ordering)
+    return page
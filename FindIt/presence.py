@@ -0,0 +1,208 @@
+"""
+Online presence and typing indicators.
+
+Presence lives in the Django cache, never the database:
+
+* Each worker process counts its own sockets (chat and notification) per
+  user in memory, and while it has any it keeps
+  ``findit:online:<user id>:<worker id>`` alive, refreshing it every
+  HEARTBEAT_INTERVAL seconds with a PRESENCE_TTL expiry. A crashed worker
+  stops refreshing its keys, so its sockets stop counting within
+  PRESENCE_TTL whatever the other workers do.
+* ``findit:online:<user id>`` lists the workers that have held a key for the
+  user. A user is online while any of them still does. The list is
+  rewritten without compare-and-set, so two workers registering at once
+  can drop each other; every heartbeat puts its worker back, so that can
+  only hide a user for up to HEARTBEAT_INTERVAL seconds.
+* ``findit:last_seen:<user id>`` is set when the last socket closes.
+
+A user coming online or going offline is announced to the group
+``presence_<user id>``, which every chat socket open on a conversation with
+that user has joined. Going offline is announced OFFLINE_GRACE to twice that
+many seconds late, and only if no socket came back meanwhile, so reloading a
+page doesn't make the user flicker offline for everyone.
+
+Typing is coalesced per socket by TypingThrottle: keystroke frames turn into
+a ``typing`` event to the room at most every TYPING_THROTTLE seconds, and one
+``typing: false`` once TYPING_TIMEOUT seconds pass without one (or a message
+is sent). A whole burst of typing costs the room a handful of frames.
+"""
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+from collections import Counter
+
+from django.core.cache import cache
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_TTL = 60
+HEARTBEAT_INTERVAL = 20
+LAST_SEEN_TTL = 30 * 24 * 60 * 60
+OFFLINE_GRACE = 5
+TYPING_THROTTLE = 3
+TYPING_TIMEOUT = 5
+
+# User id -> sockets of the user open in this process
+_local_sockets = Counter()
+# Tasks running after their socket is gone; referenced so they are not collected
+_background = set()
+
+
+def presence_group(user_id):
+    return f'presence_{user_id}'
+
+
+def worker_id():
+    """Names this process's presence keys; read per call, as workers may fork after import.
+
+    A restarted worker reusing a pid only ever vouches for its own sockets, so
+    a clash is harmless.
+    """
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def _workers_key(user_id):
+    return f'findit:online:{user_id}'
+
+
+def _worker_key(user_id, worker):
+    return f'findit:online:{user_id}:{worker}'
+
+
+def _last_seen_key(user_id):
+    return f'findit:last_seen:{user_id}'
+
+
+def _in_background(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
+async def _online_workers(user_id):
+    """Ids of the workers that still hold a socket of ``user_id``"""
+    workers = await cache.aget(_workers_key(user_id)) or []
+    if not workers:
+        return []
+    alive = await cache.aget_many([_worker_key(user_id, worker) for worker in workers])
+    return [worker for worker in workers if _worker_key(user_id, worker) in alive]
+
+
+async def is_online(user_id):
+    return bool(await _online_workers(user_id))
+
+
+async def get_presence(user_id):
+    online = await is_online(user_id)
+    return {
+        'type': 'presence',
+        'user_id': user_id,
+        'online': online,
+        'last_seen': None if online else await cache.aget(_last_seen_key(user_id)),
+    }
+
+
+async def _announce(channel_layer, user_id):
+    await channel_layer.group_send(presence_group(user_id), {
+        'type': 'presence_changed',
+        'presence': await get_presence(user_id),
+    })
+
+
+async def _refresh(user_id):
+    """Keep this worker's key for ``user_id`` alive and listed; True if the user was offline"""
+    this_worker = worker_id()
+    workers = await _online_workers(user_id)
+    await cache.aset(_worker_key(user_id, this_worker), True, timeout=PRESENCE_TTL)
+    listed = workers if this_worker in workers else workers + [this_worker]
+    # Rewritten every time: dead workers drop out and the expiry moves on
+    await cache.aset(_workers_key(user_id), listed, timeout=PRESENCE_TTL)
+    return not workers
+
+
+async def _heartbeat(channel_layer, user_id):
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        # The key lapsed, say while the event loop was stalled
+        if await _refresh(user_id):
+            await _announce(channel_layer, user_id)
+
+
+async def join(channel_layer, user_id):
+    """Count a new socket of ``user_id``; returns its heartbeat task, for leave()"""
+    _local_sockets[user_id] += 1
+    if await _refresh(user_id):
+        await _announce(channel_layer, user_id)
+    return asyncio.ensure_future(_heartbeat(channel_layer, user_id))
+
+
+async def leave(channel_layer, user_id, heartbeat):
+    heartbeat.cancel()
+    _local_sockets[user_id] -= 1
+    if _local_sockets[user_id] > 0:
+        return
+    del _local_sockets[user_id]
+    await cache.adelete(_worker_key(user_id, worker_id()))
+    if _local_sockets[user_id]:
+        # A socket joined while the key was being deleted
+        await _refresh(user_id)
+        return
+    if await is_online(user_id):
+        # Still connected through another worker
+        return
+    await cache.aset(_last_seen_key(user_id), timezone.now().isoformat(), timeout=LAST_SEEN_TTL)
+    _in_background(_announce_offline(channel_layer, user_id))
+
+
+async def _announce_offline(channel_layer, user_id):
+    # Jittered, so a worker restart closing every socket at once doesn't
+    # fire every announcement in the same instant
+    await asyncio.sleep(OFFLINE_GRACE * random.uniform(1, 2))
+    try:
+        if not await is_online(user_id):
+            await _announce(channel_layer, user_id)
+    except Exception:
+        logger.exception('Could not announce user %s offline', user_id)
+
+
+class TypingThrottle:
+    """Coalesce one socket's keystroke frames into a few typing events.
+
+    ``send`` is a coroutine function taking True (typing) or False (stopped).
+    """
+
+    def __init__(self, send, throttle=TYPING_THROTTLE, timeout=TYPING_TIMEOUT):
+        self.send = send
+        self.throttle = throttle
+        self.timeout = timeout
+        self.last_sent = None
+        self._timer = None
+
+    async def keystroke(self):
+        now = time.monotonic()
+        if self.last_sent is None or now - self.last_sent >= self.throttle:
+            self.last_sent = now
+            await self.send(True)
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(self.timeout, self._expire)
+
+    def _expire(self):
+        self._timer = None
+        self.last_sent = None
+        _in_background(self.send(False))
+
+    async def stop(self):
+        """The user sent their message or left; no-op unless typing was announced"""
+        if self._timer is None:
+            return
+        self._timer.cancel()
+        self._timer = None
+        self.last_sent = None
+        await self.send(False)
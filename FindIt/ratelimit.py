@@ -0,0 +1,105 @@
+"""
+Rate limits and payload caps for chat sockets.
+
+ChatConsumer checks every frame against:
+
+* a token bucket per socket (``connection_rate`` frames per second, bursts of
+  ``connection_burst``), kept in memory since a socket lives in one process
+* a per-user message budget shared by all of the user's sockets
+  (``user_messages`` per ``user_window`` seconds). It is a sliding window
+  counter in the Django cache, because the cache offers an atomic incr but
+  no compare-and-set to keep a shared bucket consistent. It only spans
+  workers when the cache does: LocMemCache keeps one budget per process,
+  which the FindIt.W001 check warns about (see checks.py)
+* ``max_frame_bytes`` and ``max_message_length`` caps, checked before any
+  database work
+* for image uploads (see uploads.py): ``max_upload_bytes`` per image,
+  ``max_chunk_bytes`` per binary frame, and a byte bucket per socket
+  (``upload_rate`` bytes per second, bursts of ``upload_burst``) in place of
+  the frame bucket
+* ``max_pending_writes``: while this process has that many messages waiting
+  for the write-behind writer, new ones are refused, so a slow database pushes
+  back on senders instead of queueing without bound
+
+Every hit is reported to the client, with ``retry_after`` where waiting
+helps. A socket that keeps hitting limits (``max_violations``) is closed.
+Any key of DEFAULTS can be overridden with ``settings.CHAT_LIMITS``.
+"""
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+DEFAULTS = {
+    'connection_rate': 2.0,
+    'connection_burst': 10,
+    'user_messages': 60,
+    'user_window': 60,
+    'max_frame_bytes': 16 * 1024,
+    'max_message_length': 2000,
+    'max_upload_bytes': 10 * 1024 * 1024,
+    'max_chunk_bytes': 128 * 1024,
+    'upload_rate': 2 * 1024 * 1024,
+    'upload_burst': 4 * 1024 * 1024,
+    'max_pending_writes': 2000,
+    'max_violations': 50,
+}
+
+
+def chat_limits():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_LIMITS', {})}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self, cost=1):
+        """Spend ``cost`` tokens; returns 0 if allowed, else seconds until it would be"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+
+async def take_shared(key, limit, window):
+    """Count one event against ``limit`` per ``window`` seconds for ``key`` in the cache.
+
+    Every process sharing the default cache shares the count. Returns 0 if
+    allowed, else roughly how many seconds until it would be.
+    Refused attempts still count, so a client hammering the limit stays
+    limited.
+    """
+    now = time.time()
+    slot = int(now // window)
+    elapsed = now - slot * window
+    current_key = f'findit:rate:{key}:{slot}'
+    await cache.aadd(current_key, 0, timeout=window * 2)
+    try:
+        current = await cache.aincr(current_key)
+    except ValueError:
+        # Evicted between add and incr
+        await cache.aset(current_key, 1, timeout=window * 2)
+        current = 1
+    previous = await cache.aget(f'findit:rate:{key}:{slot - 1}', 0)
+
+    # The previous window counts for the part of it still inside the sliding window
+    estimated = previous * (window - elapsed) / window + current
+    if estimated <= limit:
+        return 0
+    if current > limit or not previous:
+        return window - elapsed
+    # Only the tail of the previous window is in the way; it slides out at previous/window per second
+    return (estimated - limit) * window / previous
+
+
+def retry_after_seconds(seconds):
+    """Seconds to report to the client, rounded up to a tenth"""
+    return math.ceil(seconds * 10) / 10
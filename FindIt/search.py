@@ -0,0 +1,116 @@
+"""
+Item search backend.
+
+On PostgreSQL every Item carries a weighted ``search_vector`` (title > category
+and location > description) that is kept up to date by the signal handlers in
+models.py and indexed with GIN. A save that leaves the indexed fields as they
+were loaded skips the extra UPDATE, so searches are ranked index lookups instead of
+three ``icontains`` scans. Other databases (SQLite in development and tests)
+fall back to a per-term ``icontains`` match with a simple weighted rank so the
+results and ordering stay comparable.
+"""
+from django.db import connection
+from django.db.models import Case, F, IntegerField, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Cast, Coalesce
+
+SEARCH_CONFIG = 'english'
+
+# ts_rank() returns a float4; scaling it to an integer keeps rank values exact
+# so they can be carried in a pagination cursor (see FindIt.pagination).
+RANK_SCALE = 1000000
+
+# Item columns the search vector is built from
+INDEXED_FIELDS = ('title', 'description', 'location', 'category_id')
+
+# Fallback rank weights, mirroring the A/B/C weights of the search vector
+FALLBACK_WEIGHTS = (
+    ('title', 4),
+    ('category__name', 2),
+    ('location', 2),
+    ('description', 1),
+)
+
+
+def uses_search_vector():
+    """Whether the current database can use the maintained tsvector column"""
+    return connection.vendor == 'postgresql'
+
+
+def item_search_vector():
+    """Weighted search vector expression for an Item row (PostgreSQL only)"""
+    from django.contrib.postgres.search import SearchVector
+    from .models import ItemCategory
+
+    category_name = Coalesce(
+        Subquery(ItemCategory.objects.filter(pk=OuterRef('category_id')).values('name')[:1]),
+        Value(''),
+    )
+    return (
+        SearchVector('title', weight='A', config=SEARCH_CONFIG)
+        + SearchVector(category_name, weight='B', config=SEARCH_CONFIG)
+        + SearchVector('location', weight='B', config=SEARCH_CONFIG)
+        + SearchVector('description', weight='C', config=SEARCH_CONFIG)
+    )
+
+
+def update_search_vector(queryset):
+    """Recompute the search vector for every item in ``queryset``"""
+    if not uses_search_vector():
+        return 0
+    return queryset.update(search_vector=item_search_vector())
+
+
+def _indexed_values(item):
+    # Read from __dict__: touching a deferred field would load it
+    return tuple(item.__dict__.get(field) for field in INDEXED_FIELDS)
+
+
+def remember_indexed_values(item):
+    """Note the indexed fields as loaded (post_init), to tell later whether they changed"""
+    item._search_indexed_values = _indexed_values(item)
+
+
+def refresh_search_vector(item, created):
+    """Recompute ``item``'s vector after a save (post_save), unless no indexed field changed"""
+    if created or getattr(item, '_search_indexed_values', None) != _indexed_values(item):
+        update_search_vector(type(item).objects.filter(pk=item.pk))
+    remember_indexed_values(item)
+
+
+def legacy_search(queryset, query):
+    """The original unranked triple ``icontains`` filter, kept for benchmarking"""
+    return queryset.filter(
+        Q(title__icontains=query) | Q(description__icontains=query) | Q(location__icontains=query)
+    )
+
+
+def search_items(queryset, query):
+    """Filter ``queryset`` to items matching ``query``, best matches first"""
+    query = (query or '').strip()
+    if not query:
+        return queryset
+    if uses_search_vector():
+        return _vector_search(queryset, query)
+    return _fallback_search(queryset, query)
+
+
+def _vector_search(queryset, query):
+    from django.contrib.postgres.search import SearchQuery, SearchRank
+
+    search_query = SearchQuery(query, search_type='websearch', config=SEARCH_CONFIG)
+    return queryset.filter(search_vector=search_query).annotate(
+        rank=Cast(SearchRank(F('search_vector'), search_query) * RANK_SCALE, IntegerField())
+    ).order_by('-rank', '-date_reported', '-id')
+
+
+def _fallback_search(queryset, query):
+    terms = query.split()
+    rank = Value(0, output_field=IntegerField())
+    for term in terms:
+        term_filter = Q()
+        for field, weight in FALLBACK_WEIGHTS:
+            lookup = Q(**{f'{field}__icontains': term})
+            term_filter |= lookup
+            rank = rank + Case(When(lookup, then=Value(weight)), default=Value(0), output_field=IntegerField())
+        queryset = queryset.filter(term_filter)
+    return queryset.annotate(rank=rank).order_by('-rank', '-date_reported', '-id')
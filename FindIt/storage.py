@@ -0,0 +1,151 @@
+"""
+Content-addressed storage for uploaded images.
+
+Users upload the same photo again when they edit an item, report it twice or
+send it in chat. ContentAddressedStorage names every file after the SHA-256
+of its bytes, inside the directory its field asked for::
+
+    item_photos/IMG_1.webp -> item_photos/<64 hex digits>.webp
+
+so identical uploads to the same kind of field share one file. The hash is
+computed while the upload streams to a temporary file next to its final
+place, which is then renamed into place, or dropped if the file exists.
+
+Each stored file has a MediaBlob row counting the rows that point at it:
+save() adds a reference and delete() drops one, removing the file (and its
+thumbnails) with the last. Model rows release their files when they are
+deleted, their image is replaced or their save fails; see release(). Chat
+images stored ahead of their message are released by the write-behind
+writer when the message turns out to be a duplicate or can't be stored.
+
+A content-addressed name never changes content, so its URL can be cached
+forever (see is_immutable()). Existing files are moved into this scheme by
+the dedupe_media command.
+"""
+import hashlib
+import os
+import posixpath
+import re
+import uuid
+
+from django.core.files.storage import FileSystemStorage, storages
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+CONTENT_NAME_RE = re.compile(r'^(?:[\w-]+/)*[0-9a-f]{64}(?:\.\w+)?$')
+
+
+def media_storage():
+    """Storage of the uploaded image fields; a callable so migrations don't pin the backend"""
+    return storages['media']
+
+
+def is_immutable(name):
+    return bool(CONTENT_NAME_RE.match(name))
+
+
+class _HashingContent:
+    """Passes the chunks of ``content`` to the file being written, hashing them on the way"""
+
+    def __init__(self, content):
+        self.content = content
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def chunks(self):
+        for chunk in self.content.chunks():
+            self.digest.update(chunk)
+            self.size += len(chunk)
+            yield chunk
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def get_available_name(self, name, max_length=None):
+        # _save() picks the name from the content
+        return name
+
+    def _save(self, name, content):
+        directory = posixpath.dirname(name)
+        extension = posixpath.splitext(name)[1].lower()
+        hashing = _HashingContent(content)
+        incoming = super()._save(posixpath.join(directory, f'.incoming-{uuid.uuid4().hex}'), hashing)
+        final = posixpath.join(directory, hashing.digest.hexdigest() + extension)
+        try:
+            with transaction.atomic():
+                self.add_reference(final, hashing.size)
+                if self.exists(final):
+                    os.unlink(self.path(incoming))
+                else:
+                    os.replace(self.path(incoming), self.path(final))
+        except BaseException:
+            if os.path.exists(self.path(incoming)):
+                os.unlink(self.path(incoming))
+            raise
+        return final
+
+    def add_reference(self, name, size=0, count=1):
+        from .models import MediaBlob
+
+        if MediaBlob.objects.filter(name=name).update(refs=F('refs') + count):
+            return
+        try:
+            with transaction.atomic():
+                MediaBlob.objects.create(name=name, refs=count, size=size)
+        except IntegrityError:
+            # Created by a concurrent save
+            MediaBlob.objects.filter(name=name).update(refs=F('refs') + count)
+
+    def delete(self, name):
+        """Drop one reference to ``name``; the file goes with the last one"""
+        from .models import MediaBlob
+        from .thumbnails import delete_thumbnails
+
+        if not name:
+            raise ValueError('The name must be given to delete().')
+        if is_immutable(name):
+            with transaction.atomic():
+                blob = MediaBlob.objects.select_for_update().filter(name=name).first()
+                if blob is not None and blob.refs > 1:
+                    MediaBlob.objects.filter(pk=blob.pk).update(refs=F('refs') - 1)
+                    return
+                if blob is not None:
+                    blob.delete()
+                super().delete(name)
+        else:
+            # Stored before content addressing; never shared
+            super().delete(name)
+        delete_thumbnails(name)
+
+
+def release(fieldfile_or_name, storage=None):
+    """Drop a row's reference to a stored file once the current transaction commits"""
+    name = getattr(fieldfile_or_name, 'name', fieldfile_or_name)
+    storage = storage or getattr(fieldfile_or_name, 'storage', None) or media_storage()
+    if name:
+        transaction.on_commit(lambda: storage.delete(name))
+
+
+class ReleaseOnFailedSave:
+    """Model mixin: a save that fails after storing a new file gives back the file's reference.
+
+    The reference is taken when the file is stored, before the row is
+    written. Inside a transaction that rolls back, both the reference and
+    release()'s on_commit callback go with it.
+    """
+
+    def save(self, *args, **kwargs):
+        from django.db.models import FileField
+
+        pending = [
+            field.attname for field in self._meta.concrete_fields
+            if isinstance(field, FileField) and getattr(self, field.attname)
+            and not getattr(self, field.attname)._committed
+        ]
+        try:
+            super().save(*args, **kwargs)
+        except BaseException:
+            for attname in pending:
+                fieldfile = getattr(self, attname)
+                if fieldfile._committed:
+                    release(fieldfile)
+            raise
@@ -0,0 +1,30 @@
+from django import template
+from django.utils.html import format_html
+
+from FindIt import thumbnails
+
+register = template.Library()
+
+
+@register.simple_tag
+def image_attrs(fieldfile, sizes='100vw'):
+    """src, srcset and sizes attributes for an <img> showing an image field.
+
+    Usage: <img {% image_attrs item.photo "(max-width: 576px) 100vw, 33vw" %} alt="...">
+    ``sizes`` is how wide the image is laid out, so the browser can pick the
+    smallest thumbnail that is sharp enough.
+    """
+    if not fieldfile:
+        return ''
+    src, candidates = thumbnails.srcset(fieldfile)
+    if not candidates:
+        return format_html('src="{}"', src)
+    return format_html('src="{}" srcset="{}" sizes="{}"', src, candidates, sizes)
+
+
+@register.simple_tag
+def thumbnail_url(fieldfile, width):
+    """URL for an image field shown at most ``width`` CSS px wide (avatars, icons)"""
+    if not fieldfile:
+        return ''
+    return thumbnails.thumbnail_url(fieldfile, int(width))
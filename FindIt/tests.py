@@ -1,3 +1,2140 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from collections import Counter
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Q
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db.models.signals import post_save
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.http import Http404
+from django.utils import timezone
+
+from .messaging import (
+    MESSAGE_PAGE_SIZE, conversation_messages, create_message, create_messages, delete_conversation,
+    get_conversation, mark_read, message_history, messages_after, reconcile_unread, set_archived, unread_count,
+)
+from . import facets, presence, thumbnails, visual
+from .checks import check_shared_cache
+from .consumers import chat_group
+from .ingest import ImageRejected, normalize
+from .gazetteer import (
+    DEFAULT_GAZETTEER_PATH, MAX_GRID_CELLS, MAX_RADIUS_METRES, METRES_PER_DEGREE, Gazetteer, cells_within,
+    filter_within, get_gazetteer, grid_cell,
+)
+from .matching import MIN_SCORE, matches_for, score_item, score_pair
+from .models import (
+    Conversation, Item, ItemCategory, ItemMatch, MediaBlob, Message, RecoveredItem, UserProfile,
+    mark_item_recovered,
+)
+from .pagination import InvalidCursor, encode_cursor, paginate_keyset
+from .ratelimit import TokenBucket, take_shared
+from .routing import websocket_urlpatterns
+from .search import search_items
+from .storage import is_immutable, media_storage
+from .uploads import StoredImage, UploadError, finish_upload, parse_chunk, start_upload, write_chunk
+from .views import serve_media
+from .writebehind import MessageWriter, PendingMessage, write_batch
+
+
+class MessageQueryPlanTests(TestCase):
+    """EXPLAIN the Message queries the chat views really run and fail on full table scans.
+
+    On PostgreSQL sequential scans are disabled for the check, so any Seq Scan
+    left in a plan means no index matches the predicate. SQLite reports a full
+    scan as ``SCAN <table>`` without ``USING ... INDEX``.
+    """
+    table = Message._meta.db_table
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='pw')
+        cls.bob = User.objects.create_user('bob', password='pw')
+        category = ItemCategory.objects.create(name='Wallets')
+        cls.item = Item.objects.create(
+            title='Black leather wallet', description='Lost near the library',
+            category=category, location='Main Library', status='lost', reported_by=cls.alice,
+        )
+        for n in range(40):
+            sender, recipient = (cls.bob, cls.alice) if n % 2 else (cls.alice, cls.bob)
+            create_message(sender, recipient, cls.item, f'message {n}')
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+
+    def message_queries(self, request):
+        with CaptureQueriesContext(connection) as captured:
+            response = request()
+        self.assertLess(response.status_code, 400)
+        queries = [
+            query['sql'] for query in captured.captured_queries
+            if f'"{self.table}"' in query['sql'] and query['sql'].startswith(('SELECT', 'UPDATE', 'DELETE'))
+        ]
+        self.assertTrue(queries, 'request ran no Message queries')
+        return queries
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute(f'EXPLAIN {sql}')
+                return [row[0] for row in cursor.fetchall()]
+            if connection.vendor == 'sqlite':
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                return [row[-1] for row in cursor.fetchall()]
+        self.skipTest(f'No plan check for {connection.vendor}')
+
+    def assertNoMessageScan(self, request):
+        for sql in self.message_queries(request):
+            plan = self.explain(sql)
+            if connection.vendor == 'postgresql':
+                scans = [line for line in plan if 'Seq Scan on' in line and self.table in line]
+            else:
+                scans = [line for line in plan if re.fullmatch(rf'SCAN ({self.table}|U\d+)', line.strip())]
+            self.assertFalse(scans, f'Full scan of {self.table}:\n{sql}\n' + '\n'.join(plan))
+
+    def test_inbox_active_conversation(self):
+        self.assertNoMessageScan(lambda: self.client.get(
+            reverse('inbox'), {'item_id': self.item.id, 'recipient_id': self.bob.id},
+        ))
+
+    def test_inbox_history(self):
+        last_id = self.item.messages.order_by('-id').values_list('id', flat=True)[0]
+        self.assertNoMessageScan(lambda: self.client.get(
+            reverse('inbox_history'), {'item_id': self.item.id, 'recipient_id': self.bob.id, 'before': last_id},
+        ))
+
+    def test_send_message(self):
+        self.assertNoMessageScan(lambda: self.client.get(
+            reverse('send_message', args=[self.item.id, self.bob.id]),
+        ))
+
+    def test_archive_and_delete_conversation(self):
+        for action in ('archive', 'unarchive', 'delete'):
+            self.assertNoMessageScan(lambda: self.client.post(
+                reverse('clear_conversation'),
+                json.dumps({'action': action, 'item_id': self.item.id, 'recipient_id': self.bob.id}),
+                content_type='application/json',
+            ))
+
+
+# A stand-alone worker: joins a chat room on its own channel layer connection
+# and reports when the test's group_send reached it
+CHANNEL_WORKER = """
+import asyncio, json, sys, time
+from django.utils.module_loading import import_string
+
+async def main(layer_settings, group):
+    layer = import_string(layer_settings['BACKEND'])(**layer_settings.get('CONFIG', {}))
+    channel = await layer.new_channel()
+    await layer.group_add(group, channel)
+    print('ready', flush=True)
+    message = await asyncio.wait_for(layer.receive(channel), timeout=10)
+    print(json.dumps({'sent_at': message['sent_at'], 'received_at': time.time()}), flush=True)
+    await layer.group_discard(group, channel)
+
+asyncio.run(main(json.loads(sys.argv[1]), sys.argv[2]))
+"""
+
+
+class ChatSocketMixin:
+    """Chat sockets on ``self.item``, served by the real routing"""
+
+    def chat_socket(self, user, other_user, item=None):
+        socket = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{(item or self.item).id}-{other_user.id}/',
+        )
+        socket.scope['user'] = user
+        return socket
+
+    async def receive_chat_frame(self, socket, timeout=1):
+        # Skip presence updates
+        while True:
+            event = await socket.receive_json_from(timeout=timeout)
+            if event.get('type') != 'presence':
+                return event
+
+
+class ChannelLayerFanOutTests(ChatSocketMixin, TransactionTestCase):
+    """Chat messages reach every socket in a room, within MAX_DELIVERY_SECONDS.
+
+    test_cross_worker_delivery stands in for separate workers within this
+    process. The cross-process test needs a shared layer; run the suite with
+    CHANNEL_LAYER=redis (and REDIS_URL) to include it.
+    """
+    MAX_DELIVERY_SECONDS = 0.5
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        self.item = Item.objects.create(
+            title='Black leather wallet', description='Lost near the library',
+            category=ItemCategory.objects.create(name='Wallets'), location='Main Library',
+            status='lost', reported_by=self.alice,
+        )
+
+
+    async def test_room_fan_out(self):
+        # Each side opens the conversation from its own point of view
+        sockets = [self.chat_socket(self.alice, self.bob), self.chat_socket(self.bob, self.alice)]
+        for socket in sockets:
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+
+        sent_at = time.monotonic()
+        await get_channel_layer().group_send(chat_group(self.item.id, self.alice.id, self.bob.id), {
+            'type': 'chat_message',
+            'message': 'hello',
+            'sender_id': self.alice.id,
+            'sender_username': 'alice',
+            'timestamp': '',
+            'message_id': 1,
+        })
+        for socket in sockets:
+            event = await self.receive_chat_frame(socket, timeout=self.MAX_DELIVERY_SECONDS)
+            self.assertEqual(event['message'], 'hello')
+        self.assertLess(time.monotonic() - sent_at, self.MAX_DELIVERY_SECONDS)
+        for socket in sockets:
+            await socket.disconnect()
+
+    async def test_cross_worker_delivery(self):
+        # Sockets served by separate consumer instances, as on separate
+        # workers, meet only through the shared layer instance
+        senders = [self.chat_socket(self.alice, self.bob) for _ in range(2)]
+        receivers = [self.chat_socket(self.bob, self.alice) for _ in range(2)]
+        sockets = senders + receivers
+        for socket in sockets:
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+
+        sent_at = time.monotonic()
+        await senders[0].send_json_to({'message': 'on my way', 'client_id': 'alice-1'})
+        for socket in sockets:
+            event = await self.receive_chat_frame(socket, timeout=self.MAX_DELIVERY_SECONDS)
+            self.assertEqual(
+                (event['message'], event['client_id'], event['sender_id']), ('on my way', 'alice-1', self.alice.id),
+            )
+        self.assertLess(time.monotonic() - sent_at, self.MAX_DELIVERY_SECONDS)
+
+        # Then every socket learns the stored id from the writer
+        for socket in sockets:
+            event = await self.receive_chat_frame(socket, timeout=1)
+            self.assertEqual(event['type'], 'saved')
+        message = await database_sync_to_async(Message.objects.get)()
+        self.assertEqual((event['client_id'], event['message_id']), ('alice-1', message.pk))
+        for socket in sockets:
+            await socket.disconnect()
+
+    async def test_join_requires_participant(self):
+        carol = await database_sync_to_async(User.objects.create_user)('carol', password='pw')
+        for user, other_user in ((AnonymousUser(), self.bob), (carol, self.bob), (self.alice, self.alice)):
+            socket = self.chat_socket(user, other_user)
+            connected, _ = await socket.connect()
+            self.assertFalse(connected, f'{user} joined a chat with {other_user}')
+            await socket.disconnect()
+
+    @unittest.skipIf(
+        settings.CHANNEL_LAYERS['default']['BACKEND'] == 'channels.layers.InMemoryChannelLayer',
+        'in-memory channel layer cannot cross processes',
+    )
+    def test_cross_process_delivery(self):
+        group = f'chat_fanout-test-{time.time_ns()}'
+        workers = [
+            subprocess.Popen(
+                [sys.executable, '-c', CHANNEL_WORKER, json.dumps(settings.CHANNEL_LAYERS['default']), group],
+                stdout=subprocess.PIPE, text=True,
+            )
+            for _ in range(2)
+        ]
+        try:
+            for worker in workers:
+                self.assertEqual(worker.stdout.readline().strip(), 'ready')
+
+            asyncio.run(get_channel_layer().group_send(group, {'type': 'chat.message', 'sent_at': time.time()}))
+
+            for worker in workers:
+                output, _ = worker.communicate(timeout=15)
+                self.assertEqual(worker.returncode, 0)
+                report = json.loads(output)
+                self.assertLess(report['received_at'] - report['sent_at'], self.MAX_DELIVERY_SECONDS)
+        finally:
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.kill()
+
+
+class ItemSearchTests(TestCase):
+    """The icontains fallback used off PostgreSQL, and when the vector is refreshed"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='pw')
+        cls.electronics = ItemCategory.objects.create(name='Electronics')
+        cls.bags = ItemCategory.objects.create(name='Bags')
+
+    def make_item(self, title, description='', location='Campus', category=None):
+        return Item.objects.create(
+            title=title, description=description, location=location,
+            category=category or self.bags, status='lost', reported_by=self.alice,
+        )
+
+    def search(self, query):
+        return list(search_items(Item.objects.all(), query).values_list('title', flat=True))
+
+    def test_fallback_ranks_title_over_category_over_description(self):
+        self.make_item('Blue bag', description='Has headphones inside')
+        self.make_item('Sony headphones', category=self.electronics)
+        self.make_item('Charger', category=self.electronics, description='Phone charger')
+        self.assertEqual(self.search('headphones'), ['Sony headphones', 'Blue bag'])
+        self.assertEqual(self.search('electronics'), ['Charger', 'Sony headphones'])
+
+    def test_fallback_requires_every_term_and_sums_their_weights(self):
+        self.make_item('Black wallet', location='Library')
+        self.make_item('Black umbrella', description='Found at the library entrance')
+        self.make_item('Red wallet', location='Gym')
+        self.assertEqual(self.search('black library'), ['Black wallet', 'Black umbrella'])
+        self.assertEqual(self.search('wallet gym'), ['Red wallet'])
+        self.assertEqual(len(self.search('   ')), 3)
+
+    def test_vector_refreshed_only_when_indexed_fields_change(self):
+        with mock.patch('FindIt.search.update_search_vector') as update:
+            item = self.make_item('Keys')
+            self.assertEqual(update.call_count, 1)
+            item.is_returned = True
+            item.save()
+            Item.objects.get(pk=item.pk).save()
+            self.assertEqual(update.call_count, 1)
+            item.title = 'House keys'
+            item.save()
+            self.assertEqual(update.call_count, 2)
+            item.category = self.electronics
+            item.save()
+            self.assertEqual(update.call_count, 3)
+
+
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        alice = User.objects.create_user('alice', password='pw')
+        category = ItemCategory.objects.create(name='Bags')
+        for n in range(23):
+            Item.objects.create(
+                title=f'Bag {n}' if n % 3 else f'Blue bag {n}', description='bag', location='Campus',
+                category=category, status='lost', reported_by=alice,
+            )
+        # Groups of rows share a date_reported, so only the id breaks ties
+        base = timezone.now()
+        for item_id in Item.objects.values_list('id', flat=True):
+            Item.objects.filter(pk=item_id).update(date_reported=base - timedelta(hours=item_id % 4))
+
+    def walk(self, queryset, per_page):
+        seen, cursor = [], None
+        while True:
+            page = paginate_keyset(queryset, cursor, per_page)
+            seen.extend(item.id for item in page)
+            if not page.has_next:
+                return seen
+            cursor = page.next_cursor
+
+    def test_pages_cover_tied_rows_once_in_order(self):
+        items = Item.objects.order_by('-date_reported', '-id')
+        expected = list(items.values_list('id', flat=True))
+        for per_page in (1, 4, 5, 23, 50):
+            self.assertEqual(self.walk(items, per_page), expected, f'per_page={per_page}')
+
+    def test_rank_ordered_search_pages(self):
+        items = search_items(Item.objects.order_by('-date_reported', '-id'), 'blue bag')
+        expected = list(items.values_list('id', flat=True))
+        self.assertEqual(len(expected), 8)
+        # Equal ranks fall back to date, then id
+        self.assertEqual(self.walk(items, 3), expected)
+
+    def test_tampered_or_foreign_cursors_are_rejected(self):
+        items = Item.objects.order_by('-date_reported', '-id')
+        cursor = paginate_keyset(items, None, 5).next_cursor
+        value, signature = cursor.rsplit(':', 1)
+        for bad in (
+            value + ':' + signature[::-1],
+            cursor.replace(':', '', 1),
+            'garbage',
+            encode_cursor(['2026-01-01T00:00:00+00:00']),
+            encode_cursor(['not a date', '12']),
+        ):
+            with self.assertRaises(InvalidCursor, msg=bad):
+                paginate_keyset(items, bad, 5)
+        # A rank cursor doesn't fit the plain date listing
+        ranked = search_items(Item.objects.order_by('-date_reported', '-id'), 'bag')
+        with self.assertRaises(InvalidCursor):
+            paginate_keyset(items, paginate_keyset(ranked, None, 5).next_cursor, 5)
+        response = self.client.get(reverse('item_list_more'), {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ItemStateTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.finder = User.objects.create_user('finder', password='pw')
+        cls.owner = User.objects.create_user('owner', password='pw')
+        cls.category = ItemCategory.objects.create(name='Keys')
+
+    def make_item(self, **fields):
+        return Item.objects.create(
+            title='Keys', description='Bunch of keys', location='Gym', category=self.category,
+            status='found', reported_by=self.finder, **fields,
+        )
+
+    def state(self, item):
+        return Item.objects.values_list('state', flat=True).get(pk=item.pk)
+
+    def mark_returned(self, user, item, **data):
+        self.client.force_login(user)
+        return self.client.post(reverse('mark_item_returned', args=[item.id]), data)
+
+    def test_return_and_owner_confirmation(self):
+        item = self.make_item()
+        self.mark_returned(self.finder, item, owner_username='owner')
+        self.assertEqual(self.state(item), Item.STATE_PENDING_RETURN)
+        # The view sets the state itself, without relying on the RecoveredItem signal
+        post_save.disconnect(mark_item_recovered, sender=RecoveredItem)
+        try:
+            response = self.mark_returned(self.owner, item)
+        finally:
+            post_save.connect(mark_item_recovered, sender=RecoveredItem)
+        self.assertRedirects(response, reverse('rate_finder', args=[item.id]), fetch_redirect_response=False)
+        self.assertEqual(self.state(item), Item.STATE_RECOVERED)
+        self.assertTrue(RecoveredItem.objects.filter(item=item, owner=self.owner).exists())
+        # Recovered items stay recovered when the finder toggles the flag
+        self.mark_returned(self.finder, item)
+        self.assertEqual(self.state(item), Item.STATE_RECOVERED)
+        RecoveredItem.objects.get(item=item).delete()
+        self.assertEqual(self.state(item), Item.STATE_ACTIVE)
+
+    def test_finder_toggles_pending_return(self):
+        item = self.make_item()
+        self.mark_returned(self.finder, item)
+        self.assertEqual(self.state(item), Item.STATE_PENDING_RETURN)
+        self.mark_returned(self.finder, item)
+        self.assertEqual(self.state(item), Item.STATE_ACTIVE)
+        # Nobody else may change it
+        self.mark_returned(self.owner, item)
+        self.assertEqual(self.state(item), Item.STATE_ACTIVE)
+
+    def test_state_backfill(self):
+        from django.apps import apps
+
+        backfill = importlib.import_module('FindIt.migrations.0009_item_state').backfill_item_state
+        active, returned, recovered = self.make_item(), self.make_item(), self.make_item()
+        Item.objects.filter(pk__in=[returned.pk, recovered.pk]).update(is_returned=True)
+        RecoveredItem.objects.create(
+            item=recovered, owner=self.owner, finder=self.finder,
+            original_report_date=recovered.date_reported, location=recovered.location,
+        )
+        Item.objects.update(state=Item.STATE_ACTIVE)
+        backfill(apps, None)
+        self.assertEqual(
+            [self.state(item) for item in (active, returned, recovered)],
+            [Item.STATE_ACTIVE, Item.STATE_PENDING_RETURN, Item.STATE_RECOVERED],
+        )
+
+    def test_expire_items(self):
+        old, old_pending, recent = self.make_item(), self.make_item(is_returned=True), self.make_item()
+        old_pending.sync_returned_state()
+        old_pending.save()
+        Item.objects.filter(pk__in=[old.pk, old_pending.pk]).update(date_reported=timezone.now() - timedelta(days=200))
+        call_command('expire_items', '--dry-run', stdout=io.StringIO())
+        self.assertEqual(self.state(old), Item.STATE_ACTIVE)
+        call_command('expire_items', stdout=io.StringIO())
+        self.assertEqual(
+            [self.state(item) for item in (old, old_pending, recent)],
+            [Item.STATE_EXPIRED, Item.STATE_PENDING_RETURN, Item.STATE_ACTIVE],
+        )
+        self.assertNotIn(old, Item.objects.filter(state__in=Item.LISTED_STATES))
+
+
+class MatchingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='pw')
+        cls.bob = User.objects.create_user('bob', password='pw')
+        cls.phones = ItemCategory.objects.create(name='Phones')
+        cls.bags = ItemCategory.objects.create(name='Bags')
+
+    def make_item(self, title, status, user=None, category=None, location='Main Library'):
+        return Item.objects.create(
+            title=title, description=title, location=location, category=category or self.phones,
+            status=status, reported_by=user or (self.alice if status == 'lost' else self.bob),
+        )
+
+    def stored(self):
+        return {(m.item_id, m.candidate_id, round(m.score, 6)) for m in ItemMatch.objects.all()}
+
+    def test_score_pair_is_symmetric_and_weighs_signals(self):
+        lost = self.make_item('Black iphone cracked screen', 'lost')
+        found = self.make_item('Black iphone', 'found')
+        other = self.make_item('Red backpack', 'found', category=self.bags, location='Gym')
+        self.assertAlmostEqual(score_pair(lost, found), score_pair(found, lost))
+        self.assertGreater(score_pair(lost, found), score_pair(lost, other))
+        self.assertLess(score_pair(lost, other), MIN_SCORE)
+
+    def test_own_and_same_status_items_are_not_candidates(self):
+        lost = self.make_item('Black iphone', 'lost')
+        self.make_item('Black iphone', 'found', user=self.alice)
+        self.make_item('Black iphone', 'lost', user=self.bob)
+        self.assertEqual(score_item(lost), 0)
+        self.assertFalse(ItemMatch.objects.exists())
+
+    @mock.patch('FindIt.matching.MAX_MATCHES', 1)
+    def test_rescoring_keeps_other_items_matches(self):
+        lost = self.make_item('Black iphone 12 cracked', 'lost')
+        close = self.make_item('Black iphone 12 cracked', 'found')
+        further = self.make_item('Black iphone', 'found')
+        score_item(further)
+        self.assertEqual([m.candidate for m in matches_for(further)], [lost])
+        # lost's own top match is the closer one; further keeps its match to lost
+        self.assertEqual(score_item(lost), 1)
+        self.assertEqual([m.candidate for m in matches_for(further)], [lost])
+        self.assertEqual([m.candidate for m in matches_for(close)], [lost])
+        self.assertEqual({m.candidate for m in matches_for(lost)}, {close, further})
+
+    def test_pairs_that_stop_matching_are_removed(self):
+        lost = self.make_item('Black iphone', 'lost')
+        found = self.make_item('Black iphone', 'found')
+        score_item(found)
+        self.assertTrue(ItemMatch.objects.filter(item=found, candidate=lost).exists())
+        lost.title = lost.description = 'Red umbrella'
+        lost.category = self.bags
+        lost.location = 'Gym'
+        lost.save()
+        score_item(lost)
+        self.assertFalse(ItemMatch.objects.exists())
+        # Unlisted items lose all their pairs
+        score_item(found)
+        found.state = Item.STATE_EXPIRED
+        found.save()
+        score_item(found)
+        self.assertFalse(ItemMatch.objects.exists())
+
+    @mock.patch('FindIt.matching.MAX_MATCHES', 2)
+    def test_backfill_order_does_not_matter(self):
+        titles = ['Black iphone 12', 'Black iphone', 'Iphone 12 case', 'Black phone cracked', 'Samsung phone']
+        items = [self.make_item(title, 'lost') for title in titles]
+        items += [self.make_item(title, 'found') for title in reversed(titles)]
+        results = []
+        for order in (items, items[::-1], items[::2] + items[1::2]):
+            ItemMatch.objects.all().delete()
+            for item in order:
+                score_item(item)
+            results.append(self.stored())
+        self.assertTrue(results[0])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+        # Every pair is stored in both directions
+        self.assertEqual(
+            {(item, candidate) for item, candidate, _ in results[0]},
+            {(candidate, item) for item, candidate, _ in results[0]},
+        )
+
+
+class GazetteerTests(TestCase):
+    # Places due north of the first one, at these distances in metres
+    OFFSETS = {'north-gate': 0, 'north-hall': 200, 'north-field': 1500, 'far-farm': 3000}
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, 'gazetteer.json')
+        with open(path, 'w') as fh:
+            json.dump({'places': [
+                {'id': place_id, 'name': place_id.replace('-', ' ').title(), 'lat': 10 + metres / METRES_PER_DEGREE, 'lng': 120}
+                for place_id, metres in self.OFFSETS.items()
+            ]}, fh)
+        self.settings_override = override_settings(GAZETTEER_PATH=path)
+        self.settings_override.enable()
+        get_gazetteer.cache_clear()
+        self.alice = User.objects.create_user('alice', password='pw')
+        category = ItemCategory.objects.create(name='Bags')
+        for place_id in self.OFFSETS:
+            Item.objects.create(
+                title=place_id, description='bag', location=place_id.replace('-', ' '),
+                category=category, status='lost', reported_by=self.alice,
+            )
+
+    def tearDown(self):
+        self.settings_override.disable()
+        get_gazetteer.cache_clear()
+        self.tmp.cleanup()
+
+    def within(self, radius):
+        gate = get_gazetteer().get('north-gate')
+        return list(
+            filter_within(Item.objects.all(), gate.lat, gate.lng, radius)
+            .order_by('distance').values_list('title', flat=True)
+        )
+
+    def test_resolve(self):
+        gazetteer = Gazetteer.from_file(DEFAULT_GAZETTEER_PATH)
+        for text, place_id in (
+            ('Main Library', 'main-library'),
+            ('library 2nd floor', 'main-library'),
+            ('near the main lib', 'main-library'),
+            ('Eng bldg room 301', 'engineering-building'),
+            ('the canteen', 'cafeteria'),
+            ('somewhere downtown', None),
+            ('', None),
+        ):
+            place = gazetteer.resolve(text)
+            self.assertEqual(place.id if place else None, place_id, text)
+
+    def test_items_are_normalized_on_save(self):
+        item = Item.objects.get(title='north-hall')
+        self.assertEqual(item.place_id, 'north-hall')
+        self.assertEqual(item.grid_cell, grid_cell(item.latitude, item.longitude))
+
+    def test_hand_corrected_place_survives_other_edits(self):
+        item = Item.objects.get(title='north-hall')
+        item.place_id = 'north-field'
+        item.latitude, item.longitude = get_gazetteer().get('north-field').lat, 120
+        item.save()
+        item = Item.objects.get(pk=item.pk)
+        item.description = 'black bag'
+        item.save()
+        item.status = 'found'
+        item.save()
+        self.assertEqual(Item.objects.get(pk=item.pk).place_id, 'north-field')
+
+        # Editing the location itself resolves it again, on a loaded or a new instance
+        item.location = 'far farm'
+        item.save()
+        self.assertEqual(Item.objects.get(pk=item.pk).place_id, 'far-farm')
+        item = Item.objects.get(pk=item.pk)
+        item.location = 'north gate'
+        item.save()
+        self.assertEqual(Item.objects.get(pk=item.pk).place_id, 'north-gate')
+
+    def test_radius_search(self):
+        self.assertEqual(self.within(100), ['north-gate'])
+        self.assertEqual(self.within(300), ['north-gate', 'north-hall'])
+        self.assertEqual(self.within(2000), ['north-gate', 'north-hall', 'north-field'])
+        # Capped at MAX_RADIUS_METRES
+        self.assertEqual(self.within(50000), ['north-gate', 'north-hall', 'north-field'])
+
+    def test_wide_radius_uses_no_cell_list(self):
+        gate = get_gazetteer().get('north-gate')
+        narrow = str(filter_within(Item.objects.all(), gate.lat, gate.lng, 250).query).split(' WHERE ')[1]
+        wide = str(filter_within(Item.objects.all(), gate.lat, gate.lng, MAX_RADIUS_METRES).query).split(' WHERE ')[1]
+        self.assertIn('grid_cell', narrow)
+        self.assertNotIn('grid_cell', wide)
+        self.assertGreater(len(cells_within(gate.lat, gate.lng, MAX_RADIUS_METRES)), MAX_GRID_CELLS)
+
+    def test_place_backfill(self):
+        from django.apps import apps
+
+        backfill = importlib.import_module('FindIt.migrations.0020_item_place_backfill').backfill_item_places
+        Item.objects.update(place_id='', latitude=None, longitude=None, grid_cell='')
+        backfill(apps, None)
+        self.assertEqual(self.within(300), ['north-gate', 'north-hall'])
+
+
+class UnreadCounterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='pw')
+        cls.bob = User.objects.create_user('bob', password='pw')
+        cls.carol = User.objects.create_user('carol', password='pw')
+        category = ItemCategory.objects.create(name='Wallets')
+        cls.wallet = Item.objects.create(
+            title='Wallet', description='Brown wallet', location='Gym', category=category,
+            status='lost', reported_by=cls.alice,
+        )
+        cls.phone = Item.objects.create(
+            title='Phone', description='Black phone', location='Gym', category=category,
+            status='found', reported_by=cls.alice,
+        )
+
+    def counters(self, user):
+        """(profile total, {(item id, other user id): conversation unread}) for ``user``"""
+        per_conversation = {}
+        for conversation in Conversation.objects.filter(Q(user_a=user) | Q(user_b=user)):
+            side = conversation.side(user)
+            key = (conversation.item_id, conversation.other_user(user).pk)
+            per_conversation[key] = getattr(conversation, f'unread_{side}')
+        return unread_count(user), per_conversation
+
+    def test_send_read_delete(self):
+        create_message(self.bob, self.alice, self.wallet, 'is this yours?')
+        create_message(self.bob, self.alice, self.wallet, 'brown one')
+        create_message(self.carol, self.alice, self.phone, 'found a phone')
+        create_messages([
+            Message(sender=self.carol, recipient=self.alice, item=self.phone, content='hello', client_id='c1'),
+            Message(sender=self.alice, recipient=self.carol, item=self.phone, content='hi', client_id='a1'),
+        ])
+        self.assertEqual(self.counters(self.alice), (4, {
+            (self.wallet.id, self.bob.id): 2, (self.phone.id, self.carol.id): 2,
+        }))
+        self.assertEqual(self.counters(self.carol), (1, {(self.phone.id, self.alice.id): 1}))
+
+        # Reading one conversation leaves the other alone
+        self.assertEqual(mark_read(self.alice, Message.objects.filter(item=self.wallet)), 2)
+        self.assertEqual(self.counters(self.alice), (2, {
+            (self.wallet.id, self.bob.id): 0, (self.phone.id, self.carol.id): 2,
+        }))
+        self.assertEqual(mark_read(self.alice, Message.objects.filter(item=self.wallet)), 0)
+
+        # Deleting takes the still-unread messages off both counters
+        self.assertEqual(delete_conversation(self.phone, self.alice, self.carol), 3)
+        self.assertEqual(self.counters(self.alice), (0, {(self.wallet.id, self.bob.id): 0}))
+        self.assertEqual(self.counters(self.carol), (0, {}))
+        self.assertEqual(reconcile_unread(), 0)
+
+    def test_resent_client_ids_are_counted_once(self):
+        message = Message(sender=self.bob, recipient=self.alice, item=self.wallet, content='once', client_id='b1')
+        create_messages([message])
+        resent = create_messages([
+            Message(sender=self.bob, recipient=self.alice, item=self.wallet, content='once', client_id='b1'),
+        ])
+        self.assertEqual(resent[0].pk, message.pk)
+        self.assertEqual(self.counters(self.alice), (1, {(self.wallet.id, self.bob.id): 1}))
+
+    def test_reconcile_fixes_drift(self):
+        create_message(self.bob, self.alice, self.wallet, 'one')
+        create_message(self.bob, self.alice, self.wallet, 'two')
+        create_message(self.alice, self.bob, self.wallet, 'three')
+        UserProfile.objects.filter(user=self.alice).update(unread_messages=7)
+        Conversation.objects.filter(item=self.wallet).update(unread_a=5, unread_b=0)
+        self.assertEqual(reconcile_unread([self.carol.id]), 0)
+        self.assertEqual(reconcile_unread(), 2)
+        self.assertEqual(self.counters(self.alice), (2, {(self.wallet.id, self.bob.id): 2}))
+        self.assertEqual(self.counters(self.bob), (1, {(self.wallet.id, self.alice.id): 1}))
+        self.assertEqual(reconcile_unread(), 0)
+        # Counters never go below zero, even when they had drifted low
+        UserProfile.objects.filter(user=self.alice).update(unread_messages=0)
+        mark_read(self.alice)
+        self.assertEqual(unread_count(self.alice), 0)
+
+    def test_reconcile_restores_missing_conversations(self):
+        create_message(self.bob, self.alice, self.wallet, 'one')
+        last = create_message(self.alice, self.bob, self.wallet, 'two')
+        create_message(self.carol, self.alice, self.phone, 'three')
+        set_archived(self.phone, self.carol, self.alice, True)
+        # Rows lost to a bad import or a manual delete; the counters still hold their messages
+        Conversation.objects.all().delete()
+
+        self.assertEqual(reconcile_unread([self.bob.id]), 1)
+        self.assertFalse(Conversation.objects.filter(item=self.phone).exists())
+        # Alice's pass restores the phone conversation, so Carol's is already consistent
+        self.assertEqual(reconcile_unread(), 1)
+        self.assertEqual(
+            self.counters(self.alice), (2, {(self.wallet.id, self.bob.id): 1, (self.phone.id, self.carol.id): 1}),
+        )
+        self.assertEqual(self.counters(self.bob), (1, {(self.wallet.id, self.alice.id): 1}))
+        self.assertEqual(self.counters(self.carol), (0, {(self.phone.id, self.alice.id): 0}))
+        self.assertEqual(Conversation.objects.get(item=self.wallet).last_message, last)
+        restored = Conversation.objects.get(item=self.phone)
+        self.assertEqual(restored.last_message.content, 'three')
+        self.assertEqual(restored.last_activity, restored.last_message.timestamp)
+        self.assertTrue(getattr(restored, f'archived_{restored.side(self.carol)}'))
+        self.assertFalse(getattr(restored, f'archived_{restored.side(self.alice)}'))
+        self.assertEqual(reconcile_unread(), 0)
+
+
+class ConversationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='pw')
+        cls.bob = User.objects.create_user('bob', password='pw')
+        category = ItemCategory.objects.create(name='Keys')
+        cls.keys = Item.objects.create(
+            title='Keys', description='Car keys', location='Car park', category=category,
+            status='found', reported_by=cls.alice,
+        )
+
+    def conversation(self):
+        return get_conversation(self.keys, self.alice, self.bob)
+
+    def snapshot(self):
+        return {
+            (c.item_id, c.user_a_id, c.user_b_id): (
+                c.last_message_id, c.unread_a, c.unread_b, c.archived_a, c.archived_b,
+            )
+            for c in Conversation.objects.all()
+        }
+
+    def test_archive_until_a_new_message(self):
+        create_message(self.bob, self.alice, self.keys, 'mine?')
+        self.assertEqual(set_archived(self.keys, self.alice, self.bob, True), 1)
+        conversation = self.conversation()
+        side = conversation.side(self.alice)
+        self.assertTrue(getattr(conversation, f'archived_{side}'))
+        self.assertFalse(getattr(conversation, f'archived_{conversation.side(self.bob)}'))
+        self.assertTrue(Message.objects.get().deleted_by_recipient)
+
+        set_archived(self.keys, self.alice, self.bob, False)
+        self.assertFalse(getattr(self.conversation(), f'archived_{side}'))
+        set_archived(self.keys, self.alice, self.bob, True)
+        set_archived(self.keys, self.bob, self.alice, True)
+
+        # Either side writing again brings it back for both
+        message = create_message(self.alice, self.bob, self.keys, 'yes, come by')
+        conversation = self.conversation()
+        self.assertFalse(conversation.archived_a)
+        self.assertFalse(conversation.archived_b)
+        self.assertEqual(conversation.last_message_id, message.pk)
+        self.assertEqual(conversation.unread_for(self.bob), 1)
+
+    def test_backfill(self):
+        from django.apps import apps
+
+        build_conversations = importlib.import_module('FindIt.migrations.0013_conversation').build_conversations
+        carol = User.objects.create_user('carol', password='pw')
+        create_message(self.bob, self.alice, self.keys, 'one')
+        create_message(self.alice, self.bob, self.keys, 'two')
+        last = create_message(self.bob, self.alice, self.keys, 'three')
+        mark_read(self.bob)
+        create_message(carol, self.alice, self.keys, 'mine too')
+        set_archived(self.keys, carol, self.alice, True)
+        expected = self.snapshot()
+        self.assertEqual(len(expected), 2)
+        self.assertEqual(expected[(self.keys.id, *Conversation.participants(self.alice.id, self.bob.id))][0], last.pk)
+
+        Conversation.objects.all().delete()
+        build_conversations(apps, None)
+        self.assertEqual(self.snapshot(), expected)
+
+
+class MessageWriterTests(TransactionTestCase):
+    """Batching, ordering, dedupe and failures of the write-behind writer"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        self.item = Item.objects.create(
+            title='Umbrella', description='Red umbrella', location='Library',
+            category=ItemCategory.objects.create(name='Umbrellas'), status='found', reported_by=self.alice,
+        )
+        self.room = chat_group(self.item.id, self.alice.id, self.bob.id)
+
+    def pending(self, client_id, sender=None, content='hi', item_id=None):
+        sender = sender or self.alice
+        recipient = self.bob if sender == self.alice else self.alice
+        return PendingMessage(
+            client_id=client_id, sender_id=sender.id, recipient_id=recipient.id,
+            item_id=item_id or self.item.id, content=content, image=None, room=self.room,
+        )
+
+    async def join_room(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(self.room, channel)
+        return lambda: asyncio.wait_for(layer.receive(channel), timeout=1)
+
+    async def test_batches_in_order(self):
+        receive = await self.join_room()
+        writer = MessageWriter(batch_size=3, delay=10)
+        with mock.patch('FindIt.writebehind.write_batch', wraps=write_batch) as spy:
+            for n in range(7):
+                writer.enqueue(self.pending(f'c{n}', content=str(n)))
+            await writer.flush()
+        self.assertEqual([len(call.args[0]) for call in spy.call_args_list], [3, 3, 1])
+        self.assertEqual(len(writer), 0)
+        events = [await receive() for _ in range(7)]
+        self.assertEqual([event['client_id'] for event in events], [f'c{n}' for n in range(7)])
+        ids = [event['message_id'] for event in events]
+        self.assertEqual(ids, sorted(ids))
+        stored = await database_sync_to_async(list)(Message.objects.order_by('id').values_list('content', flat=True))
+        self.assertEqual(stored, [str(n) for n in range(7)])
+
+    async def test_partial_batch_written_after_delay(self):
+        receive = await self.join_room()
+        writer = MessageWriter(batch_size=50, delay=0.01)
+        writer.enqueue(self.pending('c1'))
+        writer.enqueue(self.pending('c2'))
+        events = [await receive() for _ in range(2)]
+        self.assertEqual([event['type'] for event in events], ['chat_message_saved'] * 2)
+        self.assertEqual(len(writer), 0)
+
+    async def test_client_ids_are_per_sender(self):
+        receive = await self.join_room()
+        writer = MessageWriter()
+        writer.enqueue(self.pending('same', sender=self.alice))
+        writer.enqueue(self.pending('same', sender=self.bob))
+        await writer.flush()
+        events = [await receive() for _ in range(2)]
+        self.assertEqual([event['duplicate'] for event in events], [False, False])
+        self.assertNotEqual(events[0]['message_id'], events[1]['message_id'])
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 2)
+
+    async def test_resend_reports_the_stored_copy(self):
+        receive = await self.join_room()
+        writer = MessageWriter()
+        writer.enqueue(self.pending('once'))
+        await writer.flush()
+        first = await receive()
+        self.assertFalse(first['duplicate'])
+        # Resent after a reconnect, and twice within one batch
+        writer.enqueue(self.pending('once'))
+        writer.enqueue(self.pending('twice'))
+        writer.enqueue(self.pending('twice'))
+        await writer.flush()
+        events = [await receive() for _ in range(3)]
+        self.assertEqual(
+            [(event['client_id'], event['duplicate']) for event in events],
+            [('once', True), ('twice', False), ('twice', True)],
+        )
+        self.assertEqual(events[0]['message_id'], first['message_id'])
+        self.assertEqual(events[1]['message_id'], events[2]['message_id'])
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 2)
+
+    async def test_failures_reach_the_room(self):
+        receive = await self.join_room()
+        writer = MessageWriter()
+        # A row that can't be stored doesn't take the rest of its batch down
+        writer.enqueue(self.pending('good'))
+        writer.enqueue(self.pending('orphan', item_id=self.item.id + 1000))
+        writer.enqueue(self.pending('also-good', sender=self.bob))
+        with self.assertLogs('FindIt.writebehind', 'WARNING'):
+            await writer.flush()
+        events = [await receive() for _ in range(3)]
+        self.assertEqual(
+            [(event['type'], event['client_id']) for event in events],
+            [('chat_message_saved', 'good'), ('chat_message_failed', 'orphan'), ('chat_message_saved', 'also-good')],
+        )
+        self.assertEqual(events[1]['sender_id'], self.alice.id)
+
+        failing = mock.patch('FindIt.writebehind.write_batch', side_effect=OperationalError('database is locked'))
+        with failing, self.assertLogs('FindIt.writebehind', 'ERROR'):
+            writer.enqueue(self.pending('lost', sender=self.bob))
+            await writer.flush()
+        event = await receive()
+        self.assertEqual(
+            (event['type'], event['client_id'], event['sender_id']), ('chat_message_failed', 'lost', self.bob.id),
+        )
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_token_bucket_burst_and_refill(self):
+        with mock.patch('FindIt.ratelimit.time.monotonic', return_value=100.0) as clock:
+            bucket = TokenBucket(rate=2, burst=3)
+            self.assertEqual([bucket.take() for _ in range(3)], [0, 0, 0])
+            self.assertEqual(bucket.take(), 0.5)
+            clock.return_value = 100.25
+            self.assertEqual(bucket.take(), 0.25)
+            clock.return_value = 100.5
+            self.assertEqual(bucket.take(), 0)
+            # Idle time refills up to the burst, no further
+            clock.return_value = 200.0
+            self.assertEqual([bucket.take() for _ in range(3)], [0, 0, 0])
+            self.assertGreater(bucket.take(), 0)
+            # Costlier than a full bucket: the wait covers the difference
+            clock.return_value = 300.0
+            self.assertEqual(bucket.take(5), 1.0)
+
+    async def test_take_shared_sliding_window(self):
+        with mock.patch('FindIt.ratelimit.time.time', return_value=6000.0) as clock:
+            self.assertEqual([await take_shared('user:1', 3, 60) for _ in range(3)], [0, 0, 0])
+            # Over the limit within the window: wait for the window to end
+            self.assertEqual(await take_shared('user:1', 3, 60), 60)
+            clock.return_value = 6030.0
+            self.assertEqual(await take_shared('user:1', 3, 60), 30)
+            # Other keys have their own budget
+            self.assertEqual(await take_shared('user:2', 3, 60), 0)
+
+            # Half of the last window (5 attempts, refused ones too) still counts
+            clock.return_value = 6090.0
+            self.assertEqual(await take_shared('user:1', 3, 60), 6.0)
+            # Two windows on, the old attempts are gone
+            clock.return_value = 6180.0
+            self.assertEqual(await take_shared('user:1', 3, 60), 0)
+
+    def test_per_process_cache_warning(self):
+        redis_layer = {'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer'}}
+        memory_layer = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        redis = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://'}}
+        with override_settings(CHANNEL_LAYERS=redis_layer, CACHES=locmem):
+            self.assertEqual([warning.id for warning in check_shared_cache(None)], ['FindIt.W001'])
+        with override_settings(CHANNEL_LAYERS=redis_layer, CACHES=redis):
+            self.assertEqual(check_shared_cache(None), [])
+        with override_settings(CHANNEL_LAYERS=memory_layer, CACHES=locmem):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+def png_bytes(size=(32, 24), color=(200, 30, 30)):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class ChatUploadTests(TestCase):
+    def setUp(self):
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.parts = os.path.join(temp.name, 'parts')
+        settings_override = override_settings(
+            CHAT_UPLOAD_TEMP_DIR=self.parts, MEDIA_ROOT=os.path.join(temp.name, 'media'), THUMBNAILS_ASYNC=False,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def part_files(self):
+        return sorted(os.listdir(self.parts)) if os.path.isdir(self.parts) else []
+
+    def test_start_validates_id_and_size(self):
+        for upload_id, size in (('bad id', 10), ('', 10), ('a' * 65, 10), ('ok', 0), ('ok', -1),
+                                ('ok', True), ('ok', '10'), ('ok', 1.5), ('ok', None)):
+            with self.assertRaises(UploadError) as raised:
+                start_upload(1, upload_id, size, 100)
+            self.assertEqual(raised.exception.reason, 'invalid', (upload_id, size))
+        with self.assertRaises(UploadError) as raised:
+            start_upload(1, 'ok', 101, 100)
+        self.assertEqual(raised.exception.reason, 'too_large')
+        self.assertEqual(start_upload(1, 'ok', 100, 100).received, 0)
+
+    def test_chunks_in_order_and_resume(self):
+        frame = bytes([2]) + b'u1' + (3).to_bytes(8, 'big') + b'data'
+        upload_id, offset, data = parse_chunk(frame)
+        self.assertEqual((upload_id, offset, bytes(data)), ('u1', 3, b'data'))
+        with self.assertRaises(UploadError):
+            parse_chunk(bytes([9]) + b'u1' + bytes(8))
+
+        upload = start_upload(1, 'u1', 10, 100)
+        self.assertEqual(write_chunk(upload, 0, b'abcd'), 4)
+        # Repeated or skipped offsets are dropped and answered with the expected one
+        self.assertEqual(write_chunk(upload, 0, b'abcd'), 4)
+        self.assertEqual(write_chunk(upload, 8, b'ij'), 4)
+        self.assertEqual(upload.path.read_bytes(), b'abcd')
+
+        # A reconnecting client continues where the part file ends
+        resumed = start_upload(1, 'u1', 10, 100)
+        self.assertTrue(resumed.resumed)
+        self.assertEqual(resumed.received, 4)
+        self.assertEqual(write_chunk(resumed, 4, b'efghij'), 10)
+        self.assertTrue(resumed.complete)
+        self.assertEqual(resumed.path.read_bytes(), b'abcdefghij')
+        # Another user's upload of the same id, or a different size, starts over
+        self.assertFalse(start_upload(2, 'u1', 10, 100).resumed)
+        restarted = start_upload(1, 'u1', 12, 100)
+        self.assertEqual((restarted.resumed, restarted.received), (False, 0))
+
+    def test_overrun_discards_the_part_file(self):
+        upload = start_upload(1, 'u2', 4, 100)
+        write_chunk(upload, 0, b'ab')
+        with self.assertRaises(UploadError) as raised:
+            write_chunk(upload, 2, b'cde')
+        self.assertEqual(raised.exception.reason, 'too_large')
+        self.assertEqual(self.part_files(), [])
+
+    def test_finish_stores_the_image_and_cleans_up(self):
+        content = png_bytes()
+        upload = start_upload(1, 'u3', len(content), 10_000)
+        write_chunk(upload, 0, content)
+        image = finish_upload(upload)
+        self.assertTrue(image.name.startswith('chat_images/'))
+        self.assertEqual((image.width, image.height), (32, 24))
+        self.assertTrue(media_storage().exists(image.name))
+        self.assertEqual(self.part_files(), [])
+
+        upload = start_upload(1, 'u4', 9, 10_000)
+        write_chunk(upload, 0, b'not a png')
+        with self.assertRaises(UploadError) as raised:
+            finish_upload(upload)
+        self.assertEqual(raised.exception.reason, 'invalid_image')
+        self.assertEqual(self.part_files(), [])
+
+
+class PresenceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.layer = get_channel_layer()
+        # Each test starts as a fresh set of workers
+        self.workers = {}
+        grace = mock.patch('FindIt.presence.OFFLINE_GRACE', 0)
+        grace.start()
+        self.addCleanup(grace.stop)
+
+    def on_worker(self, name):
+        """Patches making presence act as worker ``name``, with its own sockets"""
+        sockets = self.workers.setdefault(name, Counter())
+        return mock.patch.multiple(presence, worker_id=mock.Mock(return_value=name), _local_sockets=sockets)
+
+    async def watch(self, user_id):
+        channel = await self.layer.new_channel()
+        await self.layer.group_add(presence.presence_group(user_id), channel)
+
+        async def announced():
+            try:
+                event = await asyncio.wait_for(self.layer.receive(channel), timeout=0.2)
+            except asyncio.TimeoutError:
+                return None
+            return event['presence']['online']
+        return announced
+
+    async def test_online_and_offline_transitions(self):
+        announced = await self.watch(1)
+        with self.on_worker('w1'):
+            first = await presence.join(self.layer, 1)
+            self.assertIs(await announced(), True)
+            second = await presence.join(self.layer, 1)
+            await presence.leave(self.layer, 1, first)
+            self.assertIsNone(await announced())
+            self.assertTrue((await presence.get_presence(1))['online'])
+
+            await presence.leave(self.layer, 1, second)
+            self.assertIs(await announced(), False)
+        state = await presence.get_presence(1)
+        self.assertFalse(state['online'])
+        self.assertIsNotNone(state['last_seen'])
+
+    async def test_other_workers_keep_the_user_online(self):
+        announced = await self.watch(1)
+        with self.on_worker('w1'):
+            on_w1 = await presence.join(self.layer, 1)
+        self.assertIs(await announced(), True)
+        with self.on_worker('w2'):
+            on_w2 = await presence.join(self.layer, 1)
+            await presence.leave(self.layer, 1, on_w2)
+        self.assertIsNone(await announced())
+        self.assertTrue(await presence.is_online(1))
+        with self.on_worker('w1'):
+            await presence.leave(self.layer, 1, on_w1)
+        self.assertIs(await announced(), False)
+
+    async def test_crashed_worker_stops_counting(self):
+        with self.on_worker('w1'):
+            on_w1 = await presence.join(self.layer, 1)
+        with self.on_worker('w2'):
+            await presence.join(self.layer, 1)
+        # w2 dies without leaving: its key lapses while w1's heartbeats go on
+        await cache.adelete('findit:online:1:w2')
+        with self.on_worker('w1'):
+            self.assertFalse(await presence._refresh(1))
+            self.assertEqual(await cache.aget('findit:online:1'), ['w1'])
+            announced = await self.watch(1)
+            await presence.leave(self.layer, 1, on_w1)
+        self.assertIs(await announced(), False)
+        self.assertFalse(await presence.is_online(1))
+
+    async def test_heartbeat_relists_a_dropped_worker(self):
+        with self.on_worker('w1'):
+            heartbeat = await presence.join(self.layer, 1)
+        # Another worker's concurrent rewrite of the list lost w1
+        await cache.aset('findit:online:1', ['w2'])
+        self.assertFalse(await presence.is_online(1))
+        with self.on_worker('w1'):
+            self.assertTrue(await presence._refresh(1))
+            self.assertTrue(await presence.is_online(1))
+            await presence.leave(self.layer, 1, heartbeat)
+
+    async def test_typing_throttle_coalesces_keystrokes(self):
+        sent = []
+
+        async def send(typing):
+            sent.append(typing)
+
+        throttle = presence.TypingThrottle(send, throttle=0.1, timeout=0.15)
+        for _ in range(10):
+            await throttle.keystroke()
+        self.assertEqual(sent, [True])
+        await asyncio.sleep(0.11)
+        await throttle.keystroke()
+        self.assertEqual(sent, [True, True])
+        # Quiet for the timeout: one stop
+        await asyncio.sleep(0.2)
+        self.assertEqual(sent, [True, True, False])
+
+        # Stopping is a no-op unless typing was announced
+        await throttle.stop()
+        self.assertEqual(sent, [True, True, False])
+        await throttle.keystroke()
+        await throttle.stop()
+        self.assertEqual(sent, [True, True, False, True, False])
+        await asyncio.sleep(0.2)
+        self.assertEqual(len(sent), 5)
+
+
+class MetricsViewTests(TestCase):
+    def get(self, **extra):
+        return self.client.get(reverse('metrics'), **extra)
+
+    @override_settings(METRICS_TOKEN='s3cret', DEBUG=False)
+    def test_token_required(self):
+        response = self.get(HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        # A request relayed by a reverse proxy on the same host
+        self.assertEqual(self.get(REMOTE_ADDR='127.0.0.1', HTTP_X_FORWARDED_FOR='203.0.113.9').status_code, 403)
+
+    @override_settings(METRICS_TOKEN='', DEBUG=False)
+    def test_hidden_without_a_token(self):
+        self.assertEqual(self.get(REMOTE_ADDR='127.0.0.1', HTTP_X_FORWARDED_FOR='203.0.113.9').status_code, 404)
+        self.assertEqual(self.get(REMOTE_ADDR='127.0.0.1').status_code, 404)
+
+    @override_settings(METRICS_TOKEN='', DEBUG=True, INTERNAL_IPS=['127.0.0.1'])
+    def test_internal_ips_while_debugging(self):
+        self.assertEqual(self.get(REMOTE_ADDR='127.0.0.1').status_code, 200)
+        self.assertEqual(self.get(REMOTE_ADDR='203.0.113.9').status_code, 404)
+
+
+def image_bytes(size, format='JPEG', mode='RGB', orientation=None, **save_options):
+    """An image file's bytes; a left-to-right gradient, so orientation is visible"""
+    from PIL import Image
+
+    image = Image.linear_gradient('L').rotate(90).resize(size).convert(mode)
+    if orientation is not None:
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        save_options['exif'] = exif
+    buffer = io.BytesIO()
+    image.save(buffer, format, **save_options)
+    return buffer.getvalue()
+
+
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        from django.core.files.storage import FileSystemStorage
+
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.storage = FileSystemStorage(location=temp.name, base_url='/media/')
+        cache.clear()
+
+    def store(self, name, content):
+        from django.core.files.base import ContentFile
+
+        return self.storage.save(name, ContentFile(content))
+
+    def open_thumbnail(self, name, width):
+        from PIL import Image
+
+        with self.storage.open(thumbnails.thumbnail_name(name, width), 'rb') as fh, Image.open(fh) as image:
+            return image.format, image.size
+
+    def test_names(self):
+        self.assertEqual(thumbnails.thumbnail_name('item_photos/bike.png', 480), 'item_photos/thumbs/480/bike.png')
+        self.assertEqual(thumbnails.thumbnail_name('chat_images/a.gif', 160), 'chat_images/thumbs/160/a.jpg')
+        self.assertEqual(thumbnails.thumbnail_source('chat_images/thumbs/160/a.jpg'), ('chat_images', 'a'))
+        self.assertIsNone(thumbnails.thumbnail_source('chat_images/a.jpg'))
+        self.assertIsNone(thumbnails.thumbnail_source('chat_images/thumbs/big/a.jpg'))
+
+    @override_settings(THUMBNAIL_SIZES=(480, 160, 1200))
+    def test_one_thumbnail_per_narrower_size(self):
+        name = self.store('item_photos/wide.jpg', image_bytes((1300, 400)))
+        self.assertEqual(thumbnails.make_thumbnails(name, self.storage), ([160, 480, 1200], 1300))
+        self.assertEqual(self.open_thumbnail(name, 160), ('JPEG', (160, 49)))
+        self.assertEqual(self.open_thumbnail(name, 1200), ('JPEG', (1200, 369)))
+
+        small = self.store('item_photos/small.png', image_bytes((300, 300), 'PNG', 'RGBA'))
+        self.assertEqual(thumbnails.make_thumbnails(small, self.storage), ([160], 300))
+        self.assertEqual(self.open_thumbnail(small, 160), ('PNG', (160, 160)))
+        self.assertFalse(self.storage.exists(thumbnails.thumbnail_name(small, 480)))
+
+    @override_settings(THUMBNAIL_SIZES=(160, 480))
+    def test_exif_rotation(self):
+        # Stored landscape, shown portrait: only as wide as its short side
+        name = self.store('chat_images/turned.jpg', image_bytes((600, 300), orientation=6))
+        self.assertEqual(thumbnails.make_thumbnails(name, self.storage), ([160], 300))
+        self.assertEqual(self.open_thumbnail(name, 160), ('JPEG', (160, 320)))
+        self.assertEqual(thumbnails.available(name, self.storage), ([160], 300))
+
+    @override_settings(THUMBNAIL_SIZES=(160, 480))
+    def test_available_falls_back_to_the_original(self):
+        from django.db.models.fields.files import FieldFile
+        from .models import Item
+
+        name = self.store('item_photos/photo.jpg', image_bytes((600, 400)))
+        fieldfile = FieldFile(None, Item._meta.get_field('photo'), name)
+        fieldfile.storage = self.storage
+        # Before the thumbnails exist: the original, no srcset
+        self.assertEqual(thumbnails.available(name, self.storage), ([], 600))
+        self.assertEqual(thumbnails.srcset(fieldfile), (self.storage.url(name), ''))
+        self.assertEqual(thumbnails.thumbnail_url(fieldfile, 200), self.storage.url(name))
+
+        # The pending answer is cached only briefly; generate() replaces it
+        thumbnails.remember(name, *thumbnails.make_thumbnails(name, self.storage))
+        self.assertEqual(thumbnails.available(name, self.storage), ([160, 480], 600))
+        src, srcset = thumbnails.srcset(fieldfile)
+        self.assertEqual(src, self.storage.url(thumbnails.thumbnail_name(name, 480)))
+        self.assertEqual(srcset.count('w, '), 2)
+        self.assertTrue(srcset.endswith(f'{self.storage.url(name)} 600w'))
+        self.assertEqual(thumbnails.thumbnail_url(fieldfile, 200), src)
+
+        # Unreadable originals report no width rather than failing the page
+        broken = self.store('item_photos/broken.jpg', b'not an image')
+        self.assertEqual(thumbnails.available(broken, self.storage), ([], None))
+        thumbnails.delete_thumbnails(name, self.storage)
+        self.assertEqual(thumbnails.available(name, self.storage), ([], 600))
+
+
+class ImageIngestTests(TestCase):
+    def normalize(self, content, kind='chat_images', name='IMG_0001.JPG'):
+        from django.core.files.base import ContentFile
+
+        return normalize(ContentFile(content, name=name), kind)
+
+    def decode(self, normalized):
+        from PIL import Image
+
+        normalized.seek(0)
+        image = Image.open(io.BytesIO(normalized.read()))
+        image.load()
+        return image
+
+    def test_metadata_stripped_and_orientation_applied(self):
+        from PIL import ImageCms
+
+        icc = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        # Stored landscape with a dark left edge; EXIF says to turn it a quarter clockwise
+        content = image_bytes((600, 300), orientation=6, icc_profile=icc, comment=b'shot at home')
+        normalized = self.normalize(content)
+        self.assertEqual((normalized.width, normalized.height), (300, 600))
+        image = self.decode(normalized)
+        self.assertEqual(image.size, (300, 600))
+        self.assertEqual(dict(image.getexif()), {})
+        self.assertNotIn('comment', image.info)
+        self.assertEqual(image.info.get('icc_profile'), icc)
+        # The dark edge is now on top
+        self.assertLess(image.convert('L').getpixel((150, 5)), image.convert('L').getpixel((150, 594)))
+        self.assertEqual(normalized.name, 'IMG_0001' + os.path.splitext(normalized.name)[1])
+
+    @override_settings(IMAGE_BUDGETS={'chat_images': {'max_side': 500}})
+    def test_fitted_within_max_side(self):
+        normalized = self.normalize(image_bytes((2000, 800)))
+        self.assertEqual((normalized.width, normalized.height), (500, 200))
+        self.assertIsNone(normalized.dhash)
+        self.assertIsNotNone(self.normalize(image_bytes((200, 80)), kind='item_photos').dhash)
+
+    def test_rejections(self):
+        with self.assertRaisesMessage(ImageRejected, 'not an image'):
+            self.normalize(b'GIF89a but not really')
+        with mock.patch('FindIt.ingest.MAX_PIXELS', 100 * 100 - 1):
+            with self.assertRaisesMessage(ImageRejected, 'too many pixels'):
+                self.normalize(image_bytes((100, 100)))
+            self.normalize(image_bytes((99, 100)))
+        with override_settings(IMAGE_BUDGETS={'chat_images': {'max_bytes': 100}}):
+            with self.assertRaisesMessage(ImageRejected, 'larger than'):
+                self.normalize(image_bytes((100, 100)))
+
+    def test_output_format(self):
+        from PIL import Image, features
+
+        opaque = image_bytes((64, 64), 'PNG')
+        buffer = io.BytesIO()
+        Image.new('RGBA', (64, 64), (255, 0, 0, 128)).save(buffer, 'PNG')
+        transparent = buffer.getvalue()
+        if features.check('webp'):
+            self.assertEqual(self.decode(self.normalize(opaque)).format, 'WEBP')
+            webp = self.decode(self.normalize(transparent))
+            self.assertEqual((webp.format, webp.mode), ('WEBP', 'RGBA'))
+        with mock.patch('PIL.features.check', return_value=False):
+            jpeg = self.normalize(opaque)
+            png = self.normalize(transparent)
+        self.assertTrue(jpeg.name.endswith('.jpg'))
+        self.assertEqual(self.decode(jpeg).format, 'JPEG')
+        self.assertTrue(png.name.endswith('.png'))
+        self.assertEqual((self.decode(png).format, self.decode(png).mode), ('PNG', 'RGBA'))
+
+
+class MediaReferenceTests(TransactionTestCase):
+    """MediaBlob reference counts, including the saves and messages that fail"""
+
+    def setUp(self):
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=temp.name, THUMBNAILS_ASYNC=False)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        self.item = Item.objects.create(
+            title='Scarf', description='Green scarf', location='Hall',
+            category=ItemCategory.objects.create(name='Clothing'), status='found', reported_by=self.alice,
+        )
+
+    def refs(self, name):
+        return MediaBlob.objects.filter(name=name).values_list('refs', flat=True).first()
+
+    def message(self, content, **kwargs):
+        from django.core.files.base import ContentFile
+
+        return Message(
+            sender=self.alice, recipient=self.bob, item=self.item,
+            image=ContentFile(content, name='photo.png'), **kwargs,
+        )
+
+    def test_shared_until_the_last_owner_goes(self):
+        content = png_bytes()
+        first = self.message(content)
+        first.save()
+        second = self.message(content)
+        second.save()
+        name = first.image.name
+        self.assertEqual(second.image.name, name)
+        self.assertTrue(is_immutable(name))
+        self.assertEqual(self.refs(name), 2)
+        self.assertEqual(len(os.listdir(os.path.dirname(media_storage().path(name)))), 1)
+
+        first.delete()
+        self.assertEqual(self.refs(name), 1)
+        self.assertTrue(media_storage().exists(name))
+        second.delete()
+        self.assertIsNone(self.refs(name))
+        self.assertFalse(media_storage().exists(name))
+
+    def test_failed_save_releases_its_file(self):
+        content = png_bytes()
+        kept = self.message(content, client_id='taken')
+        kept.save()
+        name = kept.image.name
+        # The file is stored, then the row clashes with the first
+        with self.assertRaises(IntegrityError):
+            self.message(content, client_id='taken').save()
+        self.assertEqual(self.refs(name), 1)
+        other = self.message(png_bytes(color=(0, 0, 255)), client_id='taken')
+        with self.assertRaises(IntegrityError):
+            other.save()
+        self.assertIsNone(self.refs(other.image.name))
+        self.assertFalse(media_storage().exists(other.image.name))
+
+        # Inside a transaction that rolls back, the reference goes with it
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self.message(content, client_id='taken').save()
+        self.assertEqual(self.refs(name), 1)
+
+    def test_duplicate_and_dropped_chat_images_are_released(self):
+        from django.core.files.base import ContentFile
+
+        def upload(content):
+            name = media_storage().save('chat_images/image.png', ContentFile(content))
+            return StoredImage(name, 32, 24)
+
+        def pending(client_id, image, item_id=None):
+            return PendingMessage(
+                client_id=client_id, sender_id=self.alice.id, recipient_id=self.bob.id,
+                item_id=item_id or self.item.id, content='', image=image, room='room',
+            )
+
+        shared = png_bytes()
+        saved = write_batch([pending('a', upload(shared)), pending('a', upload(shared))])
+        self.assertEqual(list(saved.values()), [(Message.objects.get().pk, False)])
+        name = Message.objects.get().image.name
+        self.assertEqual(self.refs(name), 1)
+        # Resent after the first copy was stored
+        write_batch([pending('a', upload(shared))])
+        self.assertEqual(self.refs(name), 1)
+
+        orphan = upload(png_bytes(color=(0, 0, 255)))
+        with self.assertLogs('FindIt.writebehind', 'WARNING'):
+            self.assertEqual(write_batch([pending('b', orphan, item_id=self.item.id + 1000)]), {})
+        self.assertIsNone(self.refs(orphan.name))
+        self.assertFalse(media_storage().exists(orphan.name))
+
+
+class MediaServeTests(TestCase):
+    def setUp(self):
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import default_storage
+
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=temp.name, MEDIA_SENDFILE='')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        self.carol = User.objects.create_user('carol', password='pw')
+        self.item = Item.objects.create(
+            title='Bottle', description='Steel bottle', location='Gym',
+            category=ItemCategory.objects.create(name='Bottles'), status='found', reported_by=self.alice,
+        )
+        self.content = png_bytes((64, 48))
+        self.message = Message.objects.create(
+            sender=self.alice, recipient=self.bob, item=self.item,
+            image=ContentFile(self.content, name='photo.png'),
+        )
+        self.name = self.message.image.name
+        self.thumb = thumbnails.thumbnail_name(self.name, 160)
+        # Thumbnails keep the name derived from their original
+        self.assertEqual(default_storage.save(self.thumb, ContentFile(b'thumbnail')), self.thumb)
+
+    def get(self, name, user=None, **headers):
+        if user is None:
+            self.client.logout()
+        else:
+            self.client.force_login(user)
+        response = self.client.get(settings.MEDIA_URL + name, headers=headers)
+        self.addCleanup(response.close)
+        return response
+
+    def body(self, response):
+        return b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_chat_images_only_for_their_conversation(self):
+        for name in (self.name, self.thumb):
+            self.assertEqual(self.get(name).status_code, 404)
+            self.assertEqual(self.get(name, self.carol).status_code, 404)
+            for user in (self.alice, self.bob):
+                response = self.get(name, user)
+                self.assertEqual(response.status_code, 200, (name, user))
+                self.assertIn('private', response['Cache-Control'])
+        response = self.get(self.name, self.alice)
+        self.assertEqual(self.body(response), self.content)
+        self.assertIn('immutable', response['Cache-Control'])
+
+        # Clearing the conversation takes the sender's access with it
+        Message.objects.filter(pk=self.message.pk).update(deleted_by_sender=True)
+        self.assertEqual(self.get(self.name, self.alice).status_code, 404)
+        self.assertEqual(self.get(self.name, self.bob).status_code, 200)
+
+    def test_only_canonical_names(self):
+        from django.test import RequestFactory
+
+        factory = RequestFactory()
+        for path in (f'item_photos/../{self.name}', f'./{self.name}', f'{self.name}/', 'chat_images//x.png',
+                     'chat_images/.incoming-abc', '.env', 'item_photos/thumbs/.hidden/a.jpg'):
+            request = factory.get('/media/' + path)
+            request.user = self.alice
+            with self.assertRaises(Http404, msg=path):
+                serve_media(request, path)
+        self.assertEqual(self.get('item_photos/missing.jpg').status_code, 404)
+        self.assertEqual(self.get('chat_images', self.alice).status_code, 404)
+
+    def test_conditional_request(self):
+        response = self.get(self.name, self.bob)
+        etag = response['ETag']
+        cached = self.get(self.name, self.bob, if_none_match=etag)
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached['ETag'], etag)
+        self.assertEqual(self.body(cached), b'')
+        self.assertEqual(self.get(self.name, self.bob, if_none_match='"stale"').status_code, 200)
+        # Checked after permissions: a 304 would confirm the file exists
+        self.assertEqual(self.get(self.name, self.carol, if_none_match=etag).status_code, 404)
+
+    def test_byte_ranges(self):
+        size = len(self.content)
+        response = self.get(self.name, self.bob, range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{size}')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(self.body(response), self.content[10:20])
+
+        response = self.get(self.name, self.bob, range='bytes=-5')
+        self.assertEqual(response['Content-Range'], f'bytes {size - 5}-{size - 1}/{size}')
+        self.assertEqual(self.body(response), self.content[-5:])
+        response = self.get(self.name, self.bob, range=f'bytes=5-{size * 2}')
+        self.assertEqual(response['Content-Range'], f'bytes 5-{size - 1}/{size}')
+
+        response = self.get(self.name, self.bob, range=f'bytes={size}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{size}')
+        # A stale If-Range gets the whole file
+        response = self.get(self.name, self.bob, range='bytes=0-9', if_range='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+
+    def test_sendfile(self):
+        with override_settings(MEDIA_SENDFILE='x-accel-redirect'):
+            response = self.get(self.name, self.bob)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.name)
+            self.assertEqual(self.body(response), b'')
+            self.assertEqual(self.get(self.name, self.carol).status_code, 404)
+        with override_settings(MEDIA_SENDFILE='x-sendfile'):
+            response = self.get(self.name, self.bob)
+            self.assertEqual(response['X-Sendfile'], media_storage().path(self.name))
+
+
+def noise_bytes(seed, size=(96, 64)):
+    """A PNG of random grey pixels; unrelated seeds hash far apart"""
+    import random
+    from PIL import Image
+
+    rng = random.Random(seed)
+    image = Image.new('L', size)
+    image.putdata([rng.randrange(256) for _ in range(size[0] * size[1])])
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class VisualSimilarityTests(TestCase):
+    BASE = 0x0F0F_0F0F_0F0F_0F0F
+
+    def setUp(self):
+        cache.clear()
+        local = mock.patch.dict(visual._local, {'tree': None, 'version': None, 'max_id': 0, 'checked': 0.0})
+        local.start()
+        self.addCleanup(local.stop)
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.category = ItemCategory.objects.create(name='Headphones')
+
+    def make_item(self, value, **kwargs):
+        item = Item.objects.create(
+            title='Headphones', description='', location='Library', category=self.category,
+            status='found', reported_by=self.alice, **kwargs,
+        )
+        # Straight to the column: the pre_save hook only hashes new uploads
+        Item.objects.filter(pk=item.pk).update(photo_hash=None if value is None else visual.to_signed(value))
+        item.refresh_from_db()
+        return item
+
+    def test_bk_tree_matches_a_linear_scan(self):
+        import random
+
+        rng = random.Random(7)
+        values = [rng.getrandbits(64) for _ in range(300)]
+        # Near copies and exact duplicates
+        values += [values[0] ^ (1 << bit) for bit in range(0, 64, 9)] + [values[1], values[1]]
+        tree = visual.BKTree()
+        for item_id, value in enumerate(values):
+            tree.add(value, item_id)
+        self.assertEqual(tree.size, len(values))
+        for query in values[:20] + [rng.getrandbits(64) for _ in range(20)]:
+            for radius in (0, 3, 10, 20):
+                expected = sorted(
+                    (visual.distance(query, value), item_id) for item_id, value in enumerate(values)
+                    if visual.distance(query, value) <= radius
+                )
+                self.assertEqual(sorted(tree.search(query, radius)), expected)
+        self.assertEqual(visual.BKTree().search(self.BASE, 64), [])
+
+    def test_signed_column_round_trip(self):
+        for value, signed in ((0, 0), (2 ** 63 - 1, 2 ** 63 - 1), (2 ** 63, -2 ** 63), (2 ** 64 - 1, -1)):
+            self.assertEqual(visual.to_signed(value), signed)
+            self.assertEqual(visual.to_unsigned(signed), value)
+        # Stored and read back through the BigIntegerField
+        item = self.make_item(2 ** 63 + 5)
+        self.assertEqual(visual.to_unsigned(item.photo_hash), 2 ** 63 + 5)
+
+    def test_uninformative_hashes_are_skipped(self):
+        for value in (0, 2 ** 64 - 1, 0b111, (2 ** 64 - 1) ^ 0b111):
+            self.assertFalse(visual.is_informative(value), hex(value))
+        self.assertTrue(visual.is_informative(0b1111))
+        blank = self.make_item(0)
+        also_blank = self.make_item(1)
+        self.make_item(self.BASE)
+        self.assertEqual(visual.get_index().size, 1)
+        self.assertEqual(visual.similar_items(blank), [])
+        self.assertEqual(visual.similar_items(also_blank), [])
+
+    def test_only_other_listed_items_nearest_first(self):
+        item = self.make_item(self.BASE)
+        twin = self.make_item(self.BASE)
+        near = self.make_item(self.BASE ^ 0b111)
+        self.make_item(self.BASE ^ 0xFFFF)
+        self.make_item(self.BASE ^ 0b1, state=Item.STATE_RECOVERED)
+        self.make_item(self.BASE ^ 0b1, state=Item.STATE_EXPIRED)
+        pending = self.make_item(self.BASE ^ 0b11, state=Item.STATE_PENDING_RETURN)
+        self.make_item(None)
+
+        similar = visual.similar_items(item)
+        self.assertEqual([candidate.pk for candidate in similar], [twin.pk, pending.pk, near.pk])
+        self.assertEqual([candidate.photo_distance for candidate in similar], [0, 2, 3])
+        self.assertEqual(similar[0].photo_similarity, 100)
+        self.assertEqual([candidate.pk for candidate in visual.similar_items(item, limit=1)], [twin.pk])
+        self.assertEqual(visual.similar_items(self.make_item(None)), [])
+
+    def test_replaced_photo_rebuilds_the_index(self):
+        from django.core.files.base import ContentFile
+
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        with override_settings(MEDIA_ROOT=temp.name, THUMBNAILS_ASYNC=False):
+            item = self.make_item(None)
+            item.photo = normalize(ContentFile(noise_bytes(1), name='one.png'), 'item_photos')
+            with self.captureOnCommitCallbacks(execute=True):
+                item.save()
+            first = visual.to_unsigned(item.photo_hash)
+            other = self.make_item(first)
+            self.assertEqual([candidate.pk for candidate in visual.similar_items(other)], [item.pk])
+            version = cache.get(visual.VERSION_KEY)
+
+            item.photo = normalize(ContentFile(noise_bytes(2), name='two.png'), 'item_photos')
+            with self.captureOnCommitCallbacks(execute=True):
+                item.save()
+            second = visual.to_unsigned(item.photo_hash)
+            self.assertGreater(visual.distance(first, second), visual.MAX_DISTANCE)
+            self.assertEqual(cache.get(visual.VERSION_KEY), version + 1)
+            # Rebuilt at once, not after REFRESH_SECONDS: the item is found under its new hash only
+            self.assertEqual(visual.get_index().search(second, 0), [(0, item.pk)])
+            self.assertNotIn((0, item.pk), visual.get_index().search(first, 0))
+            self.assertEqual(visual.similar_items(other), [])
+
+            # Removing the photo drops the hash as well
+            item.photo = None
+            with self.captureOnCommitCallbacks(execute=True):
+                item.save()
+            self.assertIsNone(item.photo_hash)
+            self.assertEqual(cache.get(visual.VERSION_KEY), version + 2)
+
+
+class FacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        local = mock.patch.dict(facets._local, {'version': None, 'checked': 0.0, 'categories': ()})
+        local.start()
+        self.addCleanup(local.stop)
+        self.alice = User.objects.create_user('alice', password='pw')
+
+    def recheck(self):
+        """As if LOCAL_TTL had passed"""
+        facets._local['checked'] = 0.0
+        return [category.name for category in facets.get_categories()]
+
+    def test_categories_cached_in_id_order(self):
+        bags = ItemCategory.objects.create(name='Bags')
+        ItemCategory.objects.create(name='Audio')
+        self.assertEqual(list(facets.get_categories()), sorted(ItemCategory.objects.all(), key=lambda c: c.id))
+        with self.assertNumQueries(0):
+            facets.get_categories()
+            # A process whose local copy lapsed reads the shared cache
+            self.assertEqual(self.recheck(), ['Bags', 'Audio'])
+        self.assertEqual(facets.get_categories()[0], bags)
+
+    def test_edits_reach_the_next_call_after_commit(self):
+        self.assertEqual(self.recheck(), [])
+        with self.captureOnCommitCallbacks() as callbacks:
+            keys = ItemCategory.objects.create(name='Keys')
+            # Not before the transaction commits, or another worker could cache the old list
+            self.assertEqual(self.recheck(), [])
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.recheck(), ['Keys'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            keys.name = 'Keyrings'
+            keys.save()
+        self.assertEqual(self.recheck(), ['Keyrings'])
+        with self.captureOnCommitCallbacks(execute=True):
+            ItemCategory.objects.create(name='Wallets')
+            keys.delete()
+        self.assertEqual(self.recheck(), ['Wallets'])
+
+    def make_items(self):
+        phones = ItemCategory.objects.create(name='Phones')
+        bags = ItemCategory.objects.create(name='Bags')
+        for category, status, state in (
+            (phones, 'lost', Item.STATE_ACTIVE),
+            (phones, 'found', Item.STATE_ACTIVE),
+            (phones, 'found', Item.STATE_PENDING_RETURN),
+            (bags, 'lost', Item.STATE_ACTIVE),
+            (bags, 'lost', Item.STATE_RECOVERED),
+            (bags, 'found', Item.STATE_EXPIRED),
+        ):
+            item = Item.objects.create(
+                title='Thing', description='', location='Campus', category=category,
+                status=status, reported_by=self.alice,
+            )
+            Item.objects.filter(pk=item.pk).update(state=state)
+        return phones, bags
+
+    def test_facet_counts_listed_items_only(self):
+        phones, bags = self.make_items()
+        self.assertEqual(facets.facet_counts(), {
+            'category': {phones.id: 3, bags.id: 1},
+            'status': {'lost': 2, 'found': 2},
+            'total': 4,
+        })
+        with self.assertNumQueries(0):
+            facets.facet_counts()
+        # Saving an item clears them once it commits
+        with self.captureOnCommitCallbacks(execute=True):
+            Item.objects.create(
+                title='Thing', description='', location='Campus', category=bags, status='found', reported_by=self.alice,
+            )
+        self.assertEqual(facets.facet_counts()['category'][bags.id], 2)
+
+    def test_item_list_shows_the_counts(self):
+        phones, bags = self.make_items()
+        response = self.client.get(reverse('item_list'))
+        self.assertContains(response, 'All Categories (4)')
+        self.assertContains(response, 'Phones (3)')
+        self.assertContains(response, 'Bags (1)')
+        self.assertContains(response, 'Lost (2)')
+        self.assertContains(response, 'Found (2)')
+
+
+class ChatReplayTests(ChatSocketMixin, TransactionTestCase):
+    """Catching up after a reconnect: {"type": "resume", "after": <newest id seen>}"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        self.carol = User.objects.create_user('carol', password='pw')
+        category = ItemCategory.objects.create(name='Bikes')
+        self.item = Item.objects.create(
+            title='Bike', description='Blue bike', location='Rack', category=category,
+            status='found', reported_by=self.alice,
+        )
+        self.other_item = Item.objects.create(
+            title='Helmet', description='Blue helmet', location='Rack', category=category,
+            status='found', reported_by=self.alice,
+        )
+
+    def send(self, sender, recipient, content, item=None, **fields):
+        return Message.objects.create(
+            sender=sender, recipient=recipient, item=item or self.item, content=content, **fields,
+        )
+
+    async def resume(self, socket, after):
+        await socket.send_json_to({'type': 'resume', 'after': after})
+        return await self.receive_chat_frame(socket)
+
+    async def test_replays_newer_messages_of_this_conversation(self):
+        seen = await database_sync_to_async(self.send)(self.alice, self.bob, 'before')
+
+        def missed():
+            newer = [self.send(self.alice, self.bob, 'one'), self.send(self.bob, self.alice, 'two')]
+            # Other conversations, and what bob cleared, stay out
+            self.send(self.alice, self.bob, 'helmet', item=self.other_item)
+            self.send(self.carol, self.alice, 'carol')
+            self.send(self.alice, self.bob, 'hidden', deleted_by_recipient=True)
+            newer.append(self.send(self.alice, self.bob, 'three', client_id='a-3'))
+            return newer
+        newer = await database_sync_to_async(missed)()
+
+        socket = self.chat_socket(self.bob, self.alice)
+        self.assertTrue((await socket.connect())[0])
+        replay = await self.resume(socket, seen.id)
+        self.assertEqual(replay['type'], 'replay')
+        self.assertEqual([event['message_id'] for event in replay['messages']], [message.id for message in newer])
+        self.assertEqual([event['message'] for event in replay['messages']], ['one', 'two', 'three'])
+        self.assertEqual(replay['messages'][2]['client_id'], 'a-3')
+        self.assertEqual((replay['after'], replay['has_more']), (newer[-1].id, False))
+
+        # Caught up: nothing more, and the cursor stays put
+        replay = await self.resume(socket, newer[-1].id)
+        self.assertEqual((replay['messages'], replay['after'], replay['has_more']), ([], newer[-1].id, False))
+        await socket.disconnect()
+
+    async def test_pages_through_a_long_gap(self):
+        ids = await database_sync_to_async(lambda: [self.send(self.alice, self.bob, str(n)).id for n in range(7)])()
+        socket = self.chat_socket(self.bob, self.alice)
+        await socket.connect()
+        replayed, after, has_more = [], 0, True
+        with mock.patch('FindIt.consumers.REPLAY_PAGE_SIZE', 3):
+            while has_more:
+                replay = await self.resume(socket, after)
+                self.assertLessEqual(len(replay['messages']), 3)
+                replayed += [event['message_id'] for event in replay['messages']]
+                after, has_more = replay['after'], replay['has_more']
+        self.assertEqual(replayed, ids)
+        await socket.disconnect()
+
+    def test_messages_after_default_page(self):
+        for n in range(MESSAGE_PAGE_SIZE + 2):
+            self.send(self.alice, self.bob, str(n))
+        messages = Message.objects.filter(item=self.item)
+        page, has_more = messages_after(messages, 0)
+        self.assertEqual((len(page), has_more), (MESSAGE_PAGE_SIZE, True))
+        rest, has_more = messages_after(messages, page[-1].id)
+        self.assertEqual((len(rest), has_more), (2, False))
+        self.assertEqual([m.id for m in page + rest], list(messages.order_by('id').values_list('id', flat=True)))
+
+    async def test_bad_cursors_are_rejected(self):
+        foreign = await database_sync_to_async(self.send)(self.carol, self.alice, 'not yours', item=self.other_item)
+        mine = await database_sync_to_async(self.send)(self.alice, self.bob, 'yours')
+        socket = self.chat_socket(self.bob, self.alice)
+        await socket.connect()
+        for after in ('abc', None, [1], {'id': 1}, '1.5'):
+            replay = await self.resume(socket, after)
+            self.assertEqual(replay, {'type': 'replay', 'error': 'Invalid cursor'}, after)
+        # Another conversation's id is only a position: it reveals nothing from there
+        replay = await self.resume(socket, foreign.id - 1)
+        self.assertEqual([event['message_id'] for event in replay['messages']], [mine.id])
+        # The socket is still usable
+        replay = await self.resume(socket, str(mine.id - 1))
+        self.assertEqual(len(replay['messages']), 1)
+        await socket.disconnect()
+
+
+class NotificationSocketTests(TransactionTestCase):
+    """The per-page notification socket: a sync, then deltas once changes commit"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pw', first_name='Alice')
+        self.bob = User.objects.create_user('bob', password='pw')
+        category = ItemCategory.objects.create(name='Keys')
+        self.item = Item.objects.create(
+            title='Keys', description='Car keys', location='Lobby', category=category,
+            status='found', reported_by=self.alice,
+        )
+
+    def notify_socket(self, user):
+        socket = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/notify/')
+        socket.scope['user'] = user
+        return socket
+
+    async def open_tabs(self, user, count=2):
+        tabs = []
+        for _ in range(count):
+            socket = self.notify_socket(user)
+            self.assertTrue((await socket.connect())[0])
+            tabs.append((socket, await self.receive_event(socket)))
+        return tabs
+
+    async def receive_event(self, socket):
+        while True:
+            event = await socket.receive_json_from(timeout=1)
+            if event.get('type') != 'presence':
+                return event
+
+    async def assert_each(self, tabs, **expected):
+        for socket in tabs:
+            event = await self.receive_event(socket)
+            self.assertEqual({key: event.get(key) for key in expected}, expected)
+
+    async def assert_quiet(self, tabs):
+        for socket in tabs:
+            self.assertTrue(await socket.receive_nothing(timeout=0.2))
+
+    async def test_anonymous_socket_is_refused(self):
+        socket = self.notify_socket(AnonymousUser())
+        connected, _ = await socket.connect()
+        self.assertFalse(connected)
+
+    async def test_sync_carries_unread_total(self):
+        await database_sync_to_async(lambda: [
+            create_message(self.alice, self.bob, self.item, f'hi {n}') for n in range(3)
+        ])()
+        (socket, sync), = await self.open_tabs(self.bob, count=1)
+        self.assertEqual(sync, {'type': 'sync', 'unread': 3})
+        (other, sync), = await self.open_tabs(self.alice, count=1)
+        self.assertEqual(sync, {'type': 'sync', 'unread': 0})
+        await socket.disconnect()
+        await other.disconnect()
+
+    async def test_deltas_reach_every_tab(self):
+        alice_tabs = [socket for socket, _ in await self.open_tabs(self.alice)]
+        bob_tabs = [socket for socket, _ in await self.open_tabs(self.bob)]
+        alice_key, bob_key = f'{self.item.pk}-{self.bob.pk}', f'{self.item.pk}-{self.alice.pk}'
+
+        message = await database_sync_to_async(create_message)(self.alice, self.bob, self.item, 'Are these yours?')
+        common = {'type': 'message', 'message_id': message.pk, 'preview': 'Are these yours?', 'item_title': 'Keys'}
+        await self.assert_each(bob_tabs, conversation_id=bob_key, name='Alice', unread_delta=1, **common)
+        await self.assert_each(alice_tabs, conversation_id=alice_key, name='bob', unread_delta=0, **common)
+
+        # Reading and archiving only concern the reader's own pages
+        await database_sync_to_async(mark_read)(self.bob)
+        await self.assert_each(bob_tabs, type='read', conversations=[bob_key], unread_delta=-1)
+        await self.assert_quiet(alice_tabs)
+        await database_sync_to_async(set_archived)(self.item, self.bob, self.alice, True)
+        await self.assert_each(bob_tabs, type='archived', conversation_id=bob_key, archived=True)
+        await self.assert_quiet(alice_tabs)
+
+        await database_sync_to_async(create_message)(self.alice, self.bob, self.item, 'Hello?')
+        await self.assert_each(bob_tabs, type='message', unread_delta=1)
+        await self.assert_each(alice_tabs, type='message', unread_delta=0)
+        await database_sync_to_async(delete_conversation)(self.item, self.alice, self.bob)
+        await self.assert_each(bob_tabs, type='deleted', conversation_id=bob_key, unread_delta=-1)
+        await self.assert_each(alice_tabs, type='deleted', conversation_id=alice_key, unread_delta=0)
+
+        for socket in alice_tabs + bob_tabs:
+            await socket.disconnect()
+
+    async def test_deltas_wait_for_commit(self):
+        tabs = [socket for socket, _ in await self.open_tabs(self.bob)]
+
+        def send_inside_transaction(rollback):
+            with transaction.atomic():
+                create_message(self.alice, self.bob, self.item, 'pending')
+                # Still open: nothing may have gone out yet
+                async_to_sync(self.assert_quiet)(tabs)
+                if rollback:
+                    transaction.set_rollback(True)
+
+        await database_sync_to_async(send_inside_transaction)(rollback=True)
+        await self.assert_quiet(tabs)
+        await database_sync_to_async(send_inside_transaction)(rollback=False)
+        await self.assert_each(tabs, type='message', preview='pending')
+        for socket in tabs:
+            await socket.disconnect()
+
+
+class MessageHistoryTests(TestCase):
+    """Paging back through a conversation by message-id cursor"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='pw')
+        cls.bob = User.objects.create_user('bob', password='pw')
+        cls.carol = User.objects.create_user('carol', password='pw')
+        category = ItemCategory.objects.create(name='Umbrellas')
+        cls.item = Item.objects.create(
+            title='Umbrella', description='Red umbrella', location='Hall', category=category,
+            status='found', reported_by=cls.alice,
+        )
+        messages = [
+            Message(sender=(cls.alice, cls.bob)[n % 2], recipient=(cls.bob, cls.alice)[n % 2],
+                    item=cls.item, content=f'message {n}')
+            for n in range(2 * MESSAGE_PAGE_SIZE + 5)
+        ]
+        # Carol's conversation about the same item interleaves with theirs
+        messages[10:10] = [Message(sender=cls.carol, recipient=cls.alice, item=cls.item, content='carol')]
+        Message.objects.bulk_create(messages)
+        cls.ids = list(
+            Message.objects.filter(item=cls.item).exclude(sender=cls.carol).order_by('id').values_list('id', flat=True)
+        )
+
+    def history(self, before=None, **params):
+        params = {'item_id': self.item.id, 'recipient_id': self.bob.id, **params}
+        if before is not None:
+            params['before'] = before
+        return self.client.get(reverse('inbox_history'), params)
+
+    def page_ids(self, data):
+        return [int(id) for id in re.findall(r'data-message-id="(\d+)"', data['html'])]
+
+    def test_message_history_pages_without_gaps(self):
+        messages = conversation_messages(self.alice, self.item, self.bob)
+        pages, before, has_older = [], None, True
+        while has_older:
+            page, has_older = message_history(messages, before_id=before)
+            self.assertEqual([m.id for m in page], sorted(m.id for m in page))
+            pages.append([m.id for m in page])
+            before = page[0].id
+        self.assertEqual([len(page) for page in pages], [MESSAGE_PAGE_SIZE, MESSAGE_PAGE_SIZE, 5])
+        self.assertEqual([id for page in reversed(pages) for id in page], self.ids)
+        self.assertEqual(message_history(messages, before_id=self.ids[0]), ([], False))
+
+    def test_view_pages_back_to_the_start(self):
+        self.client.login(username='alice', password='pw')
+        seen, before, has_older = [], None, True
+        while has_older:
+            data = self.history(before).json()
+            ids = self.page_ids(data)
+            self.assertEqual(ids, sorted(ids))
+            self.assertEqual((data['count'], data['before']), (len(ids), ids[0]))
+            seen[:0] = ids
+            before, has_older = data['before'], data['has_older']
+        self.assertEqual(seen, self.ids)
+        data = self.history(self.ids[0]).json()
+        self.assertEqual((data['count'], data['before'], data['has_older']), (0, None, False))
+        self.assertEqual(self.history('abc').status_code, 400)
+
+    def test_send_message_page_links_older_messages(self):
+        self.client.login(username='alice', password='pw')
+        url = reverse('send_message', args=[self.item.id, self.bob.id])
+        response = self.client.get(url)
+        self.assertEqual([m.id for m in response.context['conversation']], self.ids[-MESSAGE_PAGE_SIZE:])
+        self.assertEqual(response.context['older_before'], self.ids[-MESSAGE_PAGE_SIZE])
+        response = self.client.get(url, {'before': self.ids[5]})
+        self.assertEqual([m.id for m in response.context['conversation']], self.ids[:5])
+        self.assertIsNone(response.context['older_before'])
+
+    def test_other_users_conversation_is_hidden(self):
+        self.client.login(username='carol', password='pw')
+        data = self.history().json()
+        self.assertEqual((data['count'], data['has_older']), (0, False))
+        data = self.history(recipient_id=self.alice.id).json()
+        self.assertEqual(data['count'], 1)
+        self.client.login(username='bob', password='pw')
+        self.assertEqual(self.history(recipient_id=999999).status_code, 404)
+
+
+class ChatHistorySocketTests(ChatSocketMixin, TransactionTestCase):
+    """The socket ``history`` frame returns the page the view would"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        category = ItemCategory.objects.create(name='Umbrellas')
+        self.item = Item.objects.create(
+            title='Umbrella', description='Red umbrella', location='Hall', category=category,
+            status='found', reported_by=self.alice,
+        )
+        Message.objects.bulk_create(
+            Message(sender=self.alice, recipient=self.bob, item=self.item, content=f'message {n}')
+            for n in range(MESSAGE_PAGE_SIZE + 3)
+        )
+
+    def view_page(self, before=None):
+        self.client.login(username='bob', password='pw')
+        params = {'item_id': self.item.id, 'recipient_id': self.alice.id}
+        if before is not None:
+            params['before'] = before
+        return self.client.get(reverse('inbox_history'), params).json()
+
+    async def test_history_frame_matches_view(self):
+        socket = self.chat_socket(self.bob, self.alice)
+        self.assertTrue((await socket.connect())[0])
+        before = None
+        for _ in range(2):
+            await socket.send_json_to({'type': 'history', 'before': before})
+            frame = await self.receive_chat_frame(socket)
+            expected = await database_sync_to_async(self.view_page)(before)
+            self.assertEqual(frame.pop('type'), 'history')
+            self.assertEqual(frame, expected)
+            before = frame['before']
+        self.assertFalse(frame['has_older'])
+        self.assertEqual(frame['count'], 3)
+
+        await socket.send_json_to({'type': 'history', 'before': 'abc'})
+        self.assertEqual(await self.receive_chat_frame(socket), {'type': 'history', 'error': 'Invalid cursor'})
+        await socket.disconnect()
+
+
+class LoadTestCommandTests(TestCase):
+    """loadtest_chat without sockets: arguments, fixtures and cleanup"""
+
+    def command(self):
+        from .management.commands.loadtest_chat import Command
+        return Command(stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_rejects_empty_runs(self):
+        for args in (['--conversations', '0'], ['--rate', '0'], ['--duration', '-1']):
+            with self.assertRaises(CommandError):
+                call_command('loadtest_chat', *args)
+
+    def test_fixture_sessions_sign_in(self):
+        pairs = self.command().create_fixtures(2)
+        self.assertEqual(len(pairs), 2)
+        for item_id, *participants in pairs:
+            self.assertTrue(Item.objects.filter(pk=item_id).exists())
+            for user_id, session_key in participants:
+                self.client.cookies[settings.SESSION_COOKIE_NAME] = session_key
+                response = self.client.get(reverse('inbox_history'))
+                self.assertEqual(response.wsgi_request.user.pk, user_id)
+
+    def test_cleans_up_after_failed_run(self):
+        from .management.commands.loadtest_chat import USER_PREFIX, Command
+        from django.contrib.sessions.models import Session
+
+        seen = {}
+
+        def fail(command, pairs, options):
+            seen['sessions'] = [session_key for _, *participants in pairs for _, session_key in participants]
+            self.assertEqual(Session.objects.filter(session_key__in=seen['sessions']).count(), 4)
+            raise CommandError('No socket could connect')
+
+        with mock.patch.object(Command, 'run_clients', fail), self.assertRaises(CommandError):
+            call_command('loadtest_chat', '--conversations', '2', stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(len(seen['sessions']), 4)
+        self.assertFalse(Session.objects.filter(session_key__in=seen['sessions']).exists())
+        self.assertFalse(User.objects.filter(username__startswith=USER_PREFIX).exists())
+        self.assertFalse(Item.objects.filter(title__startswith='Load test item').exists())
@@ -0,0 +1,209 @@
+"""
+Resized copies of uploaded images, for srcset.
+
+Every item photo, profile picture and chat image gets one thumbnail per
+width in THUMBNAIL_SIZES that is narrower than the original. A thumbnail's
+name follows from the original's, so nothing is stored in the database::
+
+    item_photos/bike.jpg -> item_photos/thumbs/480/bike.jpg
+
+PNG and WebP keep their format (and transparency); everything else becomes
+JPEG. The original stays the largest srcset candidate when it is wider than
+the last thumbnail.
+
+Thumbnails are made after the upload's transaction commits, on a small
+background thread pool (Pillow releases the GIL while decoding and
+resizing), so no request waits on them. Until they exist templates fall
+back to the original. The generate_thumbnails command backfills existing
+media with a process pool.
+
+Which thumbnails exist, and how wide the original is, is cached per image so
+rendering a srcset doesn't touch storage.
+"""
+import hashlib
+import io
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = (160, 480, 1200)
+THUMBS_DIR = 'thumbs'
+# Hashed: file names may hold characters memcached keys can't
+CACHE_KEY = 'findit:thumbs:{digest}'
+CACHE_TTL = 7 * 24 * 60 * 60
+# While thumbnails may still be on their way, look again soon
+PENDING_TTL = 60
+# Output format and extension by the original's extension
+FORMATS = {
+    '.png': ('PNG', '.png'),
+    '.webp': ('WEBP', '.webp'),
+}
+JPEG = ('JPEG', '.jpg')
+SAVE_OPTIONS = {
+    'JPEG': {'quality': 82, 'optimize': True, 'progressive': True},
+    'WEBP': {'quality': 80, 'method': 4},
+    'PNG': {'optimize': True},
+}
+
+_executor = None
+
+
+def thumbnail_sizes():
+    return tuple(sorted(getattr(settings, 'THUMBNAIL_SIZES', DEFAULT_SIZES)))
+
+
+def _output_format(name):
+    return FORMATS.get(posixpath.splitext(name)[1].lower(), JPEG)
+
+
+def thumbnail_name(name, width):
+    directory, filename = posixpath.split(name)
+    stem = posixpath.splitext(filename)[0]
+    return posixpath.join(directory, THUMBS_DIR, str(width), stem + _output_format(name)[1])
+
+
+def thumbnail_source(name):
+    """(directory, stem) of the original a thumbnail name was made from, or None.
+
+    The extension is lost: a JPEG-encoded thumbnail may come from any format.
+    """
+    parts = name.split('/')
+    if len(parts) < 3 or parts[-3] != THUMBS_DIR or not parts[-2].isdigit():
+        return None
+    return '/'.join(parts[:-3]), posixpath.splitext(parts[-1])[0]
+
+
+def _cache_key(name):
+    return CACHE_KEY.format(digest=hashlib.md5(name.encode()).hexdigest())
+
+
+def remember(name, widths, original_width, timeout=CACHE_TTL):
+    cache.set(_cache_key(name), {'widths': widths, 'width': original_width}, timeout=timeout)
+
+
+def make_thumbnails(name, storage=default_storage, force=False):
+    """Write the missing thumbnails of ``name``; returns (thumbnail widths, original width)"""
+    from PIL import Image, ImageOps
+
+    output_format, _ = _output_format(name)
+    with storage.open(name, 'rb') as fh, Image.open(fh) as image:
+        width, height = image.size
+        if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+            # Rotated a quarter turn by its EXIF orientation
+            width, height = height, width
+        widths = [size for size in thumbnail_sizes() if size < width]
+        todo = [size for size in widths if force or not storage.exists(thumbnail_name(name, size))]
+        if todo:
+            # Let the JPEG decoder scale down by up to 8x while decoding
+            image.draft('RGB', (todo[-1], todo[-1]))
+            image = ImageOps.exif_transpose(image)
+            if output_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                image = image.convert('RGBA')
+            for size in todo:
+                resized = image.resize(
+                    (size, max(1, round(height * size / width))),
+                    Image.Resampling.LANCZOS, reducing_gap=3.0,
+                )
+                buffer = io.BytesIO()
+                resized.save(buffer, output_format, **SAVE_OPTIONS[output_format])
+                thumb = thumbnail_name(name, size)
+                if storage.exists(thumb):
+                    storage.delete(thumb)
+                storage.save(thumb, ContentFile(buffer.getvalue()))
+    return widths, width
+
+
+def generate(name):
+    """Make the thumbnails of ``name`` and cache what exists; returns the widths"""
+    widths, width = make_thumbnails(name)
+    remember(name, widths, width)
+    return widths
+
+
+def _run_in_background(name):
+    try:
+        generate(name)
+    except Exception:
+        logger.exception('Thumbnails failed for %s', name)
+
+
+def generate_in_background(name):
+    """Queue ``name`` for thumbnails now (the file must already be in storage).
+
+    Set ``THUMBNAILS_ASYNC = False`` to make them inline (e.g. in tests).
+    """
+    global _executor
+    if not getattr(settings, 'THUMBNAILS_ASYNC', True):
+        _run_in_background(name)
+        return
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'THUMBNAIL_WORKERS', 2), thread_name_prefix='thumbnails',
+        )
+    _executor.submit(_run_in_background, name)
+
+
+def schedule_thumbnails(fieldfile):
+    """Queue thumbnails for an image field's file once the current transaction commits"""
+    if fieldfile:
+        name = fieldfile.name
+        transaction.on_commit(lambda: generate_in_background(name))
+
+
+def delete_thumbnails(name, storage=default_storage):
+    for size in thumbnail_sizes():
+        storage.delete(thumbnail_name(name, size))
+    cache.delete(_cache_key(name))
+
+
+def available(name, storage=default_storage):
+    """(thumbnail widths that exist, original width or None) for ``name``"""
+    from PIL import Image
+
+    known = cache.get(_cache_key(name))
+    if known is not None:
+        return known['widths'], known['width']
+    widths = [size for size in thumbnail_sizes() if storage.exists(thumbnail_name(name, size))]
+    try:
+        # Only reads the header
+        with storage.open(name, 'rb') as fh, Image.open(fh) as image:
+            width = image.size[0]
+            if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                width = image.size[1]
+    except (OSError, ValueError):
+        return widths, None
+    complete = widths == [size for size in thumbnail_sizes() if size < width]
+    remember(name, widths, width, timeout=CACHE_TTL if complete else PENDING_TTL)
+    return widths, width
+
+
+def srcset(fieldfile):
+    """(src, srcset) for an image field's file; srcset is '' before thumbnails exist"""
+    widths, width = available(fieldfile.name, fieldfile.storage)
+    if not widths:
+        return fieldfile.url, ''
+    candidates = [f'{fieldfile.storage.url(thumbnail_name(fieldfile.name, size))} {size}w' for size in widths]
+    if width and width > widths[-1]:
+        candidates.append(f'{fieldfile.url} {width}w')
+    # The middle size is a sensible default for browsers without srcset
+    src = fieldfile.storage.url(thumbnail_name(fieldfile.name, widths[len(widths) // 2]))
+    return src, ', '.join(candidates)
+
+
+def thumbnail_url(fieldfile, width):
+    """URL of the smallest thumbnail at least ``width`` px wide, else of the original"""
+    widths, _ = available(fieldfile.name, fieldfile.storage)
+    for size in widths:
+        if size >= width:
+            return fieldfile.storage.url(thumbnail_name(fieldfile.name, size))
+    return fieldfile.url
@@ -0,0 +1,170 @@
+"""
+Chunked image uploads over the chat socket.
+
+Protocol (handled by ChatConsumer):
+
+1. text ``{"type": "upload_start", "upload_id", "size", "content_type",
+   "client_id", "message"}``
+   -> ``{"type": "upload_ready", "upload_id", "offset"}``. The offset is
+   above 0 when an interrupted upload with the same id is resumed.
+2. binary frames: one byte giving the upload id's length, the upload id, an
+   8 byte big-endian offset, then up to ``max_chunk_bytes`` of data
+   -> ``{"type": "upload_ack", "upload_id", "offset"}`` after each chunk. A
+   chunk at any other offset than the next expected one is dropped and
+   answered with the expected offset.
+3. after the last byte the file is re-encoded (see ingest.py), moved to storage
+   and sent to the room as a chat message
+   -> ``{"type": "upload_done", "upload_id", "client_id"}``.
+
+Chunks are appended to a part file in CHAT_UPLOAD_TEMP_DIR as they arrive,
+so no image is ever held in memory whole, and a client that reconnects
+re-sends upload_start and continues from the offset it gets back. Part files
+untouched for STALE_AFTER seconds are deleted.
+"""
+import json
+import posixpath
+import re
+import struct
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files import File
+
+from .ingest import ImageRejected, normalize
+from .storage import media_storage
+from .thumbnails import generate_in_background
+
+UPLOAD_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+OFFSET = struct.Struct('>Q')
+STALE_AFTER = 24 * 60 * 60
+
+_last_purge = 0.0
+
+
+class UploadError(Exception):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+@dataclass
+class Upload:
+    upload_id: str
+    owner_id: int
+    size: int
+    path: Path
+    received: int = 0
+    # Continues a part file left by an earlier upload_start
+    resumed: bool = False
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+
+@dataclass
+class StoredImage:
+    name: str
+    width: int
+    height: int
+
+
+def temp_dir():
+    default = Path(tempfile.gettempdir()) / 'findit-chat-uploads'
+    return Path(getattr(settings, 'CHAT_UPLOAD_TEMP_DIR', default))
+
+
+def purge_stale():
+    """Delete part files nobody has written to for STALE_AFTER seconds; at most hourly"""
+    global _last_purge
+    now = time.time()
+    if now - _last_purge < 60 * 60:
+        return
+    _last_purge = now
+    for path in temp_dir().glob('*.part*'):
+        try:
+            if now - path.stat().st_mtime > STALE_AFTER:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def start_upload(owner_id, upload_id, size, max_bytes):
+    """Open (or resume) an upload of ``size`` bytes for user ``owner_id``"""
+    if not UPLOAD_ID_RE.match(str(upload_id)):
+        raise UploadError('invalid')
+    # JSON true would pass for 1
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        raise UploadError('invalid')
+    if size > max_bytes:
+        raise UploadError('too_large')
+
+    directory = temp_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    purge_stale()
+    path = directory / f'{owner_id}-{upload_id}.part'
+    meta_path = path.with_suffix('.part.json')
+
+    upload = Upload(upload_id=upload_id, owner_id=owner_id, size=size, path=path)
+    try:
+        meta = json.loads(meta_path.read_text())
+    except (FileNotFoundError, ValueError):
+        meta = None
+    if meta == {'size': size} and path.exists():
+        upload.received = path.stat().st_size
+        upload.resumed = True
+    else:
+        meta_path.write_text(json.dumps({'size': size}))
+        path.write_bytes(b'')
+    return upload
+
+
+def parse_chunk(frame):
+    """Split a binary frame into ``(upload_id, offset, data)``"""
+    if len(frame) < 1 + 1 + OFFSET.size:
+        raise UploadError('invalid')
+    id_length = frame[0]
+    header_length = 1 + id_length + OFFSET.size
+    if len(frame) < header_length:
+        raise UploadError('invalid')
+    upload_id = frame[1:1 + id_length].decode('ascii', errors='replace')
+    (offset,) = OFFSET.unpack_from(frame, 1 + id_length)
+    return upload_id, offset, memoryview(frame)[header_length:]
+
+
+def write_chunk(upload, offset, data):
+    """Append ``data`` if it continues the upload; returns the next expected offset"""
+    if offset != upload.received:
+        return upload.received
+    if upload.received + len(data) > upload.size:
+        # More than announced: abandon it rather than leave the part file for purge_stale()
+        discard_upload(upload)
+        raise UploadError('too_large')
+    with open(upload.path, 'ab') as fh:
+        fh.write(data)
+    upload.received += len(data)
+    return upload.received
+
+
+def finish_upload(upload):
+    """Re-encode the finished file (see ingest.py) and move it to storage; returns a StoredImage"""
+    try:
+        with open(upload.path, 'rb') as fh:
+            image = normalize(File(fh, name=upload.path.name), 'chat_images')
+    except ImageRejected:
+        raise UploadError('invalid_image')
+    finally:
+        discard_upload(upload)
+    extension = posixpath.splitext(image.name)[1]
+    # Named after its content by the storage
+    name = media_storage().save(f'chat_images/image{extension}', image)
+    generate_in_background(name)
+    return StoredImage(name, image.width, image.height)
+
+
+def discard_upload(upload):
+    for path in (upload.path, upload.path.with_suffix('.part.json')):
+        path.unlink(missing_ok=True)
@@ -8,10 +8,12 @@ urlpatterns = [
     path('logout/', views.user_logout, name='logout'),
     path('report/', views.report_item, name='report_item'),
     path('items/', views.item_list, name='item_list'),
+    path('items/more/', views.item_list_more, name='item_list_more'),
     path('items/<int:item_id>/', views.item_detail, name='item_detail'),
     path('items/<int:item_id>/contact/', views.contact_item_owner, name='contact_item_owner'),
     path('items/<int:item_id>/mark_returned/', views.mark_item_returned, name='mark_item_returned'),
     path('inbox/', views.inbox, name='inbox'),
+    path('inbox/history/', views.inbox_history, name='inbox_history'),
     path('items/<int:item_id>/message/<int:recipient_id>/', views.send_message, name='send_message'),
     path('profile/', views.profile_view, name='profile'),
     path('profile/edit/', views.edit_profile, name='edit_profile'),
@@ -31,4 +33,5 @@ urlpatterns = [
     path('statistics/returns/', views.returns_statistics, name='returns_statistics'),
     path('export/recovered-items/pdf/', views.export_recovered_items_pdf, name='export_recovered_items_pdf'),
     path('clear-conversation/', views.clear_conversation, name='clear_conversation'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
@@ -1,5 +1,5 @@
 from django.contrib.auth.decorators import login_required
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_POST, require_safe
 
 # Mark item as returned (reporter, owner, or superuser only)
 @login_required
@@ -20,6 +20,7 @@ def mark_item_returned(request, item_id):
                 owner_user = User.objects.get(username=owner_username)
                 item.owner = owner_user
                 item.is_returned = True
+                item.sync_returned_state()
                 item.save()
                 messages.success(request, f'Item marked as returned. Waiting for {owner_user.username} to confirm.')
                 return redirect('item_detail', item_id=item.id)
@@ -43,8 +44,10 @@ def mark_item_returned(request, item_id):
                 original_report_date=item.date_reported,
                 location=item.location
             )
-            # Ensure item is marked as returned
+            # Ensure item is marked as returned; set the state here too, so this
+            # save doesn't depend on the RecoveredItem signal having updated it
             item.is_returned = True
+            item.state = Item.STATE_RECOVERED
             item.save()
             
             messages.success(request, 'Return confirmed! The item has been moved to your recovered items. Please rate the finder.')
@@ -52,6 +55,7 @@ def mark_item_returned(request, item_id):
         else:
             # Reporter or superuser can toggle the status
             item.is_returned = not item.is_returned
+            item.sync_returned_state()
             item.save()
             
             if item.is_returned:
@@ -63,16 +67,21 @@ def mark_item_returned(request, item_id):
     
     return redirect('item_detail', item_id=item.id)
 # Context processor to provide unread inbox count to all templates
+# Reads the maintained counter, and only when a template actually uses it
 def unread_inbox_count(request):
     if request.user.is_authenticated:
-        return {'unread_inbox_count': request.user.received_messages.filter(is_read=False).count()}
+        from django.utils.functional import SimpleLazyObject
+        from .messaging import unread_count
+        user = request.user
+        return {'unread_inbox_count': SimpleLazyObject(lambda: unread_count(user))}
     return {'unread_inbox_count': 0}
 # Context processor to provide categories to all templates
 from .models import ItemCategory
 from .models import ReturnConfirmation, Item
 from .forms import ReturnConfirmationForm
+from .facets import facet_counts, get_categories
 def categories_context(request):
-    return {'categories': ItemCategory.objects.all()}
+    return {'categories': get_categories()}
 from django.contrib.auth.decorators import user_passes_test
 
 # Admin Dashboard view (superuser only)
@@ -110,6 +119,18 @@ from django.conf import settings
 
 from .forms import UserReviewForm
 from .models import UserReview
+from .gazetteer import filter_within, get_gazetteer
+from .messaging import (
+    conversation_messages, conversations_for, create_message, delete_conversation, get_conversation,
+    mark_read, message_history, set_archived,
+)
+from .matching import matches_for, schedule_scoring
+from .thumbnails import schedule_thumbnails, thumbnail_url
+from .visual import similar_items
+from .storage import release
+from .ingest import ImageRejected, add_upload_errors, normalize, upload_errors
+from .pagination import InvalidCursor, paginate_keyset
+from .search import search_items
 
 # Submit review for reputation system
 from django.contrib.auth.decorators import login_required
@@ -195,43 +216,93 @@ def home(request):
 def report_item(request):
     if request.method == 'POST':
         form = ItemForm(request.POST, request.FILES)
+        add_upload_errors(request, form)
         if form.is_valid():
             item = form.save(commit=False)
             item.reported_by = request.user
             item.save()
+            schedule_scoring(item)
+            schedule_thumbnails(item.photo)
             messages.success(request, 'Item reported successfully!')
             return redirect('home')
     else:
         form = ItemForm()
     return render(request, 'FindIt/report_item.html', {'form': form})
 
-def item_list(request):
-    from .models import RecoveredItem
+ITEMS_PER_PAGE = 24
+
+NEAR_RADIUS_CHOICES = (100, 250, 500, 1000, 2000)
+
+def _filtered_items(request):
     query = request.GET.get('q', '')
     category_id = request.GET.get('category', '')
     status = request.GET.get('status', '')
+    near = request.GET.get('near', '')
     
-    # Exclude items that have been recovered (confirmed returns)
-    recovered_item_ids = RecoveredItem.objects.values_list('item_id', flat=True)
-    items = Item.objects.exclude(id__in=recovered_item_ids).order_by('-date_reported')
+    # Only live items; recovered (confirmed returns) and expired ones are hidden
+    items = Item.objects.filter(state__in=Item.LISTED_STATES).select_related('category').order_by('-date_reported', '-id')
     
-    if query:
-        items = items.filter(Q(title__icontains=query) | Q(description__icontains=query) | Q(location__icontains=query))
     if category_id:
         items = items.filter(category_id=category_id)
     if status:
         items = items.filter(status=status)
-    categories = ItemCategory.objects.all()
+    place = get_gazetteer().get(near) if near else None
+    if place:
+        # "Within N metres of" a known place, via the grid cell index
+        try:
+            radius = int(request.GET.get('radius', 500))
+        except ValueError:
+            radius = 500
+        items = filter_within(items, place.lat, place.lng, radius)
+    if query:
+        # Ranked full-text search; results come back best match first
+        items = search_items(items, query)
+    return items, query, category_id, status
+
+def item_list(request):
+    items, query, category_id, status = _filtered_items(request)
+    try:
+        page = paginate_keyset(items, request.GET.get('cursor'), ITEMS_PER_PAGE)
+    except InvalidCursor:
+        page = paginate_keyset(items, None, ITEMS_PER_PAGE)
+    # Keep the active filters on the "load more" links
+    filter_params = request.GET.copy()
+    filter_params.pop('cursor', None)
+    # Facet counts for the filter labels come from one cached GROUP BY query
+    facets = facet_counts()
     return render(request, 'FindIt/item_list.html', {
-        'items': items,
-        'categories': categories,
+        'items': page,
+        'next_cursor': page.next_cursor,
+        'filter_query': filter_params.urlencode(),
+        'category_facets': [(cat, facets['category'].get(cat.id, 0)) for cat in get_categories()],
+        'status_facets': facets['status'],
+        'total_count': facets['total'],
+        'places': sorted(get_gazetteer().places.values(), key=lambda place: place.name),
+        'radius_choices': NEAR_RADIUS_CHOICES,
         'query': query,
         'selected_category': category_id,
         'selected_status': status,
+        'selected_near': request.GET.get('near', ''),
+        'selected_radius': request.GET.get('radius', '500'),
+    })
+
+def item_list_more(request):
+    """Next page of item cards for infinite scroll, as an HTML fragment in JSON"""
+    from django.http import JsonResponse
+    from django.template.loader import render_to_string
+    items, query, category_id, status = _filtered_items(request)
+    try:
+        page = paginate_keyset(items, request.GET.get('cursor'), ITEMS_PER_PAGE)
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    return JsonResponse({
+        'html': render_to_string('FindIt/item_cards.html', {'items': page}, request=request),
+        'count': len(page),
+        'next_cursor': page.next_cursor,
+        'has_next': page.has_next,
     })
 
 def item_detail(request, item_id):
-    from .models import RecoveredItem
     item = get_object_or_404(Item, id=item_id)
     confirmation = getattr(item, 'return_confirmation', None)
     if not confirmation:
@@ -239,12 +310,14 @@ def item_detail(request, item_id):
         confirmation = ReturnConfirmation.objects.create(item=item)
     
     # Check if item has been recovered
-    has_recovered = RecoveredItem.objects.filter(item=item).exists()
+    has_recovered = item.state == Item.STATE_RECOVERED
     
     return render(request, 'FindIt/item_detail.html', {
         'item': item,
         'confirmation': confirmation,
         'has_recovered': has_recovered,
+        'possible_matches': matches_for(item),
+        'similar_items': similar_items(item),
     })
 
 def contact_item_owner(request, item_id):
@@ -274,6 +347,14 @@ def contact_item_owner(request, item_id):
         form = MessageForm()
     return render(request, 'FindIt/contact_owner.html', {'form': form, 'item': item})
 
+CONVERSATIONS_PER_PAGE = 30
+
+def _avatar_url(user):
+    if hasattr(user, 'userprofile') and user.userprofile.profile_picture:
+        # Shown at 50px
+        return thumbnail_url(user.userprofile.profile_picture, 100)
+    return ''
+
 @login_required
 def inbox(request):
     item_id = request.GET.get('item_id')
@@ -281,37 +362,24 @@ def inbox(request):
     view_mode = request.GET.get('view')
     show_archived = request.GET.get('archived') == '1'
 
-    # If item_id and recipient_id are provided, check if conversation already exists
-    if item_id and recipient_id:
-        try:
-            item = get_object_or_404(Item, id=item_id)
-            recipient = get_object_or_404(User, id=recipient_id)
-            
-            # Check for existing conversation between these two users about this item
-            existing_messages = Message.objects.filter(
-                item=item,
-                sender__in=[request.user, recipient],
-                recipient__in=[request.user, recipient]
-            ).filter(
-                Q(sender=request.user, deleted_by_sender=False) | 
-                Q(recipient=request.user, deleted_by_recipient=False)
-            ).exists()
-            
-            # If conversation exists, we'll use it (no redirect needed, just continue)
-            # If it doesn't exist, that's fine too - we'll create a new one when they send a message
-        except:
-            pass
-
     # Handle sending a message (fallback for image uploads or non-WebSocket)
     if request.method == 'POST':
         item_id = request.POST.get('item_id') or item_id
         recipient_id = request.POST.get('recipient_id') or recipient_id
         content = request.POST.get('message', '').strip()
         image = request.FILES.get('chat_image')
+        for error in upload_errors(request).values():
+            messages.error(request, error)
+        if image:
+            try:
+                image = normalize(image, 'chat_images')
+            except ImageRejected as e:
+                messages.error(request, str(e))
+                image = None
         if item_id and recipient_id and (content or image):
             item = get_object_or_404(Item, id=item_id)
             recipient = get_object_or_404(User, id=recipient_id)
-            Message.objects.create(
+            create_message(
                 sender=request.user,
                 recipient=recipient,
                 item=item,
@@ -320,136 +388,73 @@ def inbox(request):
             )
             return redirect(f"{request.path}?item_id={item_id}&recipient_id={recipient_id}")
 
-    # Get all conversations for the sidebar
-    if show_archived:
-        # Show only archived messages (those deleted by current user)
-        conversations = Message.objects.filter(
-            Q(sender=request.user, deleted_by_sender=True) | 
-            Q(recipient=request.user, deleted_by_recipient=True)
-        ).select_related('item', 'sender', 'recipient').order_by('-timestamp')
-    else:
-        # Show active conversations (exclude archived messages)
-        conversations = Message.objects.filter(
-            Q(sender=request.user, deleted_by_sender=False) | 
-            Q(recipient=request.user, deleted_by_recipient=False)
-        ).select_related('item', 'sender', 'recipient').order_by('-timestamp')
-
-    # Group conversations by (item, other_user)
-    convo_dict = {}
-    for msg in conversations:
-        other_user = msg.recipient if msg.sender == request.user else msg.sender
-        key = (msg.item.id, other_user.id)
-        if key not in convo_dict or msg.timestamp > convo_dict[key].timestamp:
-            convo_dict[key] = msg
-    convo_list = list(convo_dict.values())
+    # Sidebar: one page of conversations, most recent activity first
+    conversations = conversations_for(request.user, archived=show_archived)
+    try:
+        convo_page = paginate_keyset(conversations, request.GET.get('convo_cursor'), CONVERSATIONS_PER_PAGE)
+    except InvalidCursor:
+        convo_page = paginate_keyset(conversations, None, CONVERSATIONS_PER_PAGE)
+    convo_list = convo_page.object_list
 
     # Determine active conversation
     active_conversation = None
     active_messages = []
+    other_user = None
     if item_id and recipient_id:
         item = get_object_or_404(Item, id=item_id)
-        recipient = get_object_or_404(User, id=recipient_id)
-        # Get messages for the active conversation (include archived if in archived view)
-        if show_archived:
-            active_messages = Message.objects.filter(
-                item=item,
-                sender__in=[request.user, recipient],
-                recipient__in=[request.user, recipient]
-            ).order_by('timestamp')
-        else:
-            active_messages = Message.objects.filter(
-                item=item,
-                sender__in=[request.user, recipient],
-                recipient__in=[request.user, recipient]
-            ).filter(
-                Q(sender=request.user, deleted_by_sender=False) | 
-                Q(recipient=request.user, deleted_by_recipient=False)
-            ).order_by('timestamp')
-        # For sidebar highlighting
-        for msg in convo_list:
-            if msg.item.id == int(item_id) and (msg.sender.id == int(recipient_id) or msg.recipient.id == int(recipient_id)):
-                active_conversation = msg
-                break
-        if not active_conversation and active_messages:
-            active_conversation = active_messages.last()
+        other_user = get_object_or_404(User, id=recipient_id)
+        active_conversation = get_conversation(item, request.user, other_user)
     elif convo_list and view_mode != 'list':
         active_conversation = convo_list[0]
-        active_messages = Message.objects.filter(
-            item=active_conversation.item,
-            sender__in=[request.user, active_conversation.sender, active_conversation.recipient],
-            recipient__in=[request.user, active_conversation.sender, active_conversation.recipient]
-        ).filter(
-            Q(sender=request.user, deleted_by_sender=False) | 
-            Q(recipient=request.user, deleted_by_recipient=False)
-        ).order_by('timestamp')
+        item = active_conversation.item
+        other_user = active_conversation.other_user(request.user)
 
-    # Mark all unread messages as read
-    Message.objects.filter(
-        recipient=request.user,
-        is_read=False
-    ).update(is_read=True)
+    has_older = False
+    if other_user is not None:
+        # Newest page of the active conversation (include archived if in archived view);
+        # older pages come from inbox_history or the chat socket
+        active_messages, has_older = message_history(conversation_messages(
+            request.user, item, other_user,
+            include_archived=bool(show_archived and item_id and recipient_id),
+        ))
 
-    # Prepare context for template
+    # Unread badges come from the conversation rows, read before everything is marked as read
     sidebar_conversations = []
-    for msg in convo_list:
-        other_user = msg.recipient if msg.sender == request.user else msg.sender
-        # Use userprofile.profile_picture if available
-        avatar_url = ''
-        if hasattr(other_user, 'userprofile') and other_user.userprofile.profile_picture:
-            avatar_url = other_user.userprofile.profile_picture.url
+    for convo in convo_list:
+        convo_other = convo.other_user(request.user)
+        last_message = convo.last_message
         sidebar_conversations.append({
-            'id': f"{msg.item.id}-{other_user.id}",
-            'avatar_url': avatar_url,
-            'name': other_user.get_full_name() or other_user.username,
-            'last_message': msg.content,
-            'last_date': msg.timestamp,
-            'item_title': msg.item.title,
-            'item_image': msg.item.photo.url if msg.item.photo else '',
-            'item_price': getattr(msg.item, 'price', ''),
-            'other_user_id': other_user.id,
-            'item_id': msg.item.id,
+            'id': f"{convo.item_id}-{convo_other.id}",
+            'avatar_url': _avatar_url(convo_other),
+            'name': convo_other.get_full_name() or convo_other.username,
+            'last_message': last_message.content if last_message else '',
+            'last_date': convo.last_activity,
+            'item_title': convo.item.title,
+            'item_image': thumbnail_url(convo.item.photo, 160) if convo.item.photo else '',
+            'item_price': getattr(convo.item, 'price', ''),
+            'other_user_id': convo_other.id,
+            'item_id': convo.item_id,
+            'unread_count': convo.unread_for(request.user),
         })
 
+    # Mark all unread messages as read
+    mark_read(request.user)
+
+    # Existing conversation, or the chat UI for a new one when item_id and recipient_id are provided
     active_convo_data = None
-    if active_conversation:
-        # If we have item_id and recipient_id from URL, use the recipient as the other user
-        if item_id and recipient_id:
-            try:
-                recipient = User.objects.get(id=recipient_id)
-                other_user = recipient
-            except User.DoesNotExist:
-                other_user = active_conversation.recipient if active_conversation.sender == request.user else active_conversation.sender
-        else:
-            other_user = active_conversation.recipient if active_conversation.sender == request.user else active_conversation.sender
-        avatar_url = ''
-        if hasattr(other_user, 'userprofile') and other_user.userprofile.profile_picture:
-            avatar_url = other_user.userprofile.profile_picture.url
+    if other_user is not None:
         active_convo_data = {
-            'id': f"{active_conversation.item.id}-{other_user.id}",
-            'avatar_url': avatar_url,
+            'id': f"{item.id}-{other_user.id}",
+            'avatar_url': _avatar_url(other_user),
             'name': other_user.get_full_name() or other_user.username,
-            'item_title': active_conversation.item.title,
-            'item_image': active_conversation.item.photo.url if active_conversation.item.photo else '',
-            'item_price': getattr(active_conversation.item, 'price', ''),
-            'date': active_conversation.timestamp,
-            'messages': active_messages,
-        }
-    # If no messages exist but item_id and recipient_id are provided, show chat UI for new conversation
-    elif item_id and recipient_id:
-        item = get_object_or_404(Item, id=item_id)
-        recipient = get_object_or_404(User, id=recipient_id)
-        avatar_url = ''
-        if hasattr(recipient, 'userprofile') and recipient.userprofile.profile_picture:
-            avatar_url = recipient.userprofile.profile_picture.url
-        active_convo_data = {
-            'id': f"{item.id}-{recipient.id}",
-            'avatar_url': avatar_url,
-            'name': recipient.get_full_name() or recipient.username,
             'item_title': item.title,
-            'item_image': item.photo.url if item.photo else '',
+            'item_image': thumbnail_url(item.photo, 160) if item.photo else '',
             'item_price': getattr(item, 'price', ''),
-            'date': None,
-            'messages': [],
+            'date': active_conversation.last_activity if active_conversation else None,
+            'messages': active_messages,
+            'has_older': has_older,
+            'oldest_id': active_messages[0].id if active_messages else None,
+            'newest_id': active_messages[-1].id if active_messages else 0,
         }
 
     # Ensure item_id and recipient_id are set for the form
@@ -457,12 +462,40 @@ def inbox(request):
         item_id = active_convo_data['id'].split('-')[0]
         recipient_id = active_convo_data['id'].split('-')[1]
 
+    # Keep the current view on the "older conversations" link
+    convo_params = request.GET.copy()
+    convo_params.pop('convo_cursor', None)
+    if convo_page.next_cursor:
+        convo_params['convo_cursor'] = convo_page.next_cursor
+
     return render(request, 'FindIt/inbox.html', {
         'conversations': sidebar_conversations,
         'active_conversation': active_convo_data,
         'user': request.user,
         'item_id': item_id,
         'recipient_id': recipient_id,
+        'older_conversations_query': convo_params.urlencode() if convo_page.next_cursor else '',
+    })
+
+@login_required
+def inbox_history(request):
+    """Older messages of one conversation, by message-id cursor, as an HTML fragment in JSON"""
+    from django.http import JsonResponse
+    from django.template.loader import render_to_string
+    item = get_object_or_404(Item, id=request.GET.get('item_id'))
+    other_user = get_object_or_404(User, id=request.GET.get('recipient_id'))
+    before = request.GET.get('before')
+    if before is not None and not before.isdigit():
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    page, has_older = message_history(
+        conversation_messages(request.user, item, other_user, include_archived=request.GET.get('archived') == '1'),
+        before_id=int(before) if before else None,
+    )
+    return JsonResponse({
+        'html': render_to_string('FindIt/chat_messages.html', {'messages': page}, request=request),
+        'count': len(page),
+        'before': page[0].id if page else None,
+        'has_older': has_older,
     })
 
 def send_message(request, item_id, recipient_id):
@@ -470,16 +503,12 @@ def send_message(request, item_id, recipient_id):
     recipient = get_object_or_404(User, id=recipient_id)
 
 
-    # Conversation: all messages between these two users about this item, not deleted for this user
-    conversation = Message.objects.filter(
-        item=item,
-        sender__in=[request.user, recipient],
-        recipient__in=[request.user, recipient]
-    ).exclude(
-        sender=request.user, deleted_by_sender=True
-    ).exclude(
-        recipient=request.user, deleted_by_recipient=True
-    ).order_by('timestamp')
+    # Conversation: one page of messages between these two users about this item, not deleted for this user
+    before = request.GET.get('before')
+    conversation, has_older = message_history(
+        conversation_messages(request.user, item, recipient),
+        before_id=int(before) if before and before.isdigit() else None,
+    )
 
     # Soft clear conversation for this user only
     if request.method == 'POST' and 'clear_conversation' in request.POST:
@@ -500,7 +529,7 @@ def send_message(request, item_id, recipient_id):
     if request.method == 'POST' and 'clear_conversation' not in request.POST:
         form = MessageForm(request.POST)
         if form.is_valid():
-            Message.objects.create(
+            create_message(
                 sender=request.user,
                 recipient=recipient,
                 item=item,
@@ -515,6 +544,7 @@ def send_message(request, item_id, recipient_id):
         'item': item,
         'recipient': recipient,
         'conversation': conversation,
+        'older_before': conversation[0].id if has_older else None,
     })
 
 from django.shortcuts import render, redirect
@@ -540,9 +570,14 @@ def profile_view(request):
 def edit_profile(request):
     profile = request.user.userprofile
     if request.method == 'POST':
+        old_picture = profile.profile_picture.name
         form = UserProfileForm(request.POST, request.FILES, instance=profile, user=request.user)
+        add_upload_errors(request, form)
         if form.is_valid():
             form.save()
+            if 'profile_picture' in form.changed_data:
+                release(old_picture, profile.profile_picture.storage)
+                schedule_thumbnails(profile.profile_picture)
             return redirect('profile')
     else:
         form = UserProfileForm(instance=profile, user=request.user)
@@ -552,10 +587,18 @@ def edit_profile(request):
 @require_POST
 def upload_profile_picture(request):
     profile = request.user.userprofile
-    form = UserProfileForm(request.POST, request.FILES, instance=profile, user=request.user)
+    for error in upload_errors(request).values():
+        messages.error(request, error)
     if 'profile_picture' in request.FILES:
-        profile.profile_picture = request.FILES['profile_picture']
+        old_picture = profile.profile_picture.name
+        try:
+            profile.profile_picture = normalize(request.FILES['profile_picture'], 'profile_pics')
+        except ImageRejected as e:
+            messages.error(request, str(e))
+            return redirect('profile')
         profile.save()
+        release(old_picture, profile.profile_picture.storage)
+        schedule_thumbnails(profile.profile_picture)
     return redirect('profile')
 
 @login_required
@@ -563,6 +606,7 @@ def upload_profile_picture(request):
 def remove_profile_picture(request):
     profile = request.user.userprofile
     if profile.profile_picture:
+        # Drops this profile's reference; the file and its thumbnails go with the last one
         profile.profile_picture.delete(save=False)
         profile.profile_picture = None
         profile.save()
@@ -600,13 +644,26 @@ def edit_item_fields(request, item_id):
         description = request.POST.get('description', '').strip()
         location = request.POST.get('location', '').strip()
         photo = request.FILES.get('photo')
+        for error in upload_errors(request).values():
+            messages.error(request, error)
+        if photo:
+            try:
+                photo = normalize(photo, 'item_photos')
+            except ImageRejected as e:
+                messages.error(request, str(e))
+                return redirect('item_detail', item_id=item.id)
         if description:
             item.description = description
         if location:
             item.location = location
+        old_photo = item.photo.name
         if photo:
             item.photo = photo
         item.save()
+        schedule_scoring(item)
+        if photo:
+            release(old_photo, item.photo.storage)
+            schedule_thumbnails(item.photo)
         messages.success(request, 'Item updated successfully.')
         return redirect('item_detail', item_id=item.id)
     else:
@@ -908,14 +965,7 @@ def clear_conversation(request):
         
         if action == 'delete':
             # Hard delete: Permanently remove all messages in this conversation
-            conversation_messages = Message.objects.filter(
-                item=item,
-                sender__in=[request.user, recipient],
-                recipient__in=[request.user, recipient]
-            )
-            
-            deleted_count = conversation_messages.count()
-            conversation_messages.delete()
+            deleted_count = delete_conversation(item, request.user, recipient)
             
             return JsonResponse({
                 'success': True, 
@@ -925,23 +975,7 @@ def clear_conversation(request):
         
         elif action == 'archive':
             # Soft delete: Mark messages as deleted for current user only
-            # Messages sent by current user
-            sender_messages = Message.objects.filter(
-                item=item,
-                sender=request.user,
-                recipient=recipient
-            )
-            sender_count = sender_messages.update(deleted_by_sender=True)
-            
-            # Messages received by current user
-            recipient_messages = Message.objects.filter(
-                item=item,
-                sender=recipient,
-                recipient=request.user
-            )
-            recipient_count = recipient_messages.update(deleted_by_recipient=True)
-            
-            total_archived = sender_count + recipient_count
+            total_archived = set_archived(item, request.user, recipient, True)
             
             return JsonResponse({
                 'success': True, 
@@ -951,23 +985,7 @@ def clear_conversation(request):
         
         elif action == 'unarchive':
             # Unarchive: Mark messages as not deleted for current user
-            # Messages sent by current user
-            sender_messages = Message.objects.filter(
-                item=item,
-                sender=request.user,
-                recipient=recipient
-            )
-            sender_count = sender_messages.update(deleted_by_sender=False)
-            
-            # Messages received by current user
-            recipient_messages = Message.objects.filter(
-                item=item,
-                sender=recipient,
-                recipient=request.user
-            )
-            recipient_count = recipient_messages.update(deleted_by_recipient=False)
-            
-            total_unarchived = sender_count + recipient_count
+            total_unarchived = set_archived(item, request.user, recipient, False)
             
             return JsonResponse({
                 'success': True, 
@@ -983,3 +1001,31 @@ def clear_conversation(request):
 
 
 
+
+
+def metrics(request):
+    """Chat socket metrics of this process in the Prometheus text format.
+
+    Needs ``Authorization: Bearer <METRICS_TOKEN>``. Without a token only
+    INTERNAL_IPS get in, and only with DEBUG on: behind a reverse proxy every
+    request comes from 127.0.0.1. Otherwise the page doesn't exist.
+    """
+    import hmac
+    from django.http import Http404, HttpResponse, HttpResponseForbidden
+    from .metrics import render
+
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return HttpResponseForbidden()
+    elif not (settings.DEBUG and request.META.get('REMOTE_ADDR') in getattr(settings, 'INTERNAL_IPS', [])):
+        raise Http404
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@require_safe
+def serve_media(request, path):
+    """Uploaded files under MEDIA_URL, with permission checks on private ones (see media.py)"""
+    from .media import serve
+
+    return serve(request, path)
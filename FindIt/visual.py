@@ -0,0 +1,232 @@
+"""
+Visual similarity of item photos.
+
+Found items often come with a photo and a vague title ("black thing"), which
+text matching can't connect to "Sony headphones". Every item photo gets a
+64-bit difference hash (dHash): the photo is shrunk to 9x8 grey pixels and
+each bit says whether a pixel is brighter than its right neighbour. Recompressed,
+resized or slightly recropped copies of a picture land within a few bits of
+each other, so similarity is the Hamming distance between hashes.
+
+- ingest.normalize() computes the hash from the image it has already decoded;
+  the pre_save hook in models.py stores it in Item.photo_hash. The
+  rebuild_photo_index command backfills existing photos.
+- Each process keeps every item's hash in a BK-tree, a metric tree that
+  finds every hash within a distance without comparing against all of them.
+  New items are added incrementally every REFRESH_SECONDS; a changed or
+  removed photo bumps a version in the shared cache, which makes every
+  process rebuild. Whether an item is still listed is checked when the hits
+  are read back from the database.
+- similar_items() backs the "visually similar" panel on item_detail.
+
+Nearly uniform pictures (a blank wall, a black screen) hash to almost all
+zeros or ones and would all match each other, so they are not indexed.
+"""
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+# Furthest two hashes can be apart and still count as the same picture
+MAX_DISTANCE = 10
+# Hashes with fewer set (or unset) bits than this come from featureless images
+MIN_DETAIL_BITS = 4
+VERSION_KEY = 'findit:photo-index:version'
+# Seconds a process serves its index before looking for new items
+REFRESH_SECONDS = 10
+# Most hits read back from the database per lookup
+CANDIDATE_LIMIT = 100
+
+_lock = threading.Lock()
+_local = {'tree': None, 'version': None, 'max_id': 0, 'checked': 0.0}
+
+
+def dhash(image):
+    """64-bit difference hash of a Pillow image"""
+    from PIL import Image
+
+    pixels = list(image.convert('L').resize((9, 8), Image.Resampling.BOX).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def hash_file(name, storage):
+    """dHash of a stored image, decoded at the smallest scale that still covers 9x8"""
+    from PIL import Image, ImageOps
+
+    with storage.open(name, 'rb') as fh, Image.open(fh) as image:
+        image.draft('L', (64, 64))
+        return dhash(ImageOps.exif_transpose(image))
+
+
+# Item.photo_hash is a signed 64-bit column
+def to_signed(value):
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def to_unsigned(value):
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+def distance(a, b):
+    return (a ^ b).bit_count()
+
+
+def is_informative(value):
+    return MIN_DETAIL_BITS <= value.bit_count() <= HASH_BITS - MIN_DETAIL_BITS
+
+
+class BKTree:
+    """Hashes and the item ids holding them, searchable by Hamming distance.
+
+    A node's children are keyed by their distance to it; by the triangle
+    inequality a search within ``radius`` of a query at distance d from a
+    node only needs the children keyed d - radius .. d + radius.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item_id):
+        self.size += 1
+        if self.root is None:
+            self.root = (value, {item_id}, {})
+            return
+        node = self.root
+        while True:
+            d = distance(value, node[0])
+            if d == 0:
+                node[1].add(item_id)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = (value, {item_id}, {})
+                return
+            node = child
+
+    def search(self, value, radius):
+        """``[(distance, item_id), ...]`` of every hash within ``radius`` of ``value``"""
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_value, ids, children = stack.pop()
+            d = distance(value, node_value)
+            if d <= radius:
+                found.extend((d, item_id) for item_id in ids)
+            for key, child in children.items():
+                if d - radius <= key <= d + radius:
+                    stack.append(child)
+        return found
+
+
+def _current_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, 1, timeout=None)
+        version = cache.get(VERSION_KEY, 1)
+    return version
+
+
+def invalidate_index():
+    """Make every process rebuild its index (a photo changed or went away)"""
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, timeout=None)
+    _local['checked'] = 0.0
+
+
+def _load(tree, min_id):
+    """Add the items with id > ``min_id`` to ``tree``; returns the highest id seen"""
+    from .models import Item
+
+    rows = Item.objects.filter(pk__gt=min_id, photo_hash__isnull=False).order_by('pk').values_list('pk', 'photo_hash')
+    for item_id, value in rows.iterator(chunk_size=5000):
+        value = to_unsigned(value)
+        if is_informative(value):
+            tree.add(value, item_id)
+        min_id = item_id
+    return min_id
+
+
+def get_index():
+    """This process's BKTree, refreshed from the database when due"""
+    now = time.monotonic()
+    if _local['tree'] is not None and now - _local['checked'] < REFRESH_SECONDS:
+        return _local['tree']
+    # One thread refreshes; the others keep using the current tree meanwhile
+    if not _lock.acquire(blocking=_local['tree'] is None):
+        return _local['tree']
+    try:
+        if _local['tree'] is not None and time.monotonic() - _local['checked'] < REFRESH_SECONDS:
+            return _local['tree']
+        version = _current_version()
+        if version != _local['version'] or _local['tree'] is None:
+            started = time.monotonic()
+            tree = BKTree()
+            _local['max_id'] = _load(tree, 0)
+            _local['tree'], _local['version'] = tree, version
+            logger.info('photo index rebuilt hashes=%s ms=%.0f', tree.size, (time.monotonic() - started) * 1000)
+        else:
+            _local['max_id'] = _load(_local['tree'], _local['max_id'])
+        _local['checked'] = time.monotonic()
+        return _local['tree']
+    finally:
+        _lock.release()
+
+
+def record_photo_hash(item):
+    """Set ``item.photo_hash`` when its photo is newly assigned or removed (pre_save)"""
+    from .ingest import NormalizedImage
+
+    photo = item.photo
+    if not photo:
+        if item.photo_hash is None:
+            return
+        item.photo_hash = None
+    elif not photo._committed:
+        pending = getattr(photo, '_file', None)
+        value = getattr(pending, 'dhash', None) if isinstance(pending, NormalizedImage) else None
+        # Not from ingest (e.g. the admin): left for rebuild_photo_index
+        item.photo_hash = to_signed(value) if value is not None else None
+    else:
+        return
+    if item.pk is not None:
+        # The old hash may be in every process's index
+        transaction.on_commit(invalidate_index)
+
+
+def similar_items(item, limit=6, max_distance=MAX_DISTANCE):
+    """Listed items whose photo looks like ``item``'s, nearest first.
+
+    Each has ``photo_distance`` (differing bits) and ``photo_similarity`` (percent) set.
+    """
+    from .models import Item
+
+    if item.photo_hash is None:
+        return []
+    value = to_unsigned(item.photo_hash)
+    if not is_informative(value):
+        return []
+    hits = sorted(hit for hit in get_index().search(value, max_distance) if hit[1] != item.pk)
+    candidates = Item.objects.filter(
+        pk__in=[item_id for _, item_id in hits[:CANDIDATE_LIMIT]], state__in=Item.LISTED_STATES, photo_hash__isnull=False,
+    ).select_related('category')
+    results = []
+    for candidate in candidates:
+        # The index may predate a photo change
+        candidate.photo_distance = distance(value, to_unsigned(candidate.photo_hash))
+        if candidate.photo_distance <= max_distance:
+            candidate.photo_similarity = round(100 * (1 - candidate.photo_distance / HASH_BITS))
+            results.append(candidate)
+    results.sort(key=lambda candidate: (candidate.photo_distance, -candidate.pk))
+    return results[:limit]
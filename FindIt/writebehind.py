@@ -0,0 +1,210 @@
+"""
+Write-behind persistence for chat messages.
+
+ChatConsumer broadcasts a message to its room as soon as it arrives, tagged
+with the client's own id, and queues it on the MessageWriter for its event
+loop. The writer inserts queued messages in batches of up to BATCH_SIZE, at
+most BATCH_DELAY seconds after the first one was queued, through
+messaging.create_messages (one bulk INSERT, one counter update per
+conversation). When a batch has committed the room gets a ``saved`` event
+mapping each client id to its database id, flagged ``duplicate`` when the
+client id had been stored before so clients keep only the first bubble.
+Messages that could not be stored get an ``error`` event in the room: the
+sender may resend, everyone else drops the bubble.
+
+Guarantees:
+
+* Ordering - batches are written one at a time, in the order messages
+  reached this process, so message ids (and history order) follow the order
+  each socket sent them.
+* Delivery - live delivery over the channel layer is at most once; the
+  database is the record. A message is durable once its ``saved`` event has
+  arrived. Until then a client may resend it with the same client id:
+  (sender, client_id) is unique, so a resend of a message that did commit
+  just returns the stored copy.
+* Loss window - if the process dies, messages queued in the last BATCH_DELAY
+  seconds are not stored. A socket's messages are flushed before its
+  disconnect completes, and whatever is still queued at interpreter exit is
+  written synchronously.
+"""
+import asyncio
+import atexit
+import logging
+import time
+import weakref
+from dataclasses import dataclass, field
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.db import IntegrityError
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+# Seconds a queued message may wait for its batch to fill
+BATCH_DELAY = 0.05
+
+
+@dataclass
+class PendingMessage:
+    client_id: str
+    sender_id: int
+    recipient_id: int
+    item_id: int
+    content: str
+    # uploads.StoredImage or None
+    image: object
+    # Room that gets the saved or error event
+    room: str
+    queued_at: float = field(default_factory=time.perf_counter)
+
+
+def write_batch(batch):
+    """Store ``batch``; returns ``{(sender_id, client_id): (message id, duplicate)}`` for the messages stored.
+
+    ``duplicate`` is set when the client id was already stored, by an earlier
+    batch or earlier in this one, and the id is that of the stored copy.
+    """
+    from .messaging import create_messages
+    from .models import Message
+    from .storage import release
+
+    messages = [
+        Message(
+            sender_id=pending.sender_id,
+            recipient_id=pending.recipient_id,
+            item_id=pending.item_id,
+            content=pending.content,
+            image=pending.image.name if pending.image else None,
+            image_width=pending.image.width if pending.image else None,
+            image_height=pending.image.height if pending.image else None,
+            client_id=pending.client_id,
+        )
+        for pending in batch
+    ]
+    try:
+        stored = list(zip(messages, create_messages(messages)))
+    except IntegrityError:
+        # One bad row (say, an item deleted meanwhile) must not sink the batch
+        stored = []
+        for message in messages:
+            try:
+                stored += zip([message], create_messages([message]))
+            except IntegrityError:
+                logger.warning('Dropped chat message %s from user %s', message.client_id, message.sender_id)
+    kept = {id(message) for message, copy in stored if copy is message}
+    for message in messages:
+        if message.image and id(message) not in kept:
+            # A duplicate or dropped: give back the reference its upload took
+            release(message.image)
+    saved = {}
+    for message, copy in stored:
+        # Client ids are only unique per sender
+        saved.setdefault((message.sender_id, message.client_id), (copy.pk, copy is not message))
+    return saved
+
+
+class MessageWriter:
+    def __init__(self, batch_size=BATCH_SIZE, delay=BATCH_DELAY):
+        self.batch_size = batch_size
+        self.delay = delay
+        self._pending = []
+        self._timer = None
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def enqueue(self, pending):
+        """Queue ``pending``; must be called on the writer's event loop"""
+        self._pending.append(pending)
+        if len(self._pending) >= self.batch_size:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.delay)
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        """Write everything queued so far, in order"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                await self._write(batch)
+
+    async def _write(self, batch):
+        started = time.perf_counter()
+        try:
+            saved = await database_sync_to_async(write_batch)(batch)
+        except Exception:
+            logger.exception('Failed to store %d chat messages', len(batch))
+            saved = {}
+        finished = time.perf_counter()
+        metrics.save_batch_seconds.observe(finished - started)
+
+        channel_layer = get_channel_layer()
+        announced = set()
+        for pending in batch:
+            key = (pending.sender_id, pending.client_id)
+            message_id, duplicate = saved.get(key, (None, False))
+            if message_id:
+                metrics.save_latency_seconds.observe(finished - pending.queued_at)
+                await channel_layer.group_send(pending.room, {
+                    'type': 'chat_message_saved',
+                    'client_id': pending.client_id,
+                    'message_id': message_id,
+                    # A resend within this batch is a duplicate of the first
+                    'duplicate': duplicate or key in announced,
+                })
+                announced.add(key)
+            else:
+                metrics.save_failures.inc()
+                await channel_layer.group_send(pending.room, {
+                    'type': 'chat_message_failed',
+                    'client_id': pending.client_id,
+                    'sender_id': pending.sender_id,
+                })
+
+    def flush_sync(self):
+        """Write whatever is queued without an event loop, e.g. at shutdown"""
+        batch, self._pending = self._pending, []
+        for start in range(0, len(batch), self.batch_size):
+            write_batch(batch[start:start + self.batch_size])
+
+
+# One writer per event loop: Daphne and Uvicorn run one loop per process
+_writers = weakref.WeakKeyDictionary()
+
+
+def get_writer():
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        writer = _writers[loop] = MessageWriter()
+    return writer
+
+
+@atexit.register
+def _flush_at_exit():
+    for writer in list(_writers.values()):
+        if len(writer):
+            try:
+                writer.flush_sync()
+            except Exception:
+                logger.exception('Failed to store queued chat messages at exit')
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -162,12 +163,37 @@ STORAGES = {
     "staticfiles": {
         "BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage",
     },
+    # Item photos, profile pictures and chat images: named by content hash and
+    # deduplicated (see FindIt/storage.py)
+    "media": {
+        "BACKEND": "FindIt.storage.ContentAddressedStorage",
+    },
 }
 
 # Media files (user uploads)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# Media is served by FindIt.views.serve_media after its permission checks. In
+# production let the web server send the file: 'x-accel-redirect' (nginx, with
+# an internal location at MEDIA_ACCEL_PREFIX aliased to MEDIA_ROOT) or
+# 'x-sendfile' (Apache mod_xsendfile). Empty streams it from Django.
+MEDIA_SENDFILE = os.environ.get('MEDIA_SENDFILE', '')
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+
+
 
+# Cache (category registry, facet counts)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',  # Per-process, for development
+        # Presence and rate limits keep a few keys per connected user; the
+        # default of 300 entries would evict them with a few hundred sockets
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+        # For production with several workers, share it through Redis:
+        # 'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        # 'LOCATION': 'redis://127.0.0.1:6379/1',
+    },
+}
 
 
 # Default primary key field type
@@ -187,14 +213,110 @@ LOGOUT_REDIRECT_URL = '/'
 # Django Channels Configuration
 ASGI_APPLICATION = 'lost_and_found.asgi.application'
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',  # For development
-        # For production, use Redis:
-        # 'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        # 'CONFIG': {
-        #     "hosts": [('127.0.0.1', 6379)],
-        # },
+# Channel layer, chosen per environment with CHANNEL_LAYER:
+#   memory       - one process only, for development (default)
+#   redis        - channels_redis list-based layer; required for several workers
+#   redis_pubsub - channels_redis pub/sub layer; no per-group bookkeeping in Redis
+# REDIS_URL points at the server, e.g. redis://127.0.0.1:6379/0
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0')
+CHANNEL_LAYER = os.environ.get('CHANNEL_LAYER', 'memory')
+# Bounded send queue per socket: events for a client that has stalled are
+# dropped beyond this, and the client catches up by resuming from the database
+CHANNEL_CAPACITY = int(os.environ.get('CHANNEL_CAPACITY', 100))
+# Redis connections per worker. Each layer call in flight holds one, and newer
+# redis-py pools raise rather than wait once they run out (the default is 100).
+# Size it for bursts: a restart disconnecting every socket at once makes a few
+# calls per socket together.
+REDIS_HOST = {
+    'address': REDIS_URL,
+    'max_connections': int(os.environ.get('REDIS_MAX_CONNECTIONS', 1000)),
+}
+
+if CHANNEL_LAYER == 'redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_HOST],
+                # Lets several deployments share one Redis
+                'prefix': os.environ.get('CHANNEL_LAYER_PREFIX', 'findit'),
+                'capacity': CHANNEL_CAPACITY,
+                # Undelivered messages to a socket that went away are dropped
+                # quickly; clients resume missed history from the database
+                'expiry': 10,
+                # Longest a socket stays in a room without re-joining
+                'group_expiry': 24 * 60 * 60,
+            },
+        },
+    }
+elif CHANNEL_LAYER == 'redis_pubsub':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.pubsub.RedisPubSubChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_HOST],
+                'prefix': os.environ.get('CHANNEL_LAYER_PREFIX', 'findit'),
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {
+                'capacity': CHANNEL_CAPACITY,
+            },
+        },
+    }
+
+# Chat socket limits; any key of FindIt.ratelimit.DEFAULTS can be overridden, e.g.
+# CHAT_LIMITS = {'connection_rate': 2, 'user_messages': 60, 'max_frame_bytes': 16384}
+CHAT_LIMITS = {}
+# Part files of chat image uploads in progress (see FindIt/uploads.py); defaults
+# to the system temp dir. Share it between ASGI workers so an upload can resume
+# on any of them. Keep it out of MEDIA_ROOT.
+if os.environ.get('CHAT_UPLOAD_TEMP_DIR'):
+    CHAT_UPLOAD_TEMP_DIR = os.environ['CHAT_UPLOAD_TEMP_DIR']
+# Uploaded images are re-encoded and resized at ingest (see FindIt/ingest.py).
+# The first handler drops an image upload as soon as it passes its budget;
+# override budgets per kind, e.g. IMAGE_BUDGETS = {'item_photos': {'max_side': 1600}}
+FILE_UPLOAD_HANDLERS = [
+    'FindIt.ingest.ImageBudgetUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+IMAGE_BUDGETS = {}
+# Widths of the thumbnails made for every item photo, profile picture and chat
+# image (see FindIt/thumbnails.py); backfill with manage.py generate_thumbnails
+THUMBNAIL_SIZES = (160, 480, 1200)
+# /metrics/ (chat socket metrics for Prometheus) answers clients presenting
+# this token as "Authorization: Bearer <token>". Without one it answers
+# INTERNAL_IPS with DEBUG on, and is a 404 otherwise
+INTERNAL_IPS = ['127.0.0.1']
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Leveled key=value logs. FindIt.consumers logs connects at INFO and every
+# chat message at DEBUG; keep it at INFO in production so frames cost no
+# writes on the event loop.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'keyvalue': {
+            'format': 'time=%(asctime)s level=%(levelname)s logger=%(name)s %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'keyvalue',
+        },
+    },
+    'loggers': {
+        'FindIt': {
+            'handlers': ['console'],
+            'level': os.environ.get('FINDIT_LOG_LEVEL', 'INFO'),
+        },
     },
 }
 SITE_URL = 'http://127.0.0.1:8000'
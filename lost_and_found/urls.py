@@ -16,15 +16,17 @@ Including another URLconf
 """
 
 from django.contrib import admin
-from django.urls import path, include
+import re
+
+from django.urls import path, include, re_path
 from django.conf import settings
-from django.conf.urls.static import static
+
+from FindIt.views import serve_media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('FindIt.urls')),
+    # Media files, in every environment: private ones need permission checks
+    # (see FindIt/media.py); set MEDIA_SENDFILE to have the web server send them
+    re_path(r'^%s(?P<path>.+)$' % re.escape(settings.MEDIA_URL.lstrip('/')), serve_media, name='media'),
 ]
-
-# Serve media files during development
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)